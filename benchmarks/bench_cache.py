@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time a search of a generated tree with no matches with --no-cache and with
+# the metadata cache cold, written by the search, and warm, read by it
+# the runs are interleaved, the median is shown
+# usage: bench_cache.py [repeat] [tree]
+from __future__ import print_function
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+
+sys.path.insert(0, here)
+from tree import make_tree
+
+
+def run(root, cache_file, args):
+    cmd = [sys.executable, '-m', 'pyf.pyf', '-N', '--cache-file', cache_file] + args + ['-d', root, 'no-such-text']
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(cmd, cwd=top, stdout=devnull, stderr=devnull)
+    return time.time() - start
+
+
+def median(times):
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    repeat = 9
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+    tmp = tempfile.mkdtemp(prefix='pyf-bench-')
+    try:
+        if len(sys.argv) > 2:
+            root = sys.argv[2]
+        else:
+            root = os.path.join(tmp, 'tree')
+            make_tree(root, dirs=100, files=100, lines=50)
+        cache_file = os.path.join(tmp, 'metadata')
+        times = {'no-cache': [], 'cold': [], 'warm': []}
+        for i in range(repeat):
+            times['no-cache'].append(run(root, cache_file, ['--no-cache']))
+            if os.path.exists(cache_file):
+                os.unlink(cache_file)
+            times['cold'].append(run(root, cache_file, []))
+            times['warm'].append(run(root, cache_file, []))
+        print('cache     seconds')
+        for name in ('no-cache', 'cold', 'warm'):
+            print('%-8s  %7.3f' % (name, median(times[name])))
+    finally:
+        shutil.rmtree(tmp)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
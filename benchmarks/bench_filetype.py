@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time the binary file check on blocks of ascii, utf-8 and binary data
+# per-byte: each byte looked at in turn in python, as pyf used to
+# table: ascii bytes counted with bytes.translate, utf-8 with a bytes regex
+from __future__ import print_function
+
+import os
+import os.path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyf.filetype import is_ascii, is_text_ascii, is_text_utf8
+
+sizes = [64, 1024, 8192]
+
+
+def per_byte_text_ascii(data, confidence=0.7):
+    return float(len([d for d in data if is_ascii(d)])) / len(data) >= confidence
+
+
+def per_byte_text_utf8(data, confidence=0.7):
+    # the number of bytes after a lead byte, from its high bits
+    count = 0
+    i = 0
+    while i < len(data):
+        d = data[i]
+        if is_ascii(d):
+            count += 1
+        elif d & 0xc0 == 0xc0:
+            for mask, lead, n in ((0xe0, 0xc0, 1), (0xf0, 0xe0, 2), (0xf8, 0xf0, 3), (0xfc, 0xf8, 4), (0xfe, 0xfc, 5)):
+                if d & mask == lead and i + n < len(data) and all(c & 0xc0 == 0x80 for c in data[i + 1:i + n + 1]):
+                    count += n + 1
+                    i += n
+                    break
+        i += 1
+    return float(count) / len(data) >= confidence
+
+
+def make_data(kind, size, rnd):
+    if kind == 'ascii':
+        text = 'the quick brown fox jumps over the lazy dog\n'
+    elif kind == 'utf-8':
+        text = 'le cœur déçu mais l\'âme plutôt naïve 中文 \n'
+    else:
+        return bytes(rnd.randrange(256) for i in range(size))
+    data = (text * (size // len(text) + 1)).encode('utf-8')
+    return data[:size]
+
+
+def best(func, data, number):
+    return min(timeit.repeat(lambda: func(data), number=number, repeat=3)) / number
+
+
+def main():
+    rnd = random.Random(0)
+    print('%-8s %6s  %12s %12s  %12s %12s' % ('data', 'size', 'ascii/byte', 'ascii/table', 'utf8/byte', 'utf8/table'))
+    for kind in ('ascii', 'utf-8', 'binary'):
+        for size in sizes:
+            data = make_data(kind, size, rnd)
+            number = max(10, 100000 // size)
+            times = [
+                best(per_byte_text_ascii, data, number),
+                best(is_text_ascii, data, number),
+                best(per_byte_text_utf8, data, number),
+                best(is_text_utf8, data, number),
+            ]
+            print('%-8s %6d  %10.1fus %10.1fus  %10.1fus %10.1fus' % tuple([kind, size] + [t * 1e6 for t in times]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time a search with an increasing number of worker processes
+# usage: bench_jobs.py [max-jobs]
+from __future__ import print_function
+
+import multiprocessing
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyf.pyf
+from tree import make_tree
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def run(root, jobs, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        pyf.pyf.main(['-N', '-j', str(jobs), '-d', root, 'needle'], stdout=NullWriter(), stderr=NullWriter())
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    if len(sys.argv) > 1:
+        max_jobs = int(sys.argv[1])
+    else:
+        max_jobs = multiprocessing.cpu_count()
+    root = tempfile.mkdtemp(prefix='pyf-bench-')
+    try:
+        make_tree(root, dirs=40, files=100, lines=400)
+        base = run(root, 1)
+        print('jobs  seconds  speedup  efficiency')
+        print('%4d  %7.3f  %7.2f  %9.0f%%' % (1, base, 1.0, 100.0))
+        jobs = 2
+        while jobs <= max_jobs:
+            t = run(root, jobs)
+            print('%4d  %7.3f  %7.2f  %9.0f%%' % (jobs, t, base / t, 100.0 * base / t / jobs))
+            jobs *= 2
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
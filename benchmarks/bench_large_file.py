@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# compare reading a large file into memory with searching it memory mapped
+# and, for a pattern that cannot search the mapped bytes, line by line
+# reports wall time and the peak RSS of the pyf process
+# note the RSS of the mapped search counts page cache pages, which the
+# kernel can drop, unlike the memory holding the read file
+# usage: bench_large_file.py [size-in-mb]
+from __future__ import print_function
+
+import os
+import os.path
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+
+sys.path.insert(0, here)
+from tree import make_line
+
+
+def make_file(path, size):
+    rnd = random.Random(1)
+    block = '\n'.join(make_line(rnd) for i in range(10000)) + '\n'
+    with open(path, 'w') as fp:
+        written = 0
+        while written < size:
+            fp.write(block)
+            written += len(block)
+        fp.write('the needle is here\n')
+
+
+def run(path, large_file_size, pattern):
+    cmd = [sys.executable, '-m', 'pyf.pyf', '-N', '--no-cache', '-p', '-l', '-c', '2',
+           '--large-file-size', str(large_file_size), '-f', path, pattern]
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=top, stdout=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    return elapsed, rusage.ru_maxrss / 1024.0
+
+
+def main():
+    size_mb = 256
+    if len(sys.argv) > 1:
+        size_mb = int(sys.argv[1])
+    fd, path = tempfile.mkstemp(prefix='pyf-bench-', suffix='.txt')
+    os.close(fd)
+    try:
+        make_file(path, size_mb * 1024 * 1024)
+        print('file: %d MB' % size_mb)
+        print('path      pattern       seconds  MB/s  peak RSS MB')
+        runs = (
+            ('read', 1 << 62, 'needle'),
+            ('mapped', 0, 'needle'),
+            ('read', 1 << 62, '(?i)need.e'),
+            ('streamed', 0, '(?i)need.e'),
+        )
+        for name, threshold, pattern in runs:
+            t, rss = run(path, threshold, pattern)
+            print('%-8s  %-12s  %7.2f  %4.0f  %11.1f' % (name, pattern, t, size_mb / t, rss))
+    finally:
+        os.unlink(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
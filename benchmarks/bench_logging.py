@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time walking a generated tree, skipping most files by name, with debug
+# logging off, with the logging functions removed, with --debug logging
+# to /dev/null and with --trace to /dev/null
+# with logging off the walk must not call the logging functions at all,
+# so it takes as long as without them
+# usage: bench_logging.py [repeat]
+from __future__ import print_function
+
+import logging
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+
+sys.path.insert(0, here)
+sys.path.insert(0, top)
+from tree import make_tree
+
+import pyf.logger
+import pyf.options
+import pyf.pyf
+
+
+def walk(options):
+    n = 0
+    for root, dirs, files in pyf.pyf.pyfwalk(options, options.start_directory):
+        n += len(files)
+    return n
+
+
+def best(options, repeat):
+    t = None
+    for i in range(repeat):
+        start = time.time()
+        walk(options)
+        elapsed = time.time() - start
+        if t is None or elapsed < t:
+            t = elapsed
+    return t
+
+
+def main():
+    repeat = 5
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+    root = tempfile.mkdtemp(prefix='pyf-bench-')
+    devnull = open(os.devnull, 'w')
+    try:
+        make_tree(root, dirs=100, files=100, lines=1)
+        options = pyf.options.parse_opts(['-N', '--no-cache', '-n', r'file00\d', '-d', root],
+                                         stdout=devnull, stderr=devnull)
+        print('logging        seconds')
+
+        print('%-13s  %7.3f' % ('off', best(options, repeat)))
+
+        debug, trace = pyf.pyf.debug, pyf.pyf.trace
+        pyf.pyf.debug = pyf.pyf.trace = None
+        try:
+            print('%-13s  %7.3f' % ('removed', best(options, repeat)))
+        finally:
+            pyf.pyf.debug, pyf.pyf.trace = debug, trace
+
+        options.debug = True
+        pyf.logger.glogger = logging.getLogger('pyf-bench')
+        pyf.logger.glogger.setLevel(logging.DEBUG)
+        pyf.logger.glogger.propagate = False
+        pyf.logger.glogger.addHandler(logging.StreamHandler(devnull))
+        print('%-13s  %7.3f' % ('--debug', best(options, repeat)))
+        pyf.logger.glogger = None
+        options.debug = False
+
+        options.trace = os.devnull
+        pyf.logger.open_trace(os.devnull)
+        print('%-13s  %7.3f' % ('--trace', best(options, repeat)))
+        pyf.logger.close_trace()
+    finally:
+        devnull.close()
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time printing every word of a generated tree with -s -m
+# to /dev/null and to a pipe, with the output buffered and line buffered
+# usage: bench_output.py [repeat]
+from __future__ import print_function
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+
+sys.path.insert(0, here)
+from tree import make_tree
+
+
+def run(root, to_pipe, line_buffered, repeat):
+    cmd = [sys.executable, '-m', 'pyf.pyf', '-N', '--no-cache', '-s', '-m', '-d', root, r'\w+']
+    if line_buffered:
+        cmd.append('--line-buffered')
+    best = None
+    lines = 0
+    for i in range(repeat):
+        start = time.time()
+        if to_pipe:
+            p = subprocess.Popen(cmd, cwd=top, stdout=subprocess.PIPE)
+            lines = 0
+            for block in iter(lambda: p.stdout.read(1 << 16), b''):
+                lines += block.count(b'\n')
+            p.wait()
+        else:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(cmd, cwd=top, stdout=devnull)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, lines
+
+
+def main():
+    repeat = 3
+    if len(sys.argv) > 1:
+        repeat = int(sys.argv[1])
+    root = tempfile.mkdtemp(prefix='pyf-bench-')
+    try:
+        make_tree(root, dirs=10, files=50, lines=200)
+        lines = None
+        print('output     buffering  seconds  lines/s')
+        # the pipe runs count the lines
+        for to_pipe in (True, False):
+            for line_buffered in (True, False):
+                t, n = run(root, to_pipe, line_buffered, repeat)
+                lines = n or lines
+                print('%-9s  %-9s  %7.3f  %7.0f' % (
+                    'pipe' if to_pipe else '/dev/null',
+                    'line' if line_buffered else 'block',
+                    t, lines / t))
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time searching a generated tree for many names, one pyf run per name
+# against one run given all the names
+# usage: bench_patterns.py [number-of-names]
+from __future__ import print_function
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyf.pyf
+from tree import make_tree
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def run(root, patterns):
+    argv = ['-N', '-p', '-d', root]
+    for p in patterns:
+        argv.extend(['-e', p])
+    pyf.pyf.main(argv, stdout=NullWriter(), stderr=NullWriter())
+
+
+def main():
+    n = 50
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    names = ['deprecated_api_%03d' % i for i in range(n)]
+    root = tempfile.mkdtemp(prefix='pyf-bench-')
+    try:
+        make_tree(root, dirs=20, files=50, lines=400, needle=names[0])
+        start = time.time()
+        for name in names:
+            run(root, [name])
+        separate = time.time() - start
+        start = time.time()
+        run(root, names)
+        together = time.time() - start
+        print('%d names' % n)
+        print('one run per name  %7.3f' % separate)
+        print('one run           %7.3f' % together)
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time searching a generated tree with and without the literal prefilter
+# per-line: each line searched in turn, as pyf used to
+# regex: the whole file searched with the regex
+# literal: files and lines found with the literal every match contains
+from __future__ import print_function
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyf.pyf
+from pyf.options import parse_opts
+from tree import make_tree
+
+patterns = [
+    r'needle',
+    r'foo\.bar\(',
+    r'golf.*needle',
+    r'(\w+) needle',
+    r'^zulu.*needle$',
+]
+
+
+class NullWriter(object):
+    def write(self, s):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def run(root, pattern, engine, repeat=3):
+    best = None
+    for i in range(repeat):
+        options = parse_opts(['-N', '-p', '-d', root, '-e', pattern], stdout=NullWriter(), stderr=NullWriter())
+        if engine != 'literal':
+            options.search_pattern_literal = None
+        if engine == 'per-line':
+            options.search_pattern_line_safe = False
+        start = time.time()
+        pyf.pyf.pyf(options)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    root = tempfile.mkdtemp(prefix='pyf-bench-')
+    try:
+        make_tree(root, dirs=20, files=100, lines=400)
+        print('%-16s  %8s  %8s  %8s' % ('pattern', 'per-line', 'regex', 'literal'))
+        for pattern in patterns:
+            times = [run(root, pattern, engine) for engine in ('per-line', 'regex', 'literal')]
+            print('%-16s  %8.3f  %8.3f  %8.3f' % tuple([pattern] + times))
+    finally:
+        shutil.rmtree(root)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# time pyf on a generated tree like a real checkout, see tree.make_suite_tree,
+# in each of the ways it is used: walking only, printing file names, files
+# with matches, lines, matches, contexts and running a command
+# the results are saved as JSON so two runs can be compared
+# usage: bench_suite.py [--scale N] [--repeat N] [--tree DIR] [--output FILE] [--scenario NAME]...
+#        bench_suite.py --compare OLD NEW
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+top = os.path.dirname(here)
+
+sys.path.insert(0, here)
+sys.path.insert(0, top)
+from tree import make_suite_tree
+
+import pyf
+from pyf.filetype import is_binary
+
+results_version = 1
+
+# given to every run, the cache would make the runs after the first faster
+common_args = ['-N', '--no-cache']
+
+# name, arguments, the directory of the tree searched
+# the legacy files are searched on their own, pyf stops at the first
+# file it cannot decode
+scenarios = [
+    ('walk-only', ['-n', 'no-such-file'], 'src'),
+    ('name-only', ['-n', r'\.py$'], 'src'),
+    ('files-with-matches', ['needle'], 'src'),
+    ('print-lines', ['-p', '-l', 'needle'], 'src'),
+    ('matches', ['-s', '-m', r'class [A-Z]\w+'], 'src'),
+    ('context', ['-p', '-c', '2', 'needle'], 'src'),
+    ('run', ['-r', 'true', 'needle'], 'src'),
+    ('non-utf8', ['needle'], 'legacy'),
+]
+
+# slower than this is flagged when comparing
+slower_threshold = 1.10
+
+
+def run_once(cmd):
+    start = time.time()
+    p = subprocess.Popen(cmd, cwd=top, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # the output is read, as a pipe, to count the lines
+    lines = 0
+    for block in iter(lambda: p.stdout.read(1 << 16), b''):
+        lines += block.count(b'\n')
+    errors = p.stderr.read().count(b'\n')
+    pid, status, rusage = os.wait4(p.pid, 0)
+    elapsed = time.time() - start
+    # ru_maxrss is in kilobytes on linux
+    return elapsed, rusage.ru_maxrss / 1024.0, lines, errors, os.WEXITSTATUS(status)
+
+
+def run_scenario(root, args, repeat):
+    cmd = [sys.executable, '-m', 'pyf.pyf'] + common_args + args + ['-d', root]
+    times = []
+    rss = 0
+    for i in range(repeat):
+        elapsed, maxrss, lines, errors, exitcode = run_once(cmd)
+        times.append(round(elapsed, 6))
+        rss = max(rss, maxrss)
+    return {
+        'cmd': cmd[3:],
+        'times': times,
+        'best': min(times),
+        'median': sorted(times)[len(times) // 2],
+        'max_rss_mb': round(rss, 1),
+        'lines': lines,
+        'errors': errors,
+        'exit': exitcode,
+    }
+
+
+def run_is_binary(root, repeat):
+    # filetype.is_binary on every file of the tree, in process
+    paths = []
+    for dpath, dirs, files in os.walk(root):
+        dirs.sort()
+        paths.extend(os.path.join(dpath, f) for f in sorted(files))
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        binary = sum(1 for path in paths if is_binary(path))
+        times.append(round(time.time() - start, 6))
+    return {
+        'cmd': ['is_binary'],
+        'times': times,
+        'best': min(times),
+        'median': sorted(times)[len(times) // 2],
+        'files': len(paths),
+        'binary': binary,
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=top, stderr=subprocess.DEVNULL)
+    except Exception:
+        return None
+    return out.decode().strip()
+
+
+def get_tree(tree, scale, seed):
+    # the tree in tree made earlier with the same scale and seed or a new one
+    manifest = os.path.join(tree, '.bench-tree.json')
+    settings = {'scale': scale, 'seed': seed}
+    try:
+        with open(manifest) as fp:
+            made = json.load(fp)
+        if made['settings'] == settings:
+            return made
+    except Exception:
+        pass
+    for name in ('src', 'legacy'):
+        shutil.rmtree(os.path.join(tree, name), ignore_errors=True)
+    made = {'settings': settings, 'counts': make_suite_tree(tree, scale=scale, seed=seed)}
+    with open(manifest, 'w') as fp:
+        json.dump(made, fp)
+    return made
+
+
+def run_suite(args):
+    tree = args.tree or tempfile.mkdtemp(prefix='pyf-bench-')
+    try:
+        if not os.path.isdir(tree):
+            os.makedirs(tree)
+        made = get_tree(tree, args.scale, args.seed)
+        results = {
+            'version': results_version,
+            'pyf': pyf.__version__,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'repeat': args.repeat,
+            'tree': made,
+            'scenarios': {},
+        }
+        print('scenario              best  median  RSS MB    lines  exit')
+        for name, scenario_args, subdir in scenarios:
+            if args.scenario and name not in args.scenario:
+                continue
+            r = run_scenario(os.path.join(tree, subdir), scenario_args, args.repeat)
+            results['scenarios'][name] = r
+            print('%-18s  %6.3f  %6.3f  %6.1f  %7d  %4d' % (name, r['best'], r['median'], r['max_rss_mb'], r['lines'], r['exit']))
+        if not args.scenario or 'is-binary' in args.scenario:
+            r = run_is_binary(os.path.join(tree, 'src'), args.repeat)
+            results['scenarios']['is-binary'] = r
+            print('%-18s  %6.3f  %6.3f' % ('is-binary', r['best'], r['median']))
+    finally:
+        if not args.tree:
+            shutil.rmtree(tree)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+    return 0
+
+
+def compare(old_file, new_file):
+    with open(old_file) as fp:
+        old = json.load(fp)
+    with open(new_file) as fp:
+        new = json.load(fp)
+    if old['tree']['settings'] != new['tree']['settings']:
+        print('warning: the trees differ: %s %s' % (old['tree']['settings'], new['tree']['settings']))
+    print('%s (%s) -> %s (%s)' % (old_file, old['commit'], new_file, new['commit']))
+    print('scenario             old best  new best  change')
+    slower = 0
+    for name, r in new['scenarios'].items():
+        o = old['scenarios'].get(name)
+        if not o:
+            print('%-18s  %8s  %8.3f' % (name, '-', r['best']))
+            continue
+        ratio = r['best'] / o['best'] if o['best'] else 1.0
+        flags = []
+        if ratio > slower_threshold:
+            flags.append('slower')
+            slower += 1
+        # a different output means the runs are not comparable
+        if o.get('lines') != r.get('lines') or o.get('exit') != r.get('exit'):
+            flags.append('output differs')
+        print('%-18s  %8.3f  %8.3f  %+5.0f%%  %s' % (name, o['best'], r['best'], (ratio - 1) * 100, ' '.join(flags)))
+    return 1 if slower else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time pyf on a generated tree.')
+    parser.add_argument('--scale', type=int, default=1, help='Make the tree N times larger. Default 1.')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generated tree. Default 1.')
+    parser.add_argument('--repeat', type=int, default=3, help='Run each scenario N times. Default 3.')
+    parser.add_argument('--tree', metavar='DIR', help='Make the tree in DIR and keep it for the next run.')
+    parser.add_argument('--output', metavar='FILE', help='Save the results to FILE as JSON.')
+    parser.add_argument('--scenario', action='append', metavar='NAME',
+                        help='Only run scenario NAME, can be given multiple times: %s.' %
+                        ', '.join([s[0] for s in scenarios] + ['is-binary']))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two saved results, exits with 1 if a scenario got slower.')
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+    return run_suite(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
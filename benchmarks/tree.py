@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# synthetic directory trees for the benchmarks
+from __future__ import print_function
+
+import os
+import os.path
+import random
+import sys
+
+words = [
+    'alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel',
+    'india', 'juliet', 'kilo', 'lima', 'mike', 'november', 'oscar', 'papa',
+    'quebec', 'romeo', 'sierra', 'tango', 'uniform', 'victor', 'whiskey',
+    'xray', 'yankee', 'zulu', 'def', 'class', 'return', 'import', 'self',
+]
+
+
+def make_line(rnd):
+    return ' '.join(rnd.choice(words) for i in range(rnd.randint(3, 12)))
+
+
+def make_tree(root, dirs=20, files=50, lines=200, needle='needle', needle_rate=0.05, seed=1):
+    # dirs directories each with files text files of lines lines
+    # needle is put on a line in about needle_rate of the files
+    rnd = random.Random(seed)
+    for d in range(dirs):
+        dpath = os.path.join(root, 'dir%03d' % d)
+        if not os.path.isdir(dpath):
+            os.makedirs(dpath)
+        for f in range(files):
+            content = [make_line(rnd) for i in range(lines)]
+            if rnd.random() < needle_rate:
+                content[rnd.randrange(lines)] += ' ' + needle
+            with open(os.path.join(dpath, 'file%03d.txt' % f), 'w') as fp:
+                fp.write('\n'.join(content))
+                fp.write('\n')
+    return root
+
+
+# words of the non-utf-8 files and their encodings
+legacy_texts = [
+    ('latin-1', "le coeur d\u00e9\u00e7u mais l'\u00e2me na\u00efve"),
+    ('cp1252', '\u201cquoted\u201d \u2013 caf\u00e9 \u20ac5'),
+    ('shift_jis', '\u65e5\u672c\u8a9e\u306e\u30c6\u30ad\u30b9\u30c8'),
+]
+
+binary_headers = [b'\x7fELF\x02\x01\x01\x00', b'\x89PNG\r\n\x1a\n', b'\x1f\x8b\x08\x00', b'PK\x03\x04']
+
+
+def write_text(path, rnd, lines, needle, needle_rate):
+    content = [make_line(rnd) for i in range(lines)]
+    if rnd.random() < needle_rate:
+        content[rnd.randrange(lines)] += ' ' + needle
+    # something for -m to print
+    content[rnd.randrange(lines)] = 'class %s%s:' % (rnd.choice(words).title(), rnd.choice(words).title())
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(content))
+        fp.write('\n')
+    return path
+
+
+def write_binary(path, rnd, size):
+    data = rnd.choice(binary_headers) + bytes(rnd.getrandbits(8) for i in range(size))
+    with open(path, 'wb') as fp:
+        fp.write(data)
+    return path
+
+
+def write_minified(path, rnd, size, needle):
+    parts = []
+    length = 0
+    while length < size:
+        part = 'function %s(a,b){return a.%s(b)||"%s"};' % (rnd.choice(words), rnd.choice(words), rnd.choice(words))
+        if rnd.random() < 0.001:
+            part += needle + ';'
+        parts.append(part)
+        length += len(part)
+    with open(path, 'w') as fp:
+        fp.write(''.join(parts))
+    return path
+
+
+def write_large(path, rnd, size, needle):
+    block = '\n'.join(make_line(rnd) for i in range(10000)) + '\n'
+    with open(path, 'w') as fp:
+        written = 0
+        while written < size:
+            fp.write(block)
+            written += len(block)
+        fp.write('the %s is here\n' % needle)
+    return path
+
+
+def write_legacy(path, rnd, lines, needle):
+    encoding, text = rnd.choice(legacy_texts)
+    content = [make_line(rnd) for i in range(lines)]
+    for i in range(0, lines, 5):
+        content[i] += ' ' + text
+    content[rnd.randrange(lines)] += ' ' + needle
+    with open(path, 'wb') as fp:
+        fp.write(('\n'.join(content) + '\n').encode(encoding))
+    return path
+
+
+def make_suite_tree(root, scale=1, needle='needle', seed=1):
+    # a tree like a real checkout, the same for the same scale and seed
+    # src: wide and deep directories of text files mixed with binary files,
+    # minified one line files and a large file
+    # legacy: text files in latin-1, cp1252 and shift_jis
+    # returns counts of what was made
+    rnd = random.Random(seed)
+    made = {'dirs': 0, 'text': 0, 'binary': 0, 'minified': 0, 'large': 0, 'legacy': 0}
+
+    def mkdir(path):
+        os.makedirs(path)
+        made['dirs'] += 1
+        return path
+
+    src = mkdir(os.path.join(root, 'src'))
+    # wide: packages of modules
+    for d in range(20 * scale):
+        dpath = mkdir(os.path.join(src, 'pkg%03d' % d))
+        for f in range(40):
+            if rnd.random() < 0.1:
+                write_binary(os.path.join(dpath, 'data%03d.bin' % f), rnd, rnd.randint(512, 65536))
+                made['binary'] += 1
+            else:
+                write_text(os.path.join(dpath, 'mod%03d.py' % f), rnd, rnd.randint(20, 400), needle, 0.05)
+                made['text'] += 1
+    # one very wide directory
+    dpath = mkdir(os.path.join(src, 'wide'))
+    for f in range(1000 * scale):
+        write_text(os.path.join(dpath, 'item%05d.txt' % f), rnd, rnd.randint(1, 20), needle, 0.01)
+        made['text'] += 1
+    # deep: a chain of nested directories
+    dpath = src
+    for d in range(25):
+        dpath = mkdir(os.path.join(dpath, 'level%02d' % d))
+        for f in range(4 * scale):
+            write_text(os.path.join(dpath, 'deep%02d.txt' % f), rnd, rnd.randint(20, 100), needle, 0.05)
+            made['text'] += 1
+    # minified and large
+    dpath = mkdir(os.path.join(src, 'dist'))
+    for f in range(5 * scale):
+        write_minified(os.path.join(dpath, 'bundle%02d.min.js' % f), rnd, 256 * 1024, needle)
+        made['minified'] += 1
+    write_large(os.path.join(dpath, 'large.log'), rnd, 16 * 1024 * 1024 * scale, needle)
+    made['large'] += 1
+
+    legacy = mkdir(os.path.join(root, 'legacy'))
+    for f in range(50 * scale):
+        write_legacy(os.path.join(legacy, 'old%03d.txt' % f), rnd, rnd.randint(20, 200), needle)
+        made['legacy'] += 1
+    return made
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: tree.py DIRECTORY')
+        return 2
+    make_tree(sys.argv[1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
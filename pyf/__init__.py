@@ -1,3 +1,12 @@
 # -*- coding: utf-8 -*-
 version_info = (0, 9, 0)
 __version__ = ".".join([str(v) for v in version_info])
+
+
+# the library api, pyf.search, pyf.asearch and pyf.Match, imported when
+# first used so running python -m pyf.pyf does not import pyf.pyf twice
+def __getattr__(name):
+    if name in ('search', 'asearch', 'Match'):
+        from . import api
+        return getattr(api, name)
+    raise AttributeError("module 'pyf' has no attribute %r" % name)
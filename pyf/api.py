@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# searching from python, without the command line
+# search yields a Match for each matching line, as pyf -p would print it,
+# found the same way: the same walk, skip patterns, binary check and
+# literal prefilter, with no output, pager, cache or logging
+#
+#   for m in pyf.search(r'TODO\s*(.*)', 'src', filename_pattern='py'):
+#       print(m.path, m.lnum, m.groups[0])
+#
+# asearch is the same for asyncio, the walk and the files are read and
+# searched in an executor:
+#
+#   async for m in pyf.asearch(r'TODO\s*(.*)', 'src', filename_pattern='py'):
+#       print(m.path, m.lnum, m.groups[0])
+
+import asyncio
+import collections
+import itertools
+import os
+import re
+import threading
+
+from .filetype import is_text_data
+from .gitindex import git_paths
+from .options import init_opts, make_parser
+from .pyf import OutputCollector, pyfwalk, search_lines
+
+# the options search takes, the names of the command line options' dests
+search_opts = (
+    'filename_pattern',
+    'files',
+    'git',
+    'gitignore',
+    'ignore',
+    'max_count',
+    'max_results',
+    'no_binary_check',
+    'skip_dirs_pattern',
+    'skip_files_pattern',
+    'sniff_size',
+    'untracked',
+    'walk_threads',
+)
+
+# the line endings universal newlines splits lines at, as bytes
+line_end_bytes_regex = re.compile(b'\r\n|\r|\n')
+
+# bytes read at a time, between checks for cancellation
+read_block_size = 1 << 20
+
+# asearch: the default number of files being searched or searched but
+# not yet consumed
+max_pending_default = 16
+
+
+class Match(object):
+    # a matching line
+    # path: the file, as the walk joined it
+    # lnum: the line number, from 1
+    # offset: the byte offset of the match in the file
+    # span: the (start, end) of the match in line
+    # groups: the match's groups
+    # line: the line without the whitespace around it
+    __slots__ = ('path', 'lnum', 'offset', 'span', 'groups', 'line')
+
+    def __init__(self, path, lnum, offset, span, groups, line):
+        self.path = path
+        self.lnum = lnum
+        self.offset = offset
+        self.span = span
+        self.groups = groups
+        self.line = line
+
+    def __repr__(self):
+        return 'Match(path=%r, lnum=%d, offset=%d, span=%r, groups=%r)' % (
+            self.path, self.lnum, self.offset, self.span, self.groups)
+
+
+class LineOffsets(object):
+    # the byte offsets of the lines of data, asked for in line order
+    def __init__(self, data):
+        self.data = data
+        self.lnum = 1
+        self.start = 0
+        # only look for \r when there is one
+        self.ends = line_end_bytes_regex if b'\r' in data else None
+
+    def end(self, start):
+        # the end of the line starting at start and of its line ending
+        if self.ends:
+            mo = self.ends.search(self.data, start)
+            if mo:
+                return mo.start(), mo.end()
+        else:
+            end = self.data.find(b'\n', start)
+            if end != -1:
+                return end, end + 1
+        return len(self.data), len(self.data)
+
+    def line(self, lnum):
+        # (start, end) of line lnum, without its line ending
+        while self.lnum < lnum:
+            self.start = self.end(self.start)[1]
+            self.lnum += 1
+        return self.start, self.end(self.start)[0]
+
+
+def make_options(pattern, root, opts):
+    if isinstance(pattern, str):
+        pattern = [pattern]
+    for name in opts:
+        if name not in search_opts:
+            raise TypeError('search() got an unexpected keyword argument %r' % name)
+
+    parser = make_parser()
+    options = parser.parse_args([])
+    options.search_patterns = list(pattern)
+    options.start_directory = root
+    options.nopager = True
+    options.no_cache = True
+    for name, value in opts.items():
+        setattr(options, name, value)
+
+    stderr = OutputCollector()
+    options = init_opts(parser, options, stdout=OutputCollector(), stderr=stderr, output=False)
+    if options is None or not options.search_pattern:
+        raise ValueError(''.join(stderr.lines).strip() or 'no search pattern')
+    return options
+
+
+def read_file(path, cancel):
+    # the contents of path, None if cancel is set while reading
+    with open(path, 'rb') as fp:
+        if cancel is None:
+            return fp.read()
+        blocks = []
+        for block in iter(lambda: fp.read(read_block_size), b''):
+            if cancel.is_set():
+                return None
+            blocks.append(block)
+        return b''.join(blocks)
+
+
+def search_file(options, path, onerror, cancel=None):
+    # yield the matches in path, stopping when cancel is set
+    try:
+        data = read_file(path, cancel)
+    except OSError as e:
+        if onerror:
+            onerror(path, e)
+        return
+    if data is None:
+        return
+    if not options.no_binary_check and not is_text_data(data[:options.sniff_size]):
+        return
+    encoding = options.encoding
+    try:
+        text = data.decode(encoding)
+    except UnicodeDecodeError as e:
+        if onerror:
+            onerror(path, e)
+        return
+    # as read with universal newlines, so the line numbers are pyf's
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+
+    offsets = LineOffsets(data)
+    count = 0
+    for lnum, line, mo in search_lines(options, text):
+        start, end = offsets.line(lnum)
+        # the match is in the stripped line, add what was stripped before it
+        raw = data[start:end].decode(encoding)
+        lead = len(raw) - len(raw.lstrip())
+        offset = start + len(raw[:lead].encode(encoding)) + len(line[:mo.start()].encode(encoding))
+        yield Match(path, lnum, offset, mo.span(), mo.groups(), line)
+        count += 1
+        if options.max_count and count >= options.max_count:
+            break
+        if cancel is not None and cancel.is_set():
+            break
+
+
+def search(pattern, root='.', onerror=None, **opts):
+    """
+    Search the files below root for pattern, a regex or a list of them,
+    yielding a Match for each matching line.
+
+    opts are named like pyf's command line options: filename_pattern,
+    files (search these files instead of walking root), git (search the
+    files in the git index instead), gitignore, ignore (ignore case),
+    max_count, max_results, no_binary_check, skip_dirs_pattern,
+    skip_files_pattern, sniff_size, untracked and walk_threads.
+
+    Files and directories below root that cannot be read are skipped,
+    onerror is called with the path and the exception for files that
+    cannot be read or decoded and for root if it cannot be listed, which
+    raises the OSError without onerror. Raises ValueError for bad
+    patterns or options.
+    """
+    # checked now rather than when the first match is asked for
+    options = make_options(pattern, root, opts)
+    return search_options(options, onerror)
+
+
+def search_options(options, onerror):
+    if options.files:
+        paths = iter(options.files)
+    else:
+        paths = walk_paths(options, onerror)
+
+    results = 0
+    for path in paths:
+        for match in search_file(options, path, onerror):
+            yield match
+            results += 1
+            if options.max_results and results >= options.max_results:
+                return
+
+
+def walk_paths(options, onerror):
+    # the start directory must be listed, not skipped like the others
+    try:
+        with os.scandir(options.start_directory):
+            pass
+    except OSError as e:
+        if onerror is None:
+            raise
+        onerror(options.start_directory, e)
+        return
+    # directories below it that cannot be read are skipped like with -A
+    options.suppress_file_access_errors = True
+    if options.git:
+        for path in git_paths(options):
+            yield path
+    else:
+        for root, dirs, files in pyfwalk(options, options.start_directory):
+            for f in files:
+                yield os.path.join(root, f)
+    # other errors listing a directory stop the walk
+    if options.exit_status == 'error':
+        raise OSError(''.join(options.stderr.lines).strip())
+
+
+def search_file_list(options, path, onerror, cancel):
+    # the matches in a file, run in the executor
+    if cancel.is_set():
+        return []
+    return list(search_file(options, path, onerror, cancel))
+
+
+def next_paths(paths, n, lock):
+    # up to n more paths to search, run in the executor as the walk lists directories
+    with lock:
+        return list(itertools.islice(paths, n))
+
+
+def close_paths(paths, lock):
+    # stop the walk, after the paths being listed if any
+    with lock:
+        paths.close()
+
+
+def asearch(pattern, root='.', onerror=None, executor=None, max_pending=max_pending_default, **opts):
+    """
+    Like search, an asynchronous iterator of the Matches for async for.
+
+    The walk and the files are read and searched in executor, the event
+    loop's default executor if None, so many searches can share it. Up to
+    max_pending files are searched ahead of the consumer, no more are
+    started until it takes their matches. When the search is cancelled or
+    closed the files being read and searched are stopped. onerror is called
+    in the executor's threads.
+    """
+    options = make_options(pattern, root, opts)
+    if max_pending < 1:
+        raise ValueError('max_pending must be at least 1: %d' % max_pending)
+    return asearch_options(options, onerror, executor, max_pending)
+
+
+async def asearch_options(options, onerror, executor, max_pending):
+    loop = asyncio.get_running_loop()
+    cancel = threading.Event()
+    # the walk runs in the executor's threads, one call at a time
+    lock = threading.Lock()
+    if options.files:
+        paths = iter(options.files)
+    else:
+        paths = walk_paths(options, onerror)
+
+    # the files being searched, in walk order
+    pending = collections.deque()
+    walking = True
+    results = 0
+    try:
+        while True:
+            if walking and len(pending) < max_pending:
+                batch = await loop.run_in_executor(executor, next_paths, paths, max_pending - len(pending), lock)
+                if not batch:
+                    walking = False
+                for path in batch:
+                    pending.append(loop.run_in_executor(executor, search_file_list, options, path, onerror, cancel))
+            if not pending:
+                break
+            for match in await pending.popleft():
+                yield match
+                results += 1
+                if options.max_results and results >= options.max_results:
+                    return
+    finally:
+        # stop the reads and searches in progress, drop those not started
+        cancel.set()
+        for future in pending:
+            future.cancel()
+        # and the walk, which closes its directories and threads
+        if hasattr(paths, 'close'):
+            await loop.run_in_executor(executor, close_paths, paths, lock)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# a cache of what pyf found out about files in earlier runs: whether a
+# file is binary, so its binary check need not read it again
+# keyed by the stat of the open file, (st_dev, st_ino, st_size, st_mtime_ns,
+# st_ctime_ns), so a changed file is looked at again, the ctime changing
+# even when the mtime is set back
+
+import collections
+import marshal
+import os
+import os.path
+import tempfile
+
+from .logger import debug
+
+cache_version = 3
+
+# the default maximum number of entries
+cache_size_default = 100000
+
+
+def cache_file_default():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pyf', 'metadata')
+
+
+class MetadataCache(object):
+    def __init__(self, fname, max_entries=cache_size_default, settings=None):
+        self.fname = fname
+        self.max_entries = max_entries
+        # entries written with other settings, e.g. the binary check block size, are dropped
+        self.settings = settings
+        # key -> binary, least recently used first
+        self.entries = collections.OrderedDict()
+        # entries added, only kept in worker processes to pass them back
+        # None elsewhere, e.g. in a server they would pile up
+        self.added = None
+        self.dirty = False
+
+    @staticmethod
+    def key(st):
+        # the key for a file with stat st
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def get(self, key):
+        # whether the file is binary, None if not known
+        binary = self.entries.get(key)
+        if binary is not None:
+            self.entries.move_to_end(key)
+        return binary
+
+    def put(self, key, binary):
+        self.update([(key, binary)])
+        if self.added is not None:
+            self.added.append((key, binary))
+
+    def update(self, entries):
+        for key, entry in entries:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if entries:
+            self.dirty = True
+
+    def load(self):
+        try:
+            # loads on the whole file, load reads a file object in small pieces
+            with open(self.fname, 'rb') as fp:
+                data = marshal.loads(fp.read())
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            debug('MetadataCache.load: exception loading %s: %s', self.fname, e)
+            return
+        if data.get('version') != cache_version or data.get('settings') != self.settings:
+            debug('MetadataCache.load: ignoring %s', self.fname)
+            return
+        self.update(data['entries'])
+        self.dirty = False
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {
+            'version': cache_version,
+            'settings': self.settings,
+            'entries': list(self.entries.items()),
+        }
+        # write a temporary file and rename it so a reader never sees half a cache
+        dname = os.path.dirname(os.path.abspath(self.fname))
+        try:
+            os.makedirs(dname)
+        except OSError:
+            pass
+        fd, tname = tempfile.mkstemp(prefix='.metadata-', dir=dname)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(marshal.dumps(data))
+            os.replace(tname, self.fname)
+        except Exception:
+            os.unlink(tname)
+            raise
+        self.dirty = False
@@ -1,122 +1,102 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import codecs
+import re
 import sys
 
 from .logger import init_logging, deinit_logging, error
 
+# the default number of bytes read to decide if a file is text
+sniff_size_default = 1024
+
+# tab, newline, form feed, carriage return and the printable characters
+ascii_text_bytes = bytes([9, 10, 12, 13]) + bytes(range(32, 127))
+ascii_bytes = bytes(range(128))
+
+# runs of ascii text and utf-8 sequences of 2 to 6 bytes, as first
+# defined utf-8 allowed 5 and 6 byte sequences
+# the lead bytes differ so at most one alternative matches at a position
+utf8_text_regex = re.compile(
+    rb'[\t\n\x0c\r\x20-\x7e]+'
+    rb'|[\xc0-\xdf][\x80-\xbf]'
+    rb'|[\xe0-\xef][\x80-\xbf]{2}'
+    rb'|[\xf0-\xf7][\x80-\xbf]{3}'
+    rb'|[\xf8-\xfb][\x80-\xbf]{4}'
+    rb'|[\xfc-\xfd][\x80-\xbf]{5}'
+)
+
+binary_signatures = (
+    b'\x42\x5a\x68',                  # bzip2
+    b'\x1f\x8b\x08',                  # gzip
+    b'\x1f\x9d',                      # tar.z lzw
+    b'\x1f\xa0',                      # tar.z lzh
+    b'\x50\x4b\x03\x04',              # zip
+    b'\x50\x4b\x05\x06',              # pkzip empty
+    b'\x50\x4b\x07\x08',              # pkzip multi
+    b'\x37\x7a\xbc\xaf\x27\x1c',      # 7zip
+)
+
 
 def is_ascii(o):
-    tab_feeds = (9, 10, 12, 13)
-    return (o > 31 and o < 127) or (o in tab_feeds)
+    return (o > 31 and o < 127) or (o in (9, 10, 12, 13))
+
+
+def count_text_ascii(data):
+    # the number of ascii text bytes in data
+    return len(data) - len(data.translate(None, ascii_text_bytes))
 
 
 def is_text_ascii(data, confidence=0.7):
-    data_length = len(data)
-    out = []
-    for d in data:
-        if is_ascii(d):
-            out.append(d)
-    ascii_confidence = float(len(out)) / data_length
-    if ascii_confidence >= confidence:
-        return True
-    return False
+    return float(count_text_ascii(data)) / len(data) >= confidence
+
+
+def count_text_utf8(data):
+    # the number of bytes in data that are ascii text or in a utf-8 sequence
+    # valid utf-8, the usual case, is checked by decoding it in one go
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        decoder.decode(data)
+    except UnicodeDecodeError:
+        return sum(map(len, utf8_text_regex.findall(data)))
+    # all but the ascii control characters and a character cut off at the end
+    non_ascii = len(data.translate(None, ascii_bytes))
+    return count_text_ascii(data) + non_ascii - len(decoder.getstate()[0])
 
 
 # https://en.wikipedia.org/wiki/UTF-8
 def is_text_utf8(data, confidence=0.7):
-    data_length = len(data)
-    out = []
-    i = 0
-    while i < data_length:
-        d = data[i]
-        if is_ascii(d):
-            out.append(d)
-        # could be utf-8
-        elif d & 0xc0 == 0xc0:
-            if (i + 1 < data_length) and (d & 0xe0 == 0xc0) and (data[i + 1] & 0xc0 == 0x80):
-                out.append(data[i])
-                out.append(data[i + 1])
-                i += 1
-            elif (i + 2 < data_length) and (d & 0xf0 == 0xe0) and (data[i + 1] & 0xc0 == 0x80) and (data[i + 2] & 0xc0 == 0x80):
-                out.append(data[i])
-                out.append(data[i + 1])
-                out.append(data[i + 2])
-                i += 2
-            elif (i + 3 < data_length) and (d & 0xf8 == 0xf0) and (data[i + 1] & 0xc0 == 0x80) and (data[i + 2] & 0xc0 == 0x80) and (data[i + 3] & 0xc0 == 0x80):
-                out.append(data[i])
-                out.append(data[i + 1])
-                out.append(data[i + 2])
-                out.append(data[i + 3])
-                i += 3
-            elif (i + 4 < data_length) and (d & 0xfc == 0xf8) and (data[i + 1] & 0xc0 == 0x80) and (data[i + 2] & 0xc0 == 0x80) and (data[i + 3] & 0xc0 == 0x80) and (data[i + 4] & 0xc0 == 0x80):
-                out.append(data[i])
-                out.append(data[i + 1])
-                out.append(data[i + 2])
-                out.append(data[i + 3])
-                out.append(data[i + 4])
-                i += 4
-            elif (i + 5 < data_length) and (d & 0xfe == 0xfc) and (data[i + 1] & 0xc0 == 0x80) and (data[i + 2] & 0xc0 == 0x80) and (data[i + 3] & 0xc0 == 0x80) and (data[i + 4] & 0xc0 == 0x80) and (data[i + 5] & 0xc0 == 0x80):
-                out.append(data[i])
-                out.append(data[i + 1])
-                out.append(data[i + 2])
-                out.append(data[i + 3])
-                out.append(data[i + 4])
-                out.append(data[i + 5])
-                i += 5
-        i += 1
-    utf8_confidence = float(len(out)) / data_length
-    if utf8_confidence >= confidence:
-        return True
-    return False
+    return float(count_text_utf8(data)) / len(data) >= confidence
 
 
 def has_binary_signature(data):
-    sigs = {
-        'bzip2': bytearray([0x42, 0x5A, 0x68]),
-        'gzip': bytearray([0x1F, 0x8B, 0x08]),
-        'tar.z lzw': bytearray([0x1F, 0x9D]),
-        'tar.z lzh': bytearray([0x1F, 0xA0]),
-        'zip': bytearray([0x50, 0x4B, 0x03, 0x04]),
-        'pkzip empty': bytearray([0x50, 0x4B, 0x05, 0x06]),
-        'pkzip multi': bytearray([0x50, 0x4B, 0x07, 0x08]),
-        '7zip': bytearray([0x37, 0x7A, 0xBC, 0xAF, 0x27, 0x1C]),
-    }
-    for k in sigs.keys():
-        sig = sigs[k]
-        length = len(sig)
-        if data[:length] == sig:
-            return True
-    return False
-
-
-def is_text(file, block=64, confidence=0.7):
+    return data.startswith(binary_signatures)
+
+
+def is_text_data(data, confidence=0.7):
+    # True if the first bytes of a file look like text
+    if not data:
+        return False
+    # ascii check, then utf-8 check
+    if not is_text_ascii(data, confidence=confidence):
+        if not is_text_utf8(data, confidence=confidence):
+            return False
+    # binary signature check
+    return not has_binary_signature(data)
+
+
+def is_text(file, block=sniff_size_default, confidence=0.7):
     file_is_text = False
     try:
         with open(file, 'rb') as fp:
             data = fp.read(block)
-        read_length = len(data)
-        if read_length == 0:
-            return False
-        data = bytearray(data)
-
-        # ascii check
-        if is_text_ascii(data, confidence=confidence):
-            file_is_text = True
-
-        # utf-8 check
-        elif is_text_utf8(data, confidence=confidence):
-            file_is_text = True
-
-        # binary signature check
-        if file_is_text:
-            file_is_text = not has_binary_signature(data)
+        file_is_text = is_text_data(data, confidence=confidence)
     except Exception as e:
-        error('is_text: exception for file %s: %s' % (file, e), exc_info=True)
+        error('is_text: exception for file %s: %s', file, e, exc_info=True)
     return file_is_text
 
 
-def is_binary(file, block=64, confidence=0.7):
+def is_binary(file, block=sniff_size_default, confidence=0.7):
     return not is_text(file, block=block, confidence=confidence)
 
 
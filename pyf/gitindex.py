@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# --git: the files to search are those in the git index, .git/index,
+# instead of those a walk of the tree finds
+# the index is read with one read and its entries parsed here, git is not run
+# the index lists the tracked files sorted by path, each with its mode and
+# flags, in format version 2, 3 or 4, see git's
+# Documentation/gitformat-index.txt
+# with --untracked the tree is also walked, as with --gitignore, for the
+# files not in the index
+
+import os
+import os.path
+import struct
+import time
+
+from .ignore import repository_top
+from .pyf import pyfwalk, writerr
+
+index_header = struct.Struct('>4sLL')
+
+# the fixed part of an entry: 40 bytes of stat data, the object name and the flags
+entry_size = 62
+mode_struct = struct.Struct('>L')
+mode_offset = 24
+flags_struct = struct.Struct('>H')
+flags_offset = 60
+
+# flags
+flag_extended = 0x4000
+flag_name_mask = 0xfff
+# extended flags, version 3 and later
+flag_skip_worktree = 0x4000
+
+# the modes of the entries that are files in the work tree
+# not gitlinks (submodules) or the directories of a sparse index
+mode_type_mask = 0o170000
+mode_symlink = 0o120000
+file_modes = (0o100000, mode_symlink)
+
+
+def git_dir(top):
+    # the git directory of the work tree top, .git or where a .git file points
+    path = os.path.join(top, '.git')
+    if os.path.isfile(path):
+        with open(path) as fp:
+            line = fp.readline().strip()
+        if line.startswith('gitdir:'):
+            return os.path.join(top, line[len('gitdir:'):].strip())
+    return path
+
+
+def read_index(fname):
+    # the paths of the files in the index, relative to the top of the
+    # work tree with / between the directories, in the index's order,
+    # and the set of those that are symlinks
+    with open(fname, 'rb') as fp:
+        data = fp.read()
+
+    signature, version, count = index_header.unpack_from(data, 0)
+    if signature != b'DIRC':
+        raise ValueError('not a git index')
+    if version not in (2, 3, 4):
+        raise ValueError('unsupported git index version %d' % version)
+
+    names = []
+    links = set()
+    name = b''
+    i = index_header.size
+    for n in range(count):
+        mode = mode_struct.unpack_from(data, i + mode_offset)[0]
+        flags = flags_struct.unpack_from(data, i + flags_offset)[0]
+        start = i + entry_size
+        skip = False
+        if flags & flag_extended:
+            skip = flags_struct.unpack_from(data, start)[0] & flag_skip_worktree
+            start += 2
+        if version == 4:
+            # the name is the end of the previous one cut short by a number
+            # of bytes, then the rest up to a nul
+            c = data[start]
+            start += 1
+            cut = c & 0x7f
+            while c & 0x80:
+                c = data[start]
+                start += 1
+                cut = ((cut + 1) << 7) | (c & 0x7f)
+            end = data.index(b'\0', start)
+            name = name[:len(name) - cut] + data[start:end]
+            i = end + 1
+        else:
+            length = flags & flag_name_mask
+            if length == flag_name_mask:
+                end = data.index(b'\0', start)
+            else:
+                end = start + length
+            name = data[start:end]
+            # padded with nuls to a multiple of 8 bytes
+            i += (end - i + 8) & ~7
+        # not in the work tree, with sparse checkouts
+        if skip or (mode & mode_type_mask) not in file_modes:
+            continue
+        # a conflicted file has an entry for each side
+        if names and names[-1] == name:
+            continue
+        names.append(name)
+        if mode & mode_type_mask == mode_symlink:
+            links.add(name)
+    return [os.fsdecode(name) for name in names], set(os.fsdecode(name) for name in links)
+
+
+def git_names(options):
+    # the top of the work tree, the paths in its index and the symlinks
+    # among them, None on errors
+    start = os.path.abspath(options.start_directory)
+    top = repository_top(start)
+    if top is None:
+        writerr(options, 'Error: not in a git repository: %s' % options.start_directory)
+        return None, None, None
+    index_file = os.path.join(git_dir(top), 'index')
+    try:
+        names, links = read_index(index_file)
+    except FileNotFoundError:
+        # a repository with nothing added yet
+        names, links = [], set()
+    except Exception as e:
+        writerr(options, 'Error reading git index %s' % index_file, exception=e)
+        return None, None, None
+    return top, names, links
+
+
+def git_paths(options):
+    # the files in the index below the start directory and, with
+    # --untracked, those not in it that are not ignored, as a walk from
+    # the start directory would join them
+    stats = options.stats
+    start = time.perf_counter()
+    top, names, links = git_names(options)
+    stats.time_walk += time.perf_counter() - start
+    if names is None:
+        return
+
+    # the index's paths start with the start directory's, then the part
+    # that is joined to the start directory
+    prefix = os.path.relpath(os.path.abspath(options.start_directory), top).replace(os.sep, '/')
+    prefix = '' if prefix == '.' else prefix + '/'
+    strip = len(prefix)
+    # whether a directory, as in the index, is skipped by --skip-dirs-pattern
+    skipped_dirs = {'': False}
+
+    for name in names:
+        if strip and not name.startswith(prefix):
+            continue
+        rel = name[strip:]
+        d, sep, f = rel.rpartition('/')
+        skip = skipped_dirs.get(d)
+        if skip is None:
+            skip = options.skip_dirs_pattern and any(options.skip_dirs_pattern_regex.search(part) for part in d.split('/'))
+            skipped_dirs[d] = skip
+            if skip:
+                stats.skipped_dirs_pattern += 1
+        if skip:
+            continue
+        if options.skip_files_pattern and options.skip_files_pattern_regex.search(f):
+            stats.skipped_files_pattern += 1
+            continue
+        if not options.filename_pattern_regex.search(f):
+            stats.skipped_filename_pattern += 1
+            continue
+        path = os.path.join(options.start_directory, rel if os.sep == '/' else rel.replace('/', os.sep))
+        # the walk lists a symlink to a directory as a directory
+        if name in links and os.path.isdir(path):
+            continue
+        stats.files += 1
+        yield path
+
+    if options.untracked:
+        tracked = set(names)
+        gitignore = options.gitignore
+        options.gitignore = True
+        try:
+            for root, dirs, files in pyfwalk(options, options.start_directory):
+                root_rel = root[len(os.path.join(options.start_directory, '')):].replace(os.sep, '/')
+                root_rel = prefix + root_rel + '/' if root_rel else prefix
+                for f in files:
+                    if root_rel + f in tracked:
+                        # counted above
+                        stats.files -= 1
+                    else:
+                        yield os.path.join(root, f)
+        finally:
+            options.gitignore = gitignore
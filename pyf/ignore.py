@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# --gitignore: skip what .gitignore and .ignore files ignore, as git would
+# each file's rules are compiled into one regex, so a path no rule matches,
+# most of them, costs one regex match per ignore file that applies
+# the ignore files that apply to a directory's entries, its ignores, are
+# those of the directory and of the directories above it, up to the
+# repository's top or the start directory, the deepest first to decide
+# the walk checks each entry as it lists a directory, so ignored
+# directories are never listed
+
+import os
+import os.path
+import re
+
+from .logger import debug
+
+# the ignore files read in each directory, a later one's rules win
+ignore_file_names = ('.gitignore', '.ignore')
+
+# a repository's ignore file that is not committed
+exclude_file_name = os.path.join('.git', 'info', 'exclude')
+
+
+def glob_regex(glob):
+    # a gitignore glob, without its leading or trailing /, as a regex
+    # for the path relative to the ignore file's directory
+    out = []
+    i = 0
+    n = len(glob)
+    while i < n:
+        c = glob[i]
+        if c == '*':
+            if glob.startswith('**/', i) and (i == 0 or glob[i - 1] == '/'):
+                # any number of directories
+                out.append('(?:.*/)?')
+                i += 3
+                continue
+            if glob.startswith('**', i) and i + 2 == n and i > 0 and glob[i - 1] == '/':
+                # everything inside
+                out.append('.*')
+                i += 2
+                continue
+            out.append('[^/]*')
+            while i < n and glob[i] == '*':
+                i += 1
+            continue
+        if c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and glob[j] in '!^':
+                j += 1
+            if j < n and glob[j] == ']':
+                j += 1
+            while j < n and glob[j] != ']':
+                j += 1
+            if j >= n:
+                out.append(re.escape(c))
+            else:
+                chars = glob[i + 1:j]
+                negate = chars[:1] in ('!', '^')
+                if negate:
+                    chars = chars[1:]
+                chars = chars.replace('\\', '\\\\')
+                out.append('[%s%s]' % ('^/' if negate else '', chars))
+                i = j
+        elif c == '\\' and i + 1 < n:
+            i += 1
+            out.append(re.escape(glob[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
+
+
+def parse_rule(line):
+    # (regex, negate, dir_only) for a line of an ignore file, None if it has no rule
+    line = line.rstrip('\r\n')
+    if not line or line.startswith('#'):
+        return None
+    # trailing spaces unless escaped
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    # a / other than at the end ties the rule to the ignore file's directory
+    anchored = '/' in line
+    regex = glob_regex(line.lstrip('/'))
+    if not anchored and not regex.startswith('(?:.*/)?'):
+        regex = '(?:.*/)?' + regex
+    return regex, negate, dir_only
+
+
+class IgnoreFile(object):
+    def __init__(self, rules):
+        # the rules, in the file's order, for directories and for files
+        self.dir_rules = [(re.compile(r + r'\Z'), negate) for r, negate, dir_only in rules]
+        self.file_rules = [(re.compile(r + r'\Z'), negate) for r, negate, dir_only in rules if not dir_only]
+        self.dir_regex = self.combine([r for r, negate, dir_only in rules])
+        self.file_regex = self.combine([r for r, negate, dir_only in rules if not dir_only])
+        self.negations = any(negate for r, negate, dir_only in rules)
+
+    @staticmethod
+    def combine(regexes):
+        # one regex matching where any of regexes does
+        if not regexes:
+            return None
+        return re.compile('|'.join('(?:%s)\\Z' % r for r in regexes))
+
+    def match(self, rel, is_dir):
+        # True if rel is ignored, False if re-included, None if no rule matches it
+        regex = self.dir_regex if is_dir else self.file_regex
+        if regex is None or not regex.match(rel):
+            return None
+        if not self.negations:
+            return True
+        # the last rule matching decides
+        for rule, negate in reversed(self.dir_rules if is_dir else self.file_rules):
+            if rule.match(rel):
+                return not negate
+        return None
+
+
+def read_ignore_file(path):
+    # the IgnoreFile of path, None if it has no rules or cannot be read
+    try:
+        with open(path, encoding='utf-8', errors='surrogateescape') as fp:
+            rules = [rule for rule in (parse_rule(line) for line in fp) if rule]
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        debug('read_ignore_file: cannot read %s: %s', path, e)
+        return None
+    if not rules:
+        return None
+    return IgnoreFile(rules)
+
+
+def dir_ignores(path, names, ignores, strip=None, prefix=''):
+    # the ignores of directory path's entries: ignores, those of the
+    # directories above it, and the ignore files in path
+    # names: the names in path, None to look for each ignore file
+    # the rules see prefix plus what follows the first strip characters of
+    # an entry's path, by default the part after path
+    if strip is None:
+        strip = len(os.path.join(path, ''))
+    if names is None:
+        files = list(ignore_file_names)
+    else:
+        files = [name for name in ignore_file_names if name in names]
+    if names is None or '.git' in names:
+        # the repository's own, below its ignore files
+        files.insert(0, exclude_file_name)
+    for name in files:
+        ignore = read_ignore_file(os.path.join(path, name))
+        if ignore:
+            ignores = ignores + ((ignore, strip, prefix),)
+    return ignores
+
+
+def repository_top(path):
+    # the directory above or at absolute path with a .git, None if none has
+    while not os.path.exists(os.path.join(path, '.git')):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    return path
+
+
+def top_ignores(options, path):
+    # the ignores of the directories above path, for path's entries, from
+    # the repository's top, or from the start directory outside a repository
+    path_abs = os.path.abspath(path)
+    top = repository_top(path_abs)
+    if top is None:
+        start = os.path.abspath(options.start_directory)
+        top = start if path_abs.startswith(os.path.join(start, '')) else path_abs
+    if top == path_abs:
+        return ()
+    parts = os.path.relpath(path_abs, top).split(os.sep)
+    strip = len(os.path.join(path, ''))
+    ignores = ()
+    d = top
+    for i in range(len(parts)):
+        # the path from d to path
+        ignores = dir_ignores(d, None, ignores, strip, '/'.join(parts[i:]) + '/')
+        d = os.path.join(d, parts[i])
+    return ignores
+
+
+def is_ignored(ignores, path, is_dir):
+    # True if the entry path of a directory with ignores is ignored
+    for ignore, strip, prefix in reversed(ignores):
+        ignored = ignore.match(prefix + path[strip:], is_dir)
+        if ignored is not None:
+            return ignored
+    return False
+
+
+def path_ignored(options, path, is_dir):
+    # True if path is ignored, reading the ignore files above it
+    parent = os.path.dirname(path) or os.curdir
+    ignores = dir_ignores(parent, None, top_ignores(options, parent))
+    return is_ignored(ignores, os.path.join(parent, os.path.basename(path)), is_dir)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+# a trigram index of the files in a tree
+# for each three bytes the files containing them, so a search can skip the
+# files that cannot contain the literal strings of the search pattern
+# files are keyed by their path and (size, mtime) so an update only reads
+# the files that changed
+
+import codecs
+import marshal
+import os
+import os.path
+import re
+import tempfile
+
+from .filetype import is_text_data
+from .logger import debug, error
+from .pattern import required_literals
+
+index_version = 1
+
+# the default index file, in the start directory
+index_file_default = '.pyf-index'
+
+# all the overlapping three bytes
+trigram_regex = re.compile(b'(?=(...))', re.DOTALL)
+
+# the text searched has universal newlines, a file's lines may end in \r\n
+# or \r, so the parts of a literal between line breaks are looked up
+line_break_regex = re.compile('[\r\n]+')
+
+# findall makes a bytes object for each byte it looks at, so the trigrams
+# are found this many bytes at a time, and files are read in blocks
+trigram_chunk_size = 64 * 1024
+read_size = 1024 * 1024
+
+
+def trigrams(data, found=None):
+    # the set of the trigrams of data, added to found if given
+    found = set() if found is None else found
+    for i in range(0, len(data) - 2, trigram_chunk_size):
+        # the two bytes after the chunk for its last trigrams
+        found.update(trigram_regex.findall(data, i, i + trigram_chunk_size + 2))
+    return found
+
+
+class Index(object):
+    def __init__(self, root):
+        # paths are stored relative to root
+        self.root = root
+        # path -> (size, mtime_ns, id)
+        self.files = {}
+        # trigram -> set of file ids
+        self.postings = {}
+        # ids of files not read: binary, unreadable or too large
+        self.binary = set()
+        self.unindexed = set()
+        self.next_id = 0
+        # used while updating
+        self.seen = set()
+        self.removed = set()
+        # the ids of the files that might match, None if any might
+        self.candidates = None
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def load(self, fname):
+        with open(fname, 'rb') as fp:
+            data = marshal.load(fp)
+        if data.get('version') != index_version:
+            raise ValueError('index version %s is not %s' % (data.get('version'), index_version))
+        self.files = data['files']
+        self.postings = data['postings']
+        self.binary = data['binary']
+        self.unindexed = data['unindexed']
+        self.next_id = data['next_id']
+
+    def save(self, fname):
+        data = {
+            'version': index_version,
+            'files': self.files,
+            'postings': self.postings,
+            'binary': self.binary,
+            'unindexed': self.unindexed,
+            'next_id': self.next_id,
+        }
+        # write a temporary file and rename it so a reader never sees half an index
+        dname = os.path.dirname(os.path.abspath(fname))
+        fd, tname = tempfile.mkstemp(prefix='.pyf-index-', dir=dname)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                marshal.dump(data, fp)
+            os.replace(tname, fname)
+        except Exception:
+            os.unlink(tname)
+            raise
+
+    def add(self, options, path):
+        # add or update the file at path, only read if its stat changed
+        rel = self.relpath(path)
+        self.seen.add(rel)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            debug('Index.add: cannot stat %s: %s', path, e)
+            return
+        entry = self.files.get(rel)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return
+        if entry:
+            self.removed.add(entry[2])
+
+        fid = self.next_id
+        self.next_id += 1
+        self.files[rel] = (st.st_size, st.st_mtime_ns, fid)
+        debug('Index.add: indexing %s', path)
+
+        if st.st_size > options.large_file_size:
+            self.unindexed.add(fid)
+            return
+        try:
+            with open(path, 'rb') as fp:
+                # the binary check and the read on one open file
+                data = fp.read(options.sniff_size)
+                if not options.no_binary_check and not is_text_data(data):
+                    self.binary.add(fid)
+                    return
+                found = set()
+                # with the last two bytes of the block before
+                tail = b''
+                while data:
+                    data = tail + data
+                    trigrams(data, found)
+                    tail = data[-2:]
+                    data = fp.read(read_size)
+        except Exception as e:
+            error('Index.add: exception reading %s: %s', path, e)
+            self.unindexed.add(fid)
+            return
+        postings = self.postings
+        for t in found:
+            ids = postings.get(t)
+            if ids is None:
+                postings[t] = set([fid])
+            else:
+                ids.add(fid)
+
+    def finish(self):
+        # drop the files not seen and the old versions of updated files
+        for rel in list(self.files):
+            if rel not in self.seen:
+                self.removed.add(self.files.pop(rel)[2])
+        removed = self.removed
+        if removed:
+            for t in list(self.postings):
+                ids = self.postings[t]
+                ids -= removed
+                if not ids:
+                    del self.postings[t]
+            self.binary -= removed
+            self.unindexed -= removed
+        self.seen = set()
+        self.removed = set()
+
+    def query(self, options):
+        # work out the files that might match the search pattern
+        # each pattern's literals must all be in a file for it to match
+        # any of the patterns
+        self.candidates = None
+        if options.invert or options.ignore or codecs.lookup(options.encoding).name != 'utf-8':
+            return
+        candidates = set()
+        for regex in options.search_regexes:
+            found = None
+            for literal in required_literals(regex):
+                for part in line_break_regex.split(literal):
+                    for t in trigrams(part.encode('utf-8')):
+                        ids = self.postings.get(t, set())
+                        if found is None:
+                            found = set(ids)
+                        else:
+                            found &= ids
+            if found is None:
+                # no literal to look up, any file might match
+                return
+            candidates |= found
+        candidates |= self.unindexed
+        if options.no_binary_check:
+            candidates |= self.binary
+        self.candidates = candidates
+        debug('Index.query: %d candidates of %d files', len(candidates), len(self.files))
+
+    def skip(self, path):
+        # True if the file at path has not changed and cannot match
+        if self.candidates is None:
+            return False
+        entry = self.files.get(self.relpath(path))
+        if not entry or entry[2] in self.candidates:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return entry[0] == st.st_size and entry[1] == st.st_mtime_ns
@@ -2,17 +2,22 @@
 from __future__ import print_function
 
 import datetime
+import json
 import logging
 import logging.handlers
 import os
+import time
 
 # logging
+# the message arguments are only formatted when logging is on, e.g.
+# debug('skipping file: %s', path), hot paths also check options.debug
+# before calling at all
 
-# the logger
+# the logger, None unless logging is on
 glogger = None
 
-# init default root object logging
-logging.basicConfig(level=logging.DEBUG, format='%(name)s %(levelname)s %(message)s', filename=os.devnull)
+# the --trace file descriptor
+trace_fd = None
 
 
 class FileFormatter(logging.Formatter):
@@ -53,6 +58,8 @@ def init_logging(options):
     global glogger
 
     glogger = logging.getLogger('pyf')
+    glogger.setLevel(logging.DEBUG)
+    glogger.propagate = False
 
     # console
     try:
@@ -73,11 +80,41 @@ def init_logging(options):
 
 
 def deinit_logging():
+    close_trace()
     logging.shutdown()
 
 
+def open_trace(fname):
+    # appending so the worker processes, which share the descriptor,
+    # do not overwrite each other's lines
+    global trace_fd
+    trace_fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o666)
+
+
+def close_trace():
+    global trace_fd
+    if trace_fd is not None:
+        os.close(trace_fd)
+        trace_fd = None
+
+
+def trace(event, path, **fields):
+    # one json object per line, written at once so lines of
+    # different processes are not mixed
+    if trace_fd is None:
+        return
+    fields['event'] = event
+    fields['path'] = path
+    fields['pid'] = os.getpid()
+    fields['time'] = round(time.time(), 6)
+    try:
+        os.write(trace_fd, (json.dumps(fields, sort_keys=True) + '\n').encode('utf-8'))
+    except Exception:
+        pass
+
+
 # catches potential logging errors
-def do_log(msg, which, **kwargs):
+def do_log(msg, args, which, **kwargs):
     global glogger
 
     if not glogger:
@@ -86,7 +123,9 @@ def do_log(msg, which, **kwargs):
     try:
         func = getattr(glogger, which, None)
         if func and callable(func):
-            func(msg.encode('unicode_escape', errors='replace'), **kwargs)
+            if args:
+                msg = msg % args
+            func(msg.encode('unicode_escape', errors='replace').decode('ascii'), **kwargs)
         else:
             pass
             #print('do_log: no function: %s' % which)
@@ -96,26 +135,26 @@ def do_log(msg, which, **kwargs):
 #        print('do_log: exception: %s' % e)
 
 
-def debug(msg, **kwargs):
-    do_log(msg, 'debug', **kwargs)
+def debug(msg, *args, **kwargs):
+    do_log(msg, args, 'debug', **kwargs)
 
 
-def info(msg, **kwargs):
-    do_log(msg, 'info', **kwargs)
+def info(msg, *args, **kwargs):
+    do_log(msg, args, 'info', **kwargs)
 
 
-def warning(msg, **kwargs):
-    do_log(msg, 'warning', **kwargs)
+def warning(msg, *args, **kwargs):
+    do_log(msg, args, 'warning', **kwargs)
 
 
-def error(msg, **kwargs):
-    do_log(msg, 'error', **kwargs)
+def error(msg, *args, **kwargs):
+    do_log(msg, args, 'error', **kwargs)
 
 
-def critical(msg, **kwargs):
-    do_log(msg, 'critical', **kwargs)
+def critical(msg, *args, **kwargs):
+    do_log(msg, args, 'critical', **kwargs)
 
 
-def exception(msg, **kwargs):
-    do_log(msg, 'exception', **kwargs)
+def exception(msg, *args, **kwargs):
+    do_log(msg, args, 'exception', **kwargs)
 
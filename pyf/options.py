@@ -2,6 +2,9 @@
 from __future__ import print_function
 
 import argparse
+import codecs
+import locale
+import multiprocessing
 import os
 import re
 import signal
@@ -10,7 +13,13 @@ import sys
 
 from . import __version__
 
+from .cache import cache_file_default, cache_size_default
+from .filetype import sniff_size_default
+from .index import index_file_default
+from .output import OutputBuffer
+from .pattern import PatternSet, bytes_regex, combine_patterns, is_line_safe, required_literals
 from .pyf import writerr
+from .stats import Stats
 
 # match all file names
 filename_pattern_default = r'.+'
@@ -64,9 +73,26 @@ Patterns are Python regular expressions.
 It's pronounced "pif".'''
 no_pattern_error_message = 'Error: no pattern given. At least search-pattern and/or filename-pattern needed.'
 regex_compile_error_message = 'Exception compiling %(type)s regex: \'%(regex)s\''
-
-
-def parse_opts(argv, stdin=None, stdout=None, stderr=None):
+dry_run_error_message = 'Error: --dry-run needs --replace.'
+jobs_error_message = 'Error: invalid number of jobs: %d'
+max_count_error_message = 'Error: invalid max count: %d'
+max_results_error_message = 'Error: invalid max results: %d'
+max_procs_error_message = 'Error: invalid number of processes: %d'
+patterns_file_error_message = 'Error reading patterns file: %s'
+cache_size_error_message = 'Error: invalid cache size: %d'
+replace_invert_error_message = 'Error: --replace cannot be used with -v.'
+replace_patterns_error_message = 'Error: --replace needs exactly one search pattern.'
+untracked_error_message = 'Error: --untracked needs --git.'
+server_memory_error_message = 'Error: invalid server memory: %d'
+sniff_size_error_message = 'Error: invalid sniff size: %d'
+walk_threads_error_message = 'Error: invalid number of walk threads: %d'
+watch_error_message = 'Error: --watch cannot be used with %s.'
+watch_pattern_error_message = 'Error: --watch needs a search pattern.'
+watch_poll_error_message = 'Error: invalid watch poll interval: %s'
+watch_poll_watch_error_message = 'Error: --watch-poll needs --watch.'
+
+
+def make_parser():
     parser = argparse.ArgumentParser(
         prog=program_name,
         usage=usage_string,
@@ -96,6 +122,14 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         help='Save debug logging to FILE.'
     )
 
+    parser.add_argument(
+        '--trace',
+        dest='trace',
+        metavar='FILE',
+        help='Write a JSON object per line to FILE for each skipped and searched file: why it was skipped, \
+        how it was searched, the number of results and the time taken.'
+    )
+
     parser.add_argument(
         '-c',
         '--context',
@@ -119,9 +153,12 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
     parser.add_argument(
         '-e',
         '--regexp',
-        dest='search_pattern',
+        dest='search_patterns',
+        metavar='SEARCH_PATTERN',
+        action='append',
         help='Use SEARCH_PATTERN as the pattern to match in a file; use when defining patterns beginning with -. \
-        Can also be given as the first positional argument.'
+        Can also be given as the first positional argument. Can be given multiple times to search for \
+        any of the patterns in one pass; printed lines and matches then show the pattern that matched.'
     )
 
     parser.add_argument(
@@ -143,6 +180,17 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         help='Ignore case. Default %(default)s.'
     )
 
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        default=1,
+        type=int,
+        dest='jobs',
+        metavar='N',
+        help='Search files using N worker processes. Results are printed in the same order as a serial search. \
+        0 means one process per CPU. Default %(default)s.'
+    )
+
     parser.add_argument(
         '-l',
         '--line-number',
@@ -184,7 +232,7 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         dest='run',
         metavar='CMD',
         help='Run a program CMD for each matching file, passing the path name of the matching file as an argument. \
-        Ignored if the -p or -l options are given.'
+        Ignored if the -p or -l options are given. If a command fails the exit status is 2.'
     )
 
     parser.add_argument(
@@ -230,6 +278,24 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         help='Do not pipe output to a pager when stdout it detected as a tty.'
     )
 
+    parser.add_argument(
+        '-P',
+        '--max-procs',
+        default=1,
+        type=int,
+        dest='max_procs',
+        metavar='N',
+        help='Run up to N commands given with -r at once while the search continues. Default %(default)s.'
+    )
+
+    parser.add_argument(
+        '--dry-run',
+        default=False,
+        action='store_true',
+        dest='dry_run',
+        help='With --replace print a diff of the changes instead of changing the files.'
+    )
+
     parser.add_argument(
         '--force-pager',
         default=False,
@@ -237,6 +303,175 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         help='Always try to pipe output to a pager, do not check if stdout is a tty. Ignored when running with the -r option.'
     )
 
+    parser.add_argument(
+        '--build-index',
+        default=False,
+        action='store_true',
+        dest='build_index',
+        help='Build or update the index of the files in the start directory, then search using it. \
+        Only files changed since the last build are read. No search pattern is needed to only build the index.'
+    )
+
+    parser.add_argument(
+        '--use-index',
+        default=False,
+        action='store_true',
+        dest='use_index',
+        help='Use the index to skip files that cannot match. Changed and new files are searched as usual.'
+    )
+
+    parser.add_argument(
+        '--index-file',
+        dest='index_file',
+        metavar='FILE',
+        help='The index file. Default %s in the start directory.' % index_file_default
+    )
+
+    parser.add_argument(
+        '--cache-file',
+        dest='cache_file',
+        metavar='FILE',
+        help='The file remembering which files are binary between runs. \
+        Default $XDG_CACHE_HOME/pyf/metadata, or ~/.cache/pyf/metadata if XDG_CACHE_HOME is not set.'
+    )
+
+    parser.add_argument(
+        '--cache-size',
+        default=cache_size_default,
+        type=int,
+        dest='cache_size',
+        metavar='N',
+        help='Remember at most N files in the cache file, dropping the least recently used. Default %(default)s.'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        default=False,
+        action='store_true',
+        dest='no_cache',
+        help='Do not read or write the cache file.'
+    )
+
+    parser.add_argument(
+        '--large-file-size',
+        default=64 * 1024 * 1024,
+        type=int,
+        dest='large_file_size',
+        metavar='BYTES',
+        help='Search files larger than BYTES without reading them into memory. Default %(default)s.'
+    )
+
+    parser.add_argument(
+        '--line-buffered',
+        default=False,
+        action='store_true',
+        dest='line_buffered',
+        help='Write each result as soon as it is found. By default results are written in blocks unless stdout is a tty.'
+    )
+
+    parser.add_argument(
+        '--max-count',
+        type=int,
+        dest='max_count',
+        metavar='N',
+        help='Stop searching a file after N matching lines.'
+    )
+
+    parser.add_argument(
+        '--max-results',
+        type=int,
+        dest='max_results',
+        metavar='N',
+        help='Stop the search after printing N results: matching lines, or files when only printing file names.'
+    )
+
+    parser.add_argument(
+        '--patterns-file',
+        dest='patterns_file',
+        metavar='FILE',
+        help='Read search patterns from FILE, one per line. As if each was given with -e.'
+    )
+
+    parser.add_argument(
+        '--replace',
+        dest='replace',
+        metavar='TEMPLATE',
+        help='Replace the matches of the search pattern in the files with TEMPLATE, which can refer to groups \
+        like \\1 or \\g<name>. Matches are replaced in each line as it is matched. Prints the changed files.'
+    )
+
+    parser.add_argument(
+        '--run-batch',
+        default=False,
+        action='store_true',
+        dest='run_batch',
+        help='Pass as many matching files to each command given with -r as the system allows, like xargs.'
+    )
+
+    parser.add_argument(
+        '--serve',
+        default=False,
+        action='store_true',
+        dest='serve',
+        help='Run a server answering searches from pyf --client over a Unix socket, keeping directory listings, \
+        which files are binary and loaded indexes in memory between searches. Changed directories and files \
+        are looked at again.'
+    )
+
+    parser.add_argument(
+        '--client',
+        default=False,
+        action='store_true',
+        dest='client',
+        help='Send the search, given with the other options as usual, to the pyf --serve server and print its results.'
+    )
+
+    parser.add_argument(
+        '--socket',
+        dest='socket',
+        metavar='PATH',
+        help='The Unix socket of --serve and --client. Default $XDG_RUNTIME_DIR/pyf-UID.sock, \
+        or in the temporary directory in pyf-UID, made only for this user, if XDG_RUNTIME_DIR is not set.'
+    )
+
+    parser.add_argument(
+        '--server-memory',
+        default=256,
+        type=int,
+        dest='server_memory',
+        metavar='MB',
+        help='Keep at most about MB megabytes of directory listings and indexes in the --serve server. \
+        Default %(default)s.'
+    )
+
+    parser.add_argument(
+        '--git',
+        default=False,
+        action='store_true',
+        dest='git',
+        help='Search the files tracked by git, read from the git index, instead of walking the start directory. \
+        The filename and skip patterns still apply. Files are searched in path order.'
+    )
+
+    parser.add_argument(
+        '--untracked',
+        default=False,
+        action='store_true',
+        dest='untracked',
+        help='With --git also search the files not tracked by git that are not ignored, found by walking the \
+        start directory as with --gitignore.'
+    )
+
+    parser.add_argument(
+        '--gitignore',
+        default=False,
+        action='store_true',
+        dest='gitignore',
+        help='Skip the files and directories that .gitignore and .ignore files, and the repository\'s \
+        .git/info/exclude, ignore, as git would. Those of the directories above the start directory, up to \
+        the top of the repository, apply too. Ignored directories are not listed.'
+    )
+
     parser.add_argument(
         '--skip-dirs-pattern',
         default='(^\..+|CVS|RCS|__pycache__)',
@@ -249,6 +484,61 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         help='Regex of files to skip. Default \'%(default)s\'.'
     )
 
+    parser.add_argument(
+        '--sniff-size',
+        default=sniff_size_default,
+        type=int,
+        dest='sniff_size',
+        metavar='BYTES',
+        help='Read the first BYTES of a file to decide if it is binary. Larger is slower but more accurate. \
+        Default %(default)s.'
+    )
+
+    parser.add_argument(
+        '--stats',
+        default=False,
+        action='store_true',
+        dest='stats_text',
+        help='Print counts of the directories and files looked at, skipped and matched, the bytes read and the \
+        time taken by each stage of the search to stderr at exit.'
+    )
+
+    parser.add_argument(
+        '--stats-json',
+        default=False,
+        action='store_true',
+        dest='stats_json',
+        help='Print the --stats counts and times to stderr at exit as a JSON object.'
+    )
+
+    parser.add_argument(
+        '--walk-threads',
+        default=0,
+        type=int,
+        dest='walk_threads',
+        metavar='N',
+        help='List up to N directories at once using a pool of threads. Helps on network filesystems. \
+        The output order is not changed. Default %(default)s lists one directory at a time.'
+    )
+
+    parser.add_argument(
+        '--watch',
+        default=False,
+        action='store_true',
+        dest='watch',
+        help='Search, then keep watching the start directory and search the files created or changed. \
+        Each result is printed as "+ result" when found and "- result" when its file changes or is removed \
+        without it. Uses inotify where available. Stop with Ctrl-C.'
+    )
+
+    parser.add_argument(
+        '--watch-poll',
+        type=float,
+        dest='watch_poll',
+        metavar='SECONDS',
+        help='With --watch look for changes by walking the start directory every SECONDS instead of using inotify.'
+    )
+
     parser.add_argument(
         'search-pattern',
         nargs='?',
@@ -267,12 +557,20 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         help='Change to this directory before findind and searching files.'
     )
 
+    return parser
+
+
+def parse_opts(argv, stdin=None, stdout=None, stderr=None):
+    parser = make_parser()
+
     # print('argv = %s' % argv)
     options = parser.parse_args(argv)
 
+    if not options.search_patterns:
+        options.search_patterns = []
     sp = getattr(options, 'search-pattern', None)
     if sp:
-        options.search_pattern = sp
+        options.search_patterns.append(sp)
     fp = getattr(options, 'filename-pattern', None)
     if fp:
         options.filename_pattern = fp
@@ -280,6 +578,14 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
     if sd:
         options.start_directory = sd
 
+    return init_opts(parser, options, stdin=stdin, stdout=stdout, stderr=stderr)
+
+
+def init_opts(parser, options, stdin=None, stdout=None, stderr=None, output=True):
+    # check the parsed options and set up what the search needs
+    # output: set up the pager and the output buffer
+    # returns None on errors, written to stderr
+
     # set up i/o options
     options.stdin = stdin or sys.stdin
     options.stdout = stdout or sys.stdout
@@ -287,12 +593,35 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
 
     # print('options = %s' % options)
 
+    # the encoding files are read with
+    options.encoding = locale.getpreferredencoding(False)
+
+    if options.patterns_file:
+        try:
+            with open(options.patterns_file) as fp:
+                for line in fp:
+                    line = line.rstrip('\r\n')
+                    if line:
+                        options.search_patterns.append(line)
+        except Exception as e:
+            writerr(options, patterns_file_error_message % options.patterns_file, exception=e)
+            return None
+
+    options.search_pattern = None
+    options.multiple_patterns = False
+    if options.search_patterns:
+        options.search_pattern = options.search_patterns[0]
+
     # check we have at least one of a search-pattern or filename-pattern
     if options.search_pattern:
         if not options.filename_pattern:
             options.filename_pattern = filename_pattern_default
     else:
-        if not options.filename_pattern:
+        if options.build_index or options.serve:
+            # index everything, or the patterns come with each search
+            if not options.filename_pattern:
+                options.filename_pattern = filename_pattern_default
+        elif not options.filename_pattern:
             parser.print_help()
             writerr(options, no_pattern_error_message)
             return None
@@ -302,12 +631,51 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
         flags = 0
         if options.ignore:
             flags = re.IGNORECASE
-        try:
-            options.search_pattern_regex = re.compile(options.search_pattern, flags)
-        except Exception as e:
-            msg = regex_compile_error_message % {'type': 'search-pattern', 'regex': options.search_pattern}
-            writerr(options, msg, exception=e)
-            return None
+        regexes = []
+        for pattern in options.search_patterns:
+            try:
+                regexes.append(re.compile(pattern, flags))
+            except Exception as e:
+                msg = regex_compile_error_message % {'type': 'search-pattern', 'regex': pattern}
+                writerr(options, msg, exception=e)
+                return None
+
+        options.search_regexes = regexes
+
+        # a line is searched with search_line
+        # the file is searched for hits with search_pattern_regex
+        options.multiple_patterns = len(regexes) > 1
+        if options.multiple_patterns:
+            combined = combine_patterns(options.search_patterns, regexes, flags)
+            patterns = PatternSet(regexes, combined)
+            options.search_line = patterns.search
+        else:
+            combined = regexes[0]
+            options.search_line = combined.search
+
+        if combined is None:
+            # search each line with each pattern
+            options.search_pattern_regex = patterns
+            options.search_pattern_line_safe = False
+            options.search_pattern_literal = None
+            options.search_pattern_mapped = False
+        else:
+            options.search_pattern_regex = combined
+            options.search_pattern_line_safe = is_line_safe(combined)
+            # a string any match contains, files without it are skipped
+            # and only the lines with it are searched
+            literals = required_literals(combined)
+            options.search_pattern_literal = literals[0] if literals else None
+            # large files are searched as bytes
+            # for the literal or with a bytes regex that finds the same lines
+            options.search_pattern_literal_bytes = None
+            options.search_pattern_bytes_regex = None
+            if codecs.lookup(options.encoding).name == 'utf-8':
+                if options.search_pattern_literal:
+                    options.search_pattern_literal_bytes = options.search_pattern_literal.encode('utf-8')
+                else:
+                    options.search_pattern_bytes_regex = bytes_regex(combined)
+            options.search_pattern_mapped = bool(options.search_pattern_literal_bytes or options.search_pattern_bytes_regex)
 
     try:
         options.filename_pattern_regex = re.compile(make_regex(options.filename_pattern))
@@ -332,22 +700,111 @@ def parse_opts(argv, stdin=None, stdout=None, stderr=None):
             writerr(options, msg, exception=e)
             return None
 
+    if options.jobs < 0:
+        writerr(options, jobs_error_message % options.jobs)
+        return None
+    if options.jobs == 0:
+        options.jobs = multiprocessing.cpu_count()
+
+    if options.walk_threads < 0:
+        writerr(options, walk_threads_error_message % options.walk_threads)
+        return None
+
+    if options.cache_size < 0:
+        writerr(options, cache_size_error_message % options.cache_size)
+        return None
+    for value, message in ((options.max_count, max_count_error_message), (options.max_results, max_results_error_message)):
+        if value is not None and value < 1:
+            writerr(options, message % value)
+            return None
+
+    if options.replace is not None:
+        if len(options.search_patterns) != 1:
+            writerr(options, replace_patterns_error_message)
+            return None
+        if options.invert:
+            writerr(options, replace_invert_error_message)
+            return None
+    elif options.dry_run:
+        writerr(options, dry_run_error_message)
+        return None
+
+    if options.untracked and not options.git:
+        writerr(options, untracked_error_message)
+        return None
+
+    if options.watch:
+        if not options.search_pattern:
+            writerr(options, watch_pattern_error_message)
+            return None
+        # the results of each file are kept, printed and removed as they change
+        for value, name in ((options.files, '-f'), (options.run, '-r'), (options.replace is not None, '--replace'),
+                            (options.build_index, '--build-index'), (options.max_results, '--max-results'),
+                            (options.jobs > 1, '-j'), (options.git, '--git')):
+            if value:
+                writerr(options, watch_error_message % name)
+                return None
+    if options.watch_poll is not None:
+        if not options.watch:
+            writerr(options, watch_poll_watch_error_message)
+            return None
+        if not options.watch_poll > 0:
+            writerr(options, watch_poll_error_message % options.watch_poll)
+            return None
+
+    if options.max_procs < 1:
+        writerr(options, max_procs_error_message % options.max_procs)
+        return None
+
+    if options.sniff_size < 1:
+        writerr(options, sniff_size_error_message % options.sniff_size)
+        return None
+
+    if options.server_memory < 1:
+        writerr(options, server_memory_error_message % options.server_memory)
+        return None
+
+    if not options.cache_file:
+        options.cache_file = cache_file_default()
+    options.cache = None
+
+    if not options.index_file:
+        options.index_file = os.path.join(options.start_directory, index_file_default)
+    options.index = None
+
     # set option to check if we matched
     options.didmatch = False
 
+    # results printed in all and for the file being searched
+    # done is set to stop the search after --max-results
+    options.results = 0
+    options.stats = Stats()
+    options.file_results = 0
+    options.done = False
+
     # ignore run if printing lines or line numbers
     if options.lines or options.lnum:
         options.run = None
+    options.runner = None
+
+    # the pyf --serve server the search is run by
+    options.server = None
 
     # use pager?
     options.pager = None
-    if not options.run and not options.nopager and (options.stdout.isatty() or options.force_pager):
+    options.exit_status = 'not-set'
+    if not output:
+        return options
+
+    if not options.run and not options.nopager and not options.serve and not options.watch and (options.stdout.isatty() or options.force_pager):
         try:
             open_pager(options)
         except Exception as e:
             writerr(options, 'Exception opening pager', exception=e)
             return None
 
-    options.exit_status = 'not-set'
+    # results are written through a buffer
+    options.stdout = OutputBuffer(options, options.stdout, line_buffered=options.line_buffered)
+
     return options
 
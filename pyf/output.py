@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# buffered output of the results
+# lines are collected and written in large blocks, flushed when the buffer
+# is full or has waited long enough, or after every line on a terminal
+# the wait is checked for each line and after each file searched, so a
+# result found early in a long search is not held until it ends
+# a closed pipe, e.g. from head or quitting the pager, stops the search
+
+import errno
+import io
+import os
+import time
+
+from .logger import debug
+
+# characters collected before writing
+output_buffer_size = 64 * 1024
+
+# seconds a line may wait in the buffer
+output_flush_interval = 0.1
+
+
+class OutputBuffer(object):
+    def __init__(self, options, stream, line_buffered=False):
+        self.options = options
+        self.stream = stream
+        # the pager's stdin is a binary pipe
+        self.encoding = None if isinstance(stream, io.TextIOBase) else options.encoding
+        self.line_buffered = line_buffered or stream.isatty()
+        self.lines = []
+        self.length = 0
+        self.flushed = time.monotonic()
+        self.broken = False
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def writeline(self, line):
+        self.lines.append(line)
+        self.length += len(line) + 1
+        if self.line_buffered or self.length >= output_buffer_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        # flush the lines that have waited long enough
+        if self.lines and time.monotonic() - self.flushed >= output_flush_interval:
+            self.flush()
+
+    def write(self, s):
+        # whole lines, e.g. the output of a worker process
+        if s.endswith('\n'):
+            self.writeline(s[:-1])
+        else:
+            self.flush()
+            self.emit(s)
+
+    def flush(self):
+        if self.lines:
+            lines = self.lines
+            self.lines = []
+            self.length = 0
+            lines.append('')
+            self.emit('\n'.join(lines))
+        self.flushed = time.monotonic()
+
+    def emit(self, s):
+        if self.broken:
+            return
+        start = time.perf_counter()
+        try:
+            if self.encoding:
+                s = s.encode(self.encoding, 'replace')
+            self.stream.write(s)
+            self.stream.flush()
+            self.options.stats.time_output += time.perf_counter() - start
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # nobody is reading, stop searching
+            debug('OutputBuffer.emit: broken pipe')
+            self.broken = True
+            self.options.done = True
+            # so what is left in the stream's own buffer is not written
+            # again when it is closed, or at exit for sys.stdout
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, self.stream.fileno())
+                os.close(devnull)
+            except Exception:
+                pass
+
+    def close(self):
+        self.flush()
+        self.stream.close()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# analysis of the compiled search pattern
+# used to pick the fastest way of searching a file that gives
+# the same matches as searching it line by line
+
+import re
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+from .logger import debug
+
+# anchors that see the start/end of a line differently when searching
+# the whole file instead of a stripped line
+# \b and \B are fine: strip only removes non-word characters
+unsafe_anchors = (
+    sre_constants.AT_BEGINNING,
+    sre_constants.AT_BEGINNING_LINE,
+    sre_constants.AT_BEGINNING_STRING,
+    sre_constants.AT_END,
+    sre_constants.AT_END_LINE,
+    sre_constants.AT_END_STRING,
+)
+
+# not in older pythons
+ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+POSSESSIVE_REPEAT = getattr(sre_constants, 'POSSESSIVE_REPEAT', None)
+
+repeats = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, POSSESSIVE_REPEAT)
+
+
+def parse(regex):
+    # the parsed pattern of a compiled regex or None
+    try:
+        return sre_parse.parse(regex.pattern, regex.flags)
+    except Exception as e:
+        debug('parse: exception parsing %s: %s', regex.pattern, e)
+        return None
+
+
+def subpatterns(op, av):
+    # the nested patterns of one parsed item
+    if op == sre_constants.SUBPATTERN:
+        return [av[-1]]
+    if op in repeats:
+        return [av[2]]
+    if op == sre_constants.BRANCH:
+        return av[1]
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [av[1]]
+    if op == sre_constants.GROUPREF_EXISTS:
+        return [p for p in av[1:] if p]
+    if op == ATOMIC_GROUP:
+        return [av]
+    return []
+
+
+def walk(parsed):
+    # all the parsed items, nested ones included
+    stack = [parsed]
+    while stack:
+        for op, av in stack.pop():
+            yield op, av
+            stack.extend(subpatterns(op, av))
+
+
+def is_line_safe(regex):
+    # True if every match of regex in a stripped line is also found when
+    # searching the whole file at the same position
+    # then the whole file can be searched once and only the lines with
+    # a match checked with a per-line search
+    # anchors, negative lookarounds and atomic groups depend on what is
+    # around the line so are not safe
+    parsed = parse(regex)
+    if parsed is None:
+        return False
+    for op, av in walk(parsed):
+        if op == sre_constants.AT and av in unsafe_anchors:
+            return False
+        if op in (sre_constants.ASSERT_NOT, ATOMIC_GROUP, POSSESSIVE_REPEAT):
+            return False
+    return True
+
+
+def is_bytes_safe(regex):
+    # True if the pattern can be searched for in the utf-8 bytes of a file
+    # and find every line the str pattern matches
+    # only ascii literals and ranges are allowed: ascii bytes in utf-8 are
+    # always ascii characters, but ., [^...], \w, \b etc. see a multi-byte
+    # character differently from the decoded one
+    if not is_line_safe(regex):
+        return False
+    parsed = parse(regex)
+    if parsed is None:
+        return False
+    ignore_case = regex.flags & sre_constants.SRE_FLAG_IGNORECASE
+    for op, av in walk(parsed):
+        if op == sre_constants.SUBPATTERN and av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+            ignore_case = True
+    for op, av in walk(parsed):
+        if op == sre_constants.LITERAL:
+            if av > 127:
+                return False
+            # these also match non-ascii characters when ignoring case
+            if ignore_case and chr(av) in 'iksIKS':
+                return False
+        elif op == sre_constants.IN:
+            for iop, iav in av:
+                if iop == sre_constants.LITERAL:
+                    if iav > 127 or (ignore_case and chr(iav) in 'iksIKS'):
+                        return False
+                elif iop == sre_constants.RANGE:
+                    if iav[1] > 127 or ignore_case:
+                        return False
+                else:
+                    return False
+        elif op in (sre_constants.ANY, sre_constants.NOT_LITERAL):
+            return False
+        elif op == sre_constants.AT:
+            # \b and \B next to a non-ascii character
+            return False
+    return True
+
+
+def bytes_regex(regex):
+    # regex compiled to search bytes, if that finds the same lines
+    if not is_bytes_safe(regex):
+        return None
+    flags = regex.flags & ~sre_constants.SRE_FLAG_UNICODE
+    try:
+        return re.compile(regex.pattern.encode('ascii'), flags)
+    except Exception as e:
+        debug('bytes_regex: exception compiling %s: %s', regex.pattern, e)
+        return None
+
+
+def find_literals(parsed, literals):
+    # add the runs of literal characters every match of parsed contains
+    run = []
+    for op, av in parsed:
+        if op == sre_constants.LITERAL:
+            run.append(chr(av))
+            continue
+        if run:
+            literals.append(''.join(run))
+            run = []
+        if op == sre_constants.SUBPATTERN:
+            if not av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+                find_literals(av[-1], literals)
+        elif op in repeats and av[0] >= 1:
+            find_literals(av[2], literals)
+        # anything else, e.g. alternatives, need not contain a literal
+    if run:
+        literals.append(''.join(run))
+
+
+def required_literals(regex):
+    # the strings every match of regex contains, longest first
+    # none when ignoring case
+    if regex.flags & sre_constants.SRE_FLAG_IGNORECASE:
+        return []
+    parsed = parse(regex)
+    if parsed is None:
+        return []
+    literals = []
+    find_literals(parsed, literals)
+    literals.sort(key=len, reverse=True)
+    return literals
+
+
+def trie_pattern(node):
+    # the regex for a trie of dicts, '' marks the end of a string
+    alts = [re.escape(c) + trie_pattern(node[c]) for c in sorted(node) if c]
+    if not alts:
+        return ''
+    if len(alts) == 1:
+        if '' in node:
+            return '(?:%s)?' % alts[0]
+        return alts[0]
+    body = '(?:%s)' % '|'.join(alts)
+    if '' in node:
+        body += '?'
+    return body
+
+
+def literals_regex(literals, flags=0):
+    # one regex for many plain strings, with common prefixes shared
+    # so it scans the text like a trie instead of trying each string
+    trie = {}
+    for literal in literals:
+        node = trie
+        for c in literal:
+            node = node.setdefault(c, {})
+        node[''] = {}
+    return re.compile(trie_pattern(trie), flags)
+
+
+def combine_patterns(patterns, regexes, flags=0):
+    # one regex matching where any of regexes match or None
+    # plain strings are combined as a trie
+    # others are alternatives unless they have back references, which
+    # would refer to the wrong group
+    try:
+        if not any(is_special(p) for p in patterns):
+            return literals_regex(patterns, flags)
+        for regex in regexes:
+            parsed = parse(regex)
+            if parsed is None:
+                return None
+            for op, av in walk(parsed):
+                if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                    return None
+        return re.compile('|'.join('(?:%s)' % p for p in patterns), flags)
+    except Exception as e:
+        debug('combine_patterns: exception combining %s: %s', patterns, e)
+        return None
+
+
+# characters that make a pattern more than a plain string
+special_regex = re.compile(r'[.^$*+?{}[\]|()\\]')
+
+
+def is_special(pattern):
+    return special_regex.search(pattern) is not None
+
+
+class PatternSet(object):
+    # several search patterns searched for together
+    # search returns the match of the first pattern matching
+    # so the pattern that matched is mo.re.pattern
+    def __init__(self, regexes, combined):
+        self.regexes = regexes
+        # None if the patterns could not be combined
+        self.combined = combined
+        self.pattern = '|'.join(r.pattern for r in regexes)
+
+    def search(self, s, pos=0):
+        if self.combined is not None:
+            if not self.combined.search(s, pos):
+                return None
+        for regex in self.regexes:
+            mo = regex.search(s, pos)
+            if mo:
+                return mo
+        return None
@@ -4,18 +4,34 @@
 # https://github.com/bnomis/pyf
 # (c) Simon Blanchard
 
+import collections
+import concurrent.futures
+import copy
+import difflib
+import errno
+import functools
+import mmap
+import multiprocessing
 import os
 import os.path
+import re
+import stat
 import subprocess
 import sys
+import tempfile
+import time
 
-from .logger import debug, error, init_logging, deinit_logging
-from .filetype import is_binary
+from .logger import debug, error, init_logging, deinit_logging, open_trace, close_trace, trace
+from .cache import MetadataCache
+from .filetype import is_text_data
+from .ignore import dir_ignores, is_ignored, top_ignores
+from .index import Index
+from .stats import Stats
 
 
 # pyf stdout
 def writeout(options, line):
-    options.stdout.write(line + '\n')
+    options.stdout.writeline(line)
 
 
 # pyf stderr
@@ -55,7 +71,7 @@ def check_file_access(options, path):
             fp = open(path)
         except Exception as e:
             writerr_file_access(options, 'File is not readable: %s' % path)
-            error('check_file_access: exception for %s: %s' % (path, e), exc_info=True)
+            error('check_file_access: exception for %s: %s', path, e, exc_info=True)
             return False
         else:
             fp.close()
@@ -63,72 +79,267 @@ def check_file_access(options, path):
     return True
 
 
-def pyfwalk(options, path):
-    debug('pyfwalk = %s' % path)
+# the messages, as check_file_access gives them, for a directory that
+# cannot be listed because it changed during the walk
+list_dir_gone_messages = {
+    errno.ENOENT: 'File does not exist: %s',
+    errno.ENOTDIR: 'Not a directory: %s',
+    errno.ELOOP: 'Broken symlink: %s',
+}
 
-    if not check_file_access(options, path):
-        return
+
+def list_dir(options, path, ignores):
+    # list one directory for pyfwalk, may be run in a walk thread
+    # so errors are returned for pyfwalk to report in walk order
+    # ignores: with --gitignore the ignore rules of the directories above
+    # returns (dirs, files, descend, ignores, stats, error)
+    # descend's ignores, error is None or (is_access_error, message, exception)
+    if options.debug:
+        debug('pyfwalk = %s', path)
 
     try:
-        contents = os.listdir(path)
+        if options.server:
+            # the listing kept by pyf --serve
+            entries = options.server.scandir(path)
+        else:
+            entries = os.scandir(path)
+    except PermissionError:
+        return None, None, None, None, None, (True, 'Directory is not readable: %s' % path, None)
+    except OSError as e:
+        # gone or replaced since its parent was listed, skipped like an unreadable one
+        if e.errno not in list_dir_gone_messages:
+            return None, None, None, None, None, (False, "Exception listing: '%s'" % path, e)
+        return None, None, None, None, None, (True, list_dir_gone_messages[e.errno] % path, None)
     except Exception as e:
-        writerr(options, "Exception listing: '%s'" % path, exception=e)
-        return
+        return None, None, None, None, None, (False, "Exception listing: '%s'" % path, e)
 
     files = []
     dirs = []
+    descend = []
+    stats = Stats()
 
-    for f in contents:
-        longname = os.path.join(path, f)
-        if os.path.isdir(longname):
-            if options.skip_dirs_pattern:
-                if not options.skip_dirs_pattern_regex.search(f):
-                    dirs.append(f)
-                else:
-                    debug('pyfwalk: skipping dir: %s' % f)
-            else:
+    with entries:
+        if options.gitignore:
+            # the directory's own ignore files apply to its entries
+            entries = list(entries)
+            ignores = dir_ignores(path, [entry.name for entry in entries], ignores)
+        for entry in entries:
+            f = entry.name
+            try:
+                # follows symlinks, like os.path.isdir
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if options.skip_dirs_pattern and options.skip_dirs_pattern_regex.search(f):
+                    if options.debug:
+                        debug('pyfwalk: skipping dir: %s', f)
+                    if options.trace:
+                        trace('skip', entry.path, reason='skip-dirs-pattern')
+                    stats.skipped_dirs_pattern += 1
+                    continue
+                if ignores and is_ignored(ignores, entry.path, True):
+                    if options.debug:
+                        debug('pyfwalk: ignoring dir: %s', f)
+                    if options.trace:
+                        trace('skip', entry.path, reason='gitignore')
+                    stats.skipped_ignore += 1
+                    continue
                 dirs.append(f)
-        else:
-            if options.skip_files_pattern:
-                if not options.skip_files_pattern_regex.search(f):
-                    if options.filename_pattern_regex.search(f):
-                        files.append(f)
-                else:
-                    debug('pyfwalk: skipping file: %s' % f)
+                # do not follow symlinked directories
+                if not entry.is_symlink():
+                    descend.append(entry.path)
             else:
-                if options.filename_pattern_regex.search(f):
-                        files.append(f)
+                if options.skip_files_pattern and options.skip_files_pattern_regex.search(f):
+                    if options.debug:
+                        debug('pyfwalk: skipping file: %s', f)
+                    if options.trace:
+                        trace('skip', entry.path, reason='skip-files-pattern')
+                    stats.skipped_files_pattern += 1
+                elif ignores and is_ignored(ignores, entry.path, False):
+                    if options.debug:
+                        debug('pyfwalk: ignoring file: %s', f)
+                    if options.trace:
+                        trace('skip', entry.path, reason='gitignore')
+                    stats.skipped_ignore += 1
+                elif options.filename_pattern_regex.search(f):
+                    files.append(f)
                 else:
-                    debug('pyfwalk: skipping file: %s' % f)
+                    if options.debug and not options.skip_files_pattern:
+                        debug('pyfwalk: skipping file: %s', f)
+                    if options.trace:
+                        trace('skip', entry.path, reason='filename-pattern')
+                    stats.skipped_filename_pattern += 1
 
-    yield(path, dirs, files)
-    for d in dirs:
-        longname = os.path.join(path, d)
-        if not os.path.islink(longname):
-            for x in pyfwalk(options, longname):
-                yield x
+    return dirs, files, descend, ignores, stats, None
 
 
-def pyf_run(options, path):
+def pyfwalk(options, path):
+    # walk with an explicit stack of [directory, listing future] still to list
+    # os.scandir gives the entry types without a stat per entry
+    # with --walk-threads the directories at the top of the stack, which are
+    # walked next, are listed ahead of time by a pool of threads
+    # the walk order is the same either way
+    if not check_file_access(options, path):
+        return
+
+    ignores = None
+    if options.gitignore:
+        # those of the directories above path in the repository
+        ignores = top_ignores(options, path)
+
+    executor = None
+    outstanding = 0
+    if options.walk_threads > 0:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=options.walk_threads)
+        # listings done or in progress but not yet walked
+        max_outstanding = 2 * options.walk_threads
+
+    stack = [[path, ignores, None]]
+    try:
+        while stack:
+            path, ignores, future = stack.pop()
+            start = time.perf_counter()
+            if future:
+                outstanding -= 1
+                listing = future.result()
+            elif executor:
+                listing = executor.submit(list_dir, options, path, ignores).result()
+            else:
+                listing = list_dir(options, path, ignores)
+
+            options.stats.time_walk += time.perf_counter() - start
+            dirs, files, descend, ignores, stats, err = listing
+            if err:
+                is_access_error, msg, exception = err
+                if is_access_error:
+                    writerr_file_access(options, msg)
+                    continue
+                writerr(options, msg, exception=exception)
+                return
+
+            options.stats.merge(stats)
+            options.stats.dirs += 1
+            options.stats.files += len(files)
+            yield(path, dirs, files)
+
+            # push in reverse so directories are walked in listing order
+            for d in reversed(descend):
+                stack.append([d, ignores, None])
+
+            if executor:
+                i = len(stack) - 1
+                while i >= 0 and outstanding < max_outstanding:
+                    item = stack[i]
+                    if not item[2]:
+                        item[2] = executor.submit(list_dir, options, item[0], item[1])
+                        outstanding += 1
+                    i -= 1
+    finally:
+        if executor:
+            for item in stack:
+                if item[2]:
+                    item[2].cancel()
+            executor.shutdown(wait=False)
+
+
+def run_args(run):
+    # the command and arguments of -r CMD
     args = []
-    for a in options.run.split():
+    for a in run.split():
         if a[0] == "'":
             a = a[1:-1]
         args.append(a)
-    args.append(path)
-    debug('pyf_run: %s' % args)
+    return args
+
+
+def arg_size(args):
+    # the space args take in the arguments passed to a command
+    # each is a pointer and a string with a terminating nul
+    return sum(len(os.fsencode(a)) + 1 + 8 for a in args)
+
+
+def arg_limit():
+    # the space for the arguments of a command, what ARG_MAX leaves
+    # after the environment and some room to spare, as xargs does
     try:
-        p = subprocess.Popen(args)
-    except Exception as e:
-        writerr(options, "Error running: '%s'" % (' '.join(args)), exception=e)
-    else:
-        p.wait()
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 128 * 1024
+    env = sum(len(os.fsencode(k)) + len(os.fsencode(v)) + 2 + 8 for k, v in os.environ.items())
+    return max(arg_max - env - 2048, 4096)
+
+
+class Runner(object):
+    # runs -r CMD on the matching files
+    # with --run-batch on as many files at once as fit in the arguments
+    # with -P N up to N commands at once while the search goes on
+    def __init__(self, options):
+        self.options = options
+        self.args = run_args(options.run)
+        self.limit = arg_limit() - arg_size(self.args)
+        # files waiting for the next batch
+        self.paths = []
+        self.size = 0
+        self.running = collections.deque()
+        self.failed = 0
+
+    def add(self, path):
+        if not self.options.run_batch:
+            self.start([path])
+            return
+        size = arg_size([path])
+        if self.paths and self.size + size > self.limit:
+            self.start(self.paths)
+            self.paths = []
+            self.size = 0
+        self.paths.append(path)
+        self.size += size
+
+    def start(self, paths):
+        # room for one more command
+        self.wait(self.options.max_procs - 1)
+        args = self.args + paths
+        debug('Runner.start: %s', args)
+        # the command's output goes after what has been printed
+        self.options.stdout.flush()
+        try:
+            p = subprocess.Popen(args)
+        except Exception as e:
+            writerr(self.options, "Error running: '%s'" % (' '.join(args)), exception=e)
+        else:
+            self.running.append(p)
+
+    def wait(self, n):
+        # wait until at most n commands are running
+        for p in list(self.running):
+            if p.poll() is not None:
+                self.running.remove(p)
+                self.check(p)
+        while len(self.running) > n:
+            p = self.running.popleft()
+            p.wait()
+            self.check(p)
+
+    def check(self, p):
+        if p.returncode != 0:
+            self.failed += 1
+            writerr(self.options, "Command '%s' exited with status %d" % (' '.join(self.args), p.returncode),
+                    set_exit_status=False)
+
+    def finish(self):
+        if self.paths:
+            self.start(self.paths)
+            self.paths = []
+        self.wait(0)
 
 
 def print_path(options, path):
     options.didmatch = True
     if options.run:
-        pyf_run(options, path)
+        options.runner.add(path)
     else:
         writeout(options, path)
 
@@ -160,22 +371,51 @@ def print_match_group(options, lnum, path, group):
             writeout(options, '%s: %s' % (path, group))
 
 
+def tag_pattern(options, mo, text):
+    # with several search patterns show the one that matched
+    if options.multiple_patterns and mo is not None:
+        return '%s: %s' % (mo.re.pattern, text)
+    return text
+
+
 def print_match(options, lnum, path, line, mo):
     groups = mo.groups()
     if groups:
         for g in groups:
-            print_match_group(options, lnum, path, g)
+            print_match_group(options, lnum, path, tag_pattern(options, mo, g))
     else:
-        print_match_group(options, lnum, path, mo.group())
+        print_match_group(options, lnum, path, tag_pattern(options, mo, mo.group()))
+
+
+def stop_search(options):
+    # True once no more files should be searched
+    # after an error or when --max-results have been printed
+    return options.exit_status == 'error' or options.done
+
+
+def count_result(options):
+    # count a result about to be printed
+    # returns True if it is the last one for the file
+    if options.max_results and isinstance(options.stdout, OutputCollector):
+        # where it starts in the worker's output, for the parent to cut it short
+        options.stdout.marks.append(len(options.stdout.lines))
+    options.results += 1
+    options.file_results += 1
+    if options.max_results and options.results >= options.max_results:
+        options.done = True
+    return options.done or (options.max_count and options.file_results >= options.max_count)
 
 
 def print_result(options, lnum, path, line, lines, mo):
     not_first_time = options.didmatch
-    stop = False
+    stop = count_result(options)
     options.didmatch = True
     if not options.matches and not options.lines:
         if options.lnum:
-            writeout(options, '%d: %s' % (lnum, path))
+            if options.multiple_patterns and mo is not None:
+                writeout(options, '%d: %s: %s' % (lnum, path, mo.re.pattern))
+            else:
+                writeout(options, '%d: %s' % (lnum, path))
         else:
             print_path(options, path)
             stop = True
@@ -195,54 +435,561 @@ def print_result(options, lnum, path, line, lines, mo):
                 writeout(options, '')
             # write the lines
             for i in range(start, end):
-                print_line(options, i + 1, path, lines[i])
+                if i + 1 == lnum:
+                    print_line(options, i + 1, path, tag_pattern(options, mo, lines[i].strip()))
+                else:
+                    print_line(options, i + 1, path, lines[i])
         elif options.matches:
             print_match(options, lnum, path, line, mo)
         elif options.lines:
-            print_line(options, lnum, path, line)
+            print_line(options, lnum, path, tag_pattern(options, mo, line))
     return stop
 
 
+def split_lines(text):
+    # the lines of text as readlines would give them, without the newlines
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def regex_finder(search, data):
+    # a find function for hit_lines that searches data with a regex
+    def find(pos):
+        mo = search(data, pos)
+        if mo:
+            return mo.start()
+        return -1
+    return find
+
+
+def count_text_newlines(text, start, end):
+    return text.count('\n', start, end)
+
+
+def hit_lines(data, newline, count, find):
+    # yield (lnum, start, end) for each line of data with a hit
+    # find(pos) gives the offset of the next hit at or after pos or -1
+    # count(data, start, end) counts the newlines between start and end
+    length = len(data)
+    pos = 0
+    lnum = 1
+    counted = 0
+    while pos < length:
+        hit = find(pos)
+        if hit < 0:
+            return
+        start = data.rfind(newline, pos, hit)
+        if start < 0:
+            start = pos
+        else:
+            start += 1
+        # readlines does not give an empty line after a last newline
+        if start >= length:
+            return
+        end = data.find(newline, hit)
+        if end < 0:
+            end = length
+        lnum += count(data, counted, start)
+        counted = start
+        yield lnum, start, end
+        pos = end + 1
+
+
+def search_lines(options, text):
+    # yield (lnum, line, mo) for each line of text matching the search pattern
+    # line is stripped and mo is the match in the stripped line
+    # as if each line had been searched in turn
+    search = options.search_line
+    literal = options.search_pattern_literal
+
+    # look for hits in the whole text and check only the lines with one
+    # a hit need not be a match in the stripped line
+    # e.g. a regex match that runs on to the next line, so search the line
+    if literal and (len(literal) > 1 or not options.search_pattern_line_safe):
+        # every match contains the literal
+        find = functools.partial(text.find, literal)
+    elif options.search_pattern_line_safe:
+        find = regex_finder(options.search_pattern_regex.search, text)
+    else:
+        lnum = 0
+        for line in split_lines(text):
+            lnum += 1
+            line = line.strip()
+            mo = search(line)
+            if mo:
+                yield lnum, line, mo
+        return
+
+    for lnum, start, end in hit_lines(text, '\n', count_text_newlines, find):
+        line = text[start:end].strip()
+        mo = search(line)
+        if mo:
+            yield lnum, line, mo
+
+
+# bytes of a memory mapped file looked at at a time
+map_block_size = 1 << 20
+
+# a carriage return not part of \r\n, a line ending in universal newlines mode
+lone_cr_regex = re.compile(b'\\r(?!\\n)')
+
+
+def count_newlines(data, start, end):
+    # mmap has no count(), copy a block at a time
+    n = 0
+    while start < end:
+        block_end = min(start + map_block_size, end)
+        n += data[start:block_end].count(b'\n')
+        start = block_end
+    return n
+
+
+def search_lines_mapped(options, data):
+    # search_lines for the bytes of a memory mapped file
+    # yields (lnum, line, mo, start, end)
+    # only the lines with a hit are decoded
+    literal = options.search_pattern_literal_bytes
+    if literal:
+        find = functools.partial(data.find, literal)
+    else:
+        find = regex_finder(options.search_pattern_bytes_regex.search, data)
+    search = options.search_line
+    encoding = options.encoding
+
+    for lnum, start, end in hit_lines(data, b'\n', count_newlines, find):
+        line = data[start:end].decode(encoding, 'replace').strip()
+        mo = search(line)
+        if mo:
+            yield lnum, line, mo, start, end
+
+
+class LineWindow(object):
+    # the lines of a file around a match, the first being line first + 1
+    # indexed like the list of all the lines of the file for print_result
+    def __init__(self, first, lines):
+        self.first = first
+        self.lines = lines
+
+    def __len__(self):
+        return self.first + len(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i - self.first]
+
+
+def mapped_window(options, data, lnum, start, end):
+    # the LineWindow of a memory mapped file around a match at lnum
+    lines = [data[start:end]]
+    # lines before
+    while start > 0 and len(lines) <= options.context:
+        prev = data.rfind(b'\n', 0, start - 1) + 1
+        lines.append(data[prev:start - 1])
+        start = prev
+    lines.reverse()
+    first = lnum - len(lines)
+    # lines after, readlines does not give an empty line after a last newline
+    length = len(data)
+    pos = end + 1
+    after = 0
+    while pos < length and after < options.context:
+        end = data.find(b'\n', pos)
+        if end < 0:
+            end = length
+        lines.append(data[pos:end])
+        pos = end + 1
+        after += 1
+    return LineWindow(first, [line.decode(options.encoding, 'replace') for line in lines])
+
+
+def pyf_file_mapped(options, path, fd):
+    # search a large file without reading it into memory
+    # returns False if the file has to be read instead
+    try:
+        data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except Exception as e:
+        debug('pyf_file_mapped: cannot map %s: %s', path, e)
+        return False
+    with data:
+        # lines are only split at \n here
+        if data.find(b'\r') >= 0 and lone_cr_regex.search(data):
+            return False
+
+        if options.debug:
+            debug('pyf_file_mapped: searching in %s', path)
+        if options.trace:
+            trace('search', path, how='mapped')
+        for lnum, line, mo, start, end in search_lines_mapped(options, data):
+            lines = None
+            if options.context:
+                lines = mapped_window(options, data, lnum, start, end)
+            if print_result(options, lnum, path, line, lines, mo):
+                break
+    return True
+
+
+# characters of a large file read at a time by pyf_file_stream
+stream_block_size = 1 << 20
+
+# characters of a line of a large file searched, the rest of a longer line is skipped
+stream_line_size = 1 << 24
+
+
+def read_line_end(fp):
+    # the rest of the line a block of a large file ends in, with its newline
+    # at most stream_line_size characters more are kept, so that a file with
+    # very long lines or no newlines is not read into memory in one piece
+    rest = fp.readline(stream_line_size)
+    if rest.endswith('\n'):
+        return rest
+    skipped = fp.readline(stream_block_size)
+    if not skipped:
+        # the end of the file
+        return rest
+    while skipped and not skipped.endswith('\n'):
+        skipped = fp.readline(stream_block_size)
+    return rest + '\n'
+
+
+def pyf_file_stream(options, path, fp):
+    # search a large file a block of whole lines at a time as it is read
+    # only the lines before the block needed for a context are kept
+    # and the windows of the matches waiting for their lines after
+    context = options.context if (options.lines or options.matches) else 0
+    before = collections.deque(maxlen=context)
+    pending = collections.deque()
+    # the number of lines before the block
+    base = 0
+    while True:
+        block = fp.read(stream_block_size)
+        if not block:
+            break
+        if not block.endswith('\n'):
+            # finish the last line
+            block += read_line_end(fp)
+
+        if options.invert:
+            matching = set(lnum for lnum, line, mo in search_lines(options, block))
+            if not (options.lines or options.matches):
+                if matching:
+                    # a matching file is not printed
+                    return
+                base += block.count('\n') + (not block.endswith('\n'))
+                continue
+            hits = ((lnum, line.strip(), None) for lnum, line in enumerate(split_lines(block), 1) if lnum not in matching)
+        else:
+            hits = search_lines(options, block)
+
+        if not context:
+            for lnum, line, mo in hits:
+                if print_result(options, base + lnum, path, line, None, mo):
+                    return
+            base += block.count('\n') + (not block.endswith('\n'))
+            continue
+
+        hits = dict((lnum, (line, mo)) for lnum, line, mo in hits)
+        lines = split_lines(block)
+        if not hits and not pending:
+            before.extend(lines[-context:])
+            base += len(lines)
+            continue
+        for lnum, line in enumerate(lines, base + 1):
+            for window in pending:
+                window[0].lines.append(line)
+            # print the windows complete with their lines after, in order
+            while pending and len(pending[0][0]) == pending[0][1] + context:
+                window, wlnum, wline, wmo = pending.popleft()
+                if print_result(options, wlnum, path, wline, window, wmo):
+                    return
+            hit = hits.get(lnum - base)
+            if hit:
+                window = LineWindow(lnum - 1 - len(before), list(before) + [line])
+                pending.append((window, lnum) + hit)
+            before.append(line)
+        base += len(lines)
+
+    # the end of the file, the last windows have all the lines there are
+    for window, wlnum, wline, wmo in pending:
+        if print_result(options, wlnum, path, wline, window, wmo):
+            return
+    # print a non-matching file
+    if options.invert and not (options.lines or options.matches):
+        print_result(options, base, path, '', None, None)
+
+
+# the line endings universal newlines split lines at
+line_end_regex = re.compile(r'(\r\n|\r|\n)')
+
+
+def replace_lines(options, text):
+    # replace the search pattern in each stripped line of text, as the
+    # lines are matched, keeping the whitespace and line ending around it
+    # returns the old and new lines, without line endings, and the new text
+    regex = options.search_regexes[0]
+    parts = line_end_regex.split(text)
+    old = parts[0::2]
+    ends = parts[1::2] + ['']
+    # nothing after the last line ending is not a line
+    if not old[-1]:
+        old.pop()
+        ends.pop()
+    new = []
+    for line in old:
+        core = line.strip()
+        if regex.search(core):
+            lead = len(line) - len(line.lstrip())
+            line = line[:lead] + regex.sub(options.replace, core) + line[lead + len(core):]
+        new.append(line)
+    return old, new, ''.join(line + end for line, end in zip(new, ends))
+
+
+def write_replaced(options, path, fst, text):
+    # write text through a temporary file renamed over the file
+    # so it is never left half written, keeping its mode
+    path = os.path.realpath(path)
+    fd, tname = tempfile.mkstemp(prefix='.pyf-replace-', dir=os.path.dirname(path))
+    try:
+        with open(fd, 'w', encoding=options.encoding, newline='') as fp:
+            fp.write(text)
+        os.chmod(tname, stat.S_IMODE(fst.st_mode))
+        st = os.stat(path)
+        if st.st_size != fst.st_size or st.st_mtime_ns != fst.st_mtime_ns:
+            raise IOError('file changed while replacing')
+        os.replace(tname, path)
+    except Exception:
+        os.unlink(tname)
+        raise
+
+
+def pyf_file_replace(options, path, fd, fst):
+    # --replace: print the changed files or with --dry-run their diffs
+    try:
+        with open(fd, closefd=False, newline='') as fp:
+            text = fp.read()
+    except Exception as e:
+        writerr(options, 'Error opening %s' % (path), exception=e)
+        return
+
+    if options.debug:
+        debug('pyf_file_replace: replacing in %s', path)
+    if options.trace:
+        trace('search', path, how='replace')
+    try:
+        old, new, replaced = replace_lines(options, text)
+    except Exception as e:
+        writerr(options, 'Exception matching %s' % path, exception=e)
+        return
+    if replaced == text:
+        return
+
+    count_result(options)
+    options.didmatch = True
+    if options.dry_run:
+        for line in difflib.unified_diff(old, new, path, path, lineterm=''):
+            writeout(options, line)
+        return
+    try:
+        write_replaced(options, path, fst, replaced)
+    except Exception as e:
+        writerr(options, 'Error replacing %s' % path, exception=e)
+        return
+    writeout(options, path)
+
+
+def pyf_lines_invert(options, path, lines):
+    # print the lines not matching
+    lnum = 0
+    for line in lines:
+        lnum += 1
+        line = line.strip()
+        mo = options.search_line(line)
+        if not mo:
+            if print_result(options, lnum, path, line, lines, mo):
+                break
+
+
+def open_file(options, path):
+    # open path for reading, returns the file descriptor or None
+    # the errors are those check_file_access gives
+    try:
+        return os.open(path, os.O_RDONLY)
+    except (OSError, ValueError) as e:
+        # only look at why it failed
+        if not os.path.lexists(path):
+            writerr_file_access(options, 'File does not exist: %s' % path)
+        elif os.path.islink(path) and not os.path.exists(path):
+            writerr_file_access(options, 'Broken symlink: %s' % path)
+        elif os.path.isdir(path):
+            writerr_file_access(options, 'Directory is not readable: %s' % path)
+        else:
+            writerr_file_access(options, 'File is not readable: %s' % path)
+            error('open_file: exception for %s: %s', path, e, exc_info=True)
+        return None
+
+
+def read_block(fd, size):
+    # read size bytes, fewer only at the end of the file
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def sniff_binary(options, path, fd):
+    # True if the start of the file looks binary, leaves fd at the start
+    try:
+        data = read_block(fd, options.sniff_size)
+        os.lseek(fd, 0, os.SEEK_SET)
+    except Exception as e:
+        error('sniff_binary: exception for file %s: %s', path, e, exc_info=True)
+        return True
+    return not is_text_data(data)
+
+
 def pyf_file(options, path):
-    if not check_file_access(options, path):
+    options.file_results = 0
+    if options.trace:
+        start = time.time()
+        pyf_file_open(options, path)
+        trace('file', path, results=options.file_results, seconds=round(time.time() - start, 6))
+    else:
+        pyf_file_open(options, path)
+    # the results of earlier files, while this one found none
+    options.stdout.flush_if_due()
+
+
+def pyf_file_open(options, path):
+    stats = options.stats
+    start = time.perf_counter()
+    # one descriptor for the access check, the binary check and the search
+    fd = open_file(options, path)
+    stats.time_open += time.perf_counter() - start
+    if fd is None:
+        stats.unreadable += 1
         return
+    try:
+        pyf_fd(options, path, fd)
+    finally:
+        os.close(fd)
 
+
+def pyf_fd(options, path, fd):
+    stats = options.stats
+    fst = os.fstat(fd)
     if not options.no_binary_check:
-        if is_binary(path):
-            debug('pyf_file: skipping binary file: %s' % path)
+        # the answer for a file not changed since an earlier run comes from
+        # the cache, keyed by the stat of the open file
+        cache = options.cache
+        key = binary = None
+        if cache:
+            key = cache.key(fst)
+            binary = cache.get(key)
+        cached = binary is not None
+        if not cached:
+            start = time.perf_counter()
+            binary = sniff_binary(options, path, fd)
+            stats.time_sniff += time.perf_counter() - start
+            if cache:
+                cache.put(key, binary)
+        if binary:
+            if options.debug:
+                debug('pyf_fd: skipping binary file: %s', path)
+            if options.trace:
+                trace('skip', path, reason='binary', cached=cached)
+            stats.skipped_binary += 1
+            return
+
+    if stat.S_ISDIR(fst.st_mode):
+        # only with -B, otherwise a directory is binary
+        e = IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), path)
+        writerr(options, 'Error opening %s' % (path), exception=e)
+        return
+
+    stats.searched += 1
+    stats.bytes_read += fst.st_size
+    start = time.perf_counter()
+    try:
+        pyf_fd_search(options, path, fd, fst)
+    finally:
+        if options.file_results:
+            stats.matched_files += 1
+        stats.time_match += time.perf_counter() - start
+
+
+def pyf_fd_search(options, path, fd, fst):
+    if options.replace is not None:
+        pyf_file_replace(options, path, fd, fst)
+        return
+
+    if options.search_pattern_mapped and not options.invert and fst.st_size > options.large_file_size:
+        try:
+            if pyf_file_mapped(options, path, fd):
+                return
+        except IOError:
+            writerr(options, 'IOError exception matching %s' % path)
+            return
+        except Exception as e:
+            writerr(options, 'Exception matching %s' % path, exception=e)
             return
 
     try:
-        fp = open(path)
+        fp = open(fd, closefd=False)
     except Exception as e:
         writerr(options, 'Error opening %s' % (path), exception=e)
         return
-    else:
-        lines = fp.readlines()
-        fp.close()
 
-    debug('pyf_file: searching in %s' % path)
+    if fst.st_size > options.large_file_size:
+        # too large to read into memory
+        if options.debug:
+            debug('pyf_fd: streaming %s', path)
+        if options.trace:
+            trace('search', path, how='stream')
+        try:
+            with fp:
+                pyf_file_stream(options, path, fp)
+        except IOError:
+            writerr(options, 'IOError exception matching %s' % path)
+        except Exception as e:
+            writerr(options, 'Exception matching %s' % path, exception=e)
+        return
+
+    start = time.perf_counter()
+    text = fp.read()
+    fp.close()
+    # the search is timed as a whole by pyf_fd, the read is not part of the match
+    read = time.perf_counter() - start
+    options.stats.time_read += read
+    options.stats.time_match -= read
+
+    if options.debug:
+        debug('pyf_fd: searching in %s', path)
+    if options.trace:
+        trace('search', path, how='read')
     try:
-        lnum = 0
+        if options.invert and (options.lines or options.matches):
+            pyf_lines_invert(options, path, split_lines(text))
+            return
+
+        # only needed to print contexts
+        lines = None
         matched = False
-        line = ''
-        mo = None
-        for line in lines:
-            lnum += 1
-            line = line.strip()
-            mo = options.search_pattern_regex.search(line)
-            # a match?
-            if mo:
-                matched = True
-                if not options.invert:
-                    if print_result(options, lnum, path, line, lines, mo):
-                        break
-            elif options.invert:
-                if options.lines:
-                    print_result(options, lnum, path, line, lines, mo)
+        for lnum, line, mo in search_lines(options, text):
+            matched = True
+            if options.invert:
+                break
+            if options.context and lines is None:
+                lines = split_lines(text)
+            if print_result(options, lnum, path, line, lines, mo):
+                break
         # print a non-matching file
-        if options.invert and (not options.lines) and (not matched):
-            print_result(options, lnum, path, line, lines, mo)
+        if options.invert and not matched:
+            lines = split_lines(text)
+            print_result(options, len(lines), path, '', lines, None)
     # typically from a broken pipe
     # e.g. when 'q' is typed in the pager
     # should exit
@@ -252,63 +999,375 @@ def pyf_file(options, path):
         writerr(options, 'Exception matching %s' % path, exception=e)
 
 
+# --jobs: search files in a pool of worker processes
+# the options a worker process searches with, set by init_job
+job_options = None
+
+# files per job sent to a worker
+job_chunk_size = 32
+
+
+class OutputCollector(object):
+    # stands in for stdout/stderr in a worker process
+    def __init__(self):
+        self.lines = []
+        # the index in lines of each result with --max-results
+        self.marks = []
+
+    def write(self, s):
+        self.lines.append(s)
+
+    def writeline(self, line):
+        self.lines.append(line + '\n')
+
+    def flush(self):
+        pass
+
+    def flush_if_due(self):
+        pass
+
+
+def make_job_options(options):
+    # a picklable copy of options for the worker processes
+    wopts = copy.copy(options)
+    wopts.stdin = None
+    wopts.stdout = None
+    wopts.stderr = None
+    wopts.pager = None
+    # the parent skips files using the index
+    wopts.index = None
+    # -r commands are run by the parent, in walk order
+    wopts.run = None
+    wopts.runner = None
+    return wopts
+
+
+def init_job(options):
+    global job_options
+    job_options = options
+
+
+def pyf_files_job(paths):
+    # returns the results of each file and the stats of all of them
+    options = job_options
+    options.stats = Stats()
+    results = []
+    for path in paths:
+        options.stdout = OutputCollector()
+        options.stderr = OutputCollector()
+        options.didmatch = False
+        options.exit_status = 'not-set'
+        # the parent counts the results of all the files
+        options.results = 0
+        options.done = False
+        if options.cache:
+            options.cache.added = []
+        pyf_file(options, path)
+        # the parent saves what the worker added to the cache
+        added = options.cache.added if options.cache else None
+        results.append((options.stdout.lines, options.stdout.marks, options.stderr.lines,
+                        options.didmatch, options.exit_status, added, options.file_results))
+        if options.exit_status == 'error':
+            break
+    return results, options.stats
+
+
+def pyf_job_results(options, job):
+    results, stats = job.get()
+    options.stats.merge(stats)
+    for result in results:
+        pyf_file_result(options, result)
+    options.stdout.flush_if_due()
+
+
+def pyf_file_result(options, result):
+    out, marks, err, didmatch, exit_status, added, results = result
+    if added:
+        options.cache.update(added)
+    if options.done:
+        return
+    if options.max_results and marks:
+        # only the results still wanted
+        left = options.max_results - options.results
+        if len(marks) > left:
+            out = out[:marks[left]]
+            marks = marks[:left]
+        results = len(marks)
+    options.results += results
+    if options.max_results and options.results >= options.max_results:
+        options.done = True
+    if out:
+        if options.run:
+            # the worker printed the matching path; run the command on it
+            for line in out:
+                print_path(options, line[:-1])
+        else:
+            if options.context and (options.matches or options.lines) and options.didmatch:
+                # the worker did not know about earlier matches
+                # so write the blank line to separate the contexts
+                writeout(options, '')
+            options.stdout.write(''.join(out))
+    if err:
+        options.stderr.write(''.join(err))
+    if didmatch:
+        options.didmatch = True
+    if exit_status == 'error':
+        options.exit_status = 'error'
+
+
+def index_skip(options, path):
+    # True if the index says path cannot match
+    if options.index and options.index.skip(path):
+        if options.debug:
+            debug('index_skip: index skipping file: %s', path)
+        if options.trace:
+            trace('skip', path, reason='index')
+        options.stats.skipped_index += 1
+        return True
+    return False
+
+
+def pyf_dir_paths(options):
+    # the files to search, those in the git index with --git
+    if options.git:
+        from .gitindex import git_paths
+        for path in git_paths(options):
+            if stop_search(options):
+                break
+            if index_skip(options, path):
+                continue
+            yield path
+        return
+
+    for root, dirs, files in pyfwalk(options, options.start_directory):
+        if stop_search(options):
+            break
+
+        for f in files:
+            path = os.path.join(root, f)
+            if index_skip(options, path):
+                continue
+            yield path
+
+
+def pyf_dir_jobs(options):
+    pool = multiprocessing.Pool(options.jobs, initializer=init_job, initargs=(make_job_options(options),))
+    # results are collected in submission order
+    # so the output is the same as a serial search
+    pending = collections.deque()
+    try:
+        chunk = []
+        for path in pyf_dir_paths(options):
+            chunk.append(path)
+            if len(chunk) < job_chunk_size:
+                continue
+            pending.append(pool.apply_async(pyf_files_job, (chunk,)))
+            chunk = []
+            # limit how far the walk runs ahead of the output
+            if len(pending) > 2 * options.jobs:
+                pyf_job_results(options, pending.popleft())
+            if stop_search(options):
+                break
+        if chunk and not stop_search(options):
+            pending.append(pool.apply_async(pyf_files_job, (chunk,)))
+        while pending and not stop_search(options):
+            pyf_job_results(options, pending.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+
+
 def pyf_dir(options):
+    if options.search_pattern and options.jobs > 1:
+        pyf_dir_jobs(options)
+        return
+
+    if options.git:
+        # no directories to print, only the files in the git index
+        for path in pyf_dir_paths(options):
+            if options.search_pattern:
+                pyf_file(options, path)
+            else:
+                print_path(options, path)
+                count_result(options)
+        return
+
     for root, dirs, files in pyfwalk(options, options.start_directory):
-        if options.exit_status == 'error':
+        if stop_search(options):
             break
+        # while the walk finds no files to search
+        options.stdout.flush_if_due()
 
         # handle printing of matching directory name
         if options.filename_pattern and not options.search_pattern:
             for d in dirs:
-                debug('dir = %s' % d)
+                if options.debug:
+                    debug('dir = %s', d)
                 if options.filename_pattern_regex.search(d):
                     print_path(options, os.path.join(root, d))
+                    count_result(options)
+                    if options.done:
+                        return
 
         # search files / print file names
         for f in files:
-            if options.exit_status == 'error':
+            if stop_search(options):
                 break
 
             path = os.path.join(root, f)
             if options.search_pattern:
+                if index_skip(options, path):
+                    continue
                 pyf_file(options, path)
             else:
                 print_path(options, path)
+                count_result(options)
 
 
 def pyf_stdin(options):
     for path in options.stdin.readlines():
-        if options.exit_status == 'error':
+        if stop_search(options):
             break
 
         path = path.strip()
         if path:
+            options.stats.files += 1
             pyf_file(options, path)
 
 
+def pyf_build_index(options):
+    index = Index(options.start_directory)
+    if os.path.exists(options.index_file):
+        try:
+            index.load(options.index_file)
+        except Exception as e:
+            # start again
+            error('pyf_build_index: exception loading %s: %s', options.index_file, e, exc_info=True)
+            index = Index(options.start_directory)
+
+    index_file = os.path.abspath(options.index_file)
+    for root, dirs, files in pyfwalk(options, options.start_directory):
+        if options.exit_status == 'error':
+            return
+        for f in files:
+            path = os.path.join(root, f)
+            if os.path.abspath(path) != index_file:
+                index.add(options, path)
+    index.finish()
+
+    try:
+        index.save(options.index_file)
+    except Exception as e:
+        writerr(options, 'Error saving index %s' % options.index_file, exception=e)
+        return
+    options.index = index
+
+
+def pyf_load_index(options):
+    try:
+        if options.server:
+            index = options.server.load_index(options)
+        else:
+            index = Index(options.start_directory)
+            index.load(options.index_file)
+    except Exception as e:
+        # search without it
+        writerr(options, 'Error loading index %s' % options.index_file, exception=e, set_exit_status=False)
+        return
+    options.index = index
+
+
+def pyf_load_cache(options):
+    if options.server:
+        options.cache = options.server.metadata_cache(options)
+        if options.cache:
+            return
+    # verdicts from another sniff size are not used
+    cache = MetadataCache(options.cache_file, options.cache_size, settings={'sniff_size': options.sniff_size})
+    cache.load()
+    options.cache = cache
+
+
+def pyf_save_cache(options):
+    if options.server and options.server.metadata_cache(options) is options.cache:
+        # saved by the server
+        return
+    try:
+        options.cache.save()
+    except Exception as e:
+        # only slows down the next run
+        error('pyf_save_cache: exception saving %s: %s', options.cache_file, e, exc_info=True)
+
+
 def pyf(options):
-    if options.files:
+    if options.build_index:
+        pyf_build_index(options)
+        if not options.search_pattern:
+            if options.exit_status == 'not-set':
+                options.exit_status = 'ok'
+            return
+    elif options.use_index and options.search_pattern:
+        pyf_load_index(options)
+    if options.index:
+        options.index.query(options)
+    if options.search_pattern and not options.no_cache:
+        pyf_load_cache(options)
+    if options.run:
+        options.runner = Runner(options)
+
+    if options.watch:
+        from .watch import watch
+        watch(options)
+    elif options.files:
         for f in options.files:
-            if options.exit_status == 'error':
+            if stop_search(options):
                 break
 
             if f == '-':
                 pyf_stdin(options)
             else:
+                options.stats.files += 1
                 pyf_file(options, f)
     else:
         pyf_dir(options)
 
+    if options.runner:
+        # the last batch and the commands still running
+        options.runner.finish()
+        if options.runner.failed:
+            options.exit_status = 'error'
+    if options.cache:
+        pyf_save_cache(options)
+    options.stats.results = options.results
+
+
+def pyf_print_stats(options):
+    try:
+        if options.stats_text:
+            options.stderr.write(options.stats.format() + '\n')
+        if options.stats_json:
+            options.stderr.write(options.stats.format_json() + '\n')
+        options.stderr.flush()
+    except Exception as e:
+        error('pyf_print_stats: exception: %s', e, exc_info=True)
+
+
+exit_statuses = {
+    'ok': 0,
+    'match': 0,
+    'no-match': 1,
+    'error': 2,
+    'not-set': -1
+}
+
 
 def main(argv, stdin=None, stdout=None, stderr=None):
-    from .options import parse_opts
+    if '--client' in argv:
+        # the server parses the options
+        from .server import client
+        return client(argv, stdin=stdin, stdout=stdout, stderr=stderr)
 
-    exit_statuses = {
-        'match': 0,
-        'no-match': 1,
-        'error': 2,
-        'not-set': -1
-    }
+    from .options import parse_opts
 
     options = parse_opts(argv, stdin=stdin, stdout=stdout, stderr=stderr)
     if not options:
@@ -316,8 +1375,28 @@ def main(argv, stdin=None, stdout=None, stderr=None):
 
     init_logging(options)
 
-    debug('argv = %s' % argv)
-    debug('options = %s' % options)
+    debug('argv = %s', argv)
+    debug('options = %s', options)
+
+    if options.serve:
+        from .server import serve
+        exit_status = serve(options)
+    else:
+        exit_status = pyf_main(options)
+
+    deinit_logging()
+
+    return exit_status
+
+
+def pyf_main(options):
+    # search with the parsed options, returns the exit status
+    if options.trace:
+        try:
+            open_trace(options.trace)
+        except Exception as e:
+            writerr(options, 'Error opening trace file %s' % options.trace, exception=e)
+            return exit_statuses['error']
 
     # do the match
     try:
@@ -330,6 +1409,7 @@ def main(argv, stdin=None, stdout=None, stderr=None):
         writerr(options, 'pyf exception', exception=e)
         options.exit_status = 'error'
     finally:
+        options.stdout.flush()
         # tidy up and wait for pager if used
         if options.pager:
             sys.stdout.flush()
@@ -342,13 +1422,17 @@ def main(argv, stdin=None, stdout=None, stderr=None):
             options.stderr.close()
             options.pager.wait()
 
+    if options.stats_text or options.stats_json:
+        pyf_print_stats(options)
+
     if options.exit_status == 'not-set':
         if options.didmatch:
             options.exit_status = 'match'
         else:
             options.exit_status = 'no-match'
 
-    deinit_logging()
+    if options.trace:
+        close_trace()
 
     return exit_statuses[options.exit_status]
 
@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# pyf --serve: answer searches sent by pyf --client over a unix socket
+# what earlier searches found out is kept in memory:
+# - directory listings, used again while the directory's stat is unchanged
+# - the metadata cache, keyed by each file's stat
+# - loaded indexes, used again while the index file's stat is unchanged
+# the listings and indexes are dropped, least recently used first,
+# to keep about --server-memory megabytes
+# searches are answered one at a time, each in the client's directory
+#
+# the client sends one json line: {"argv": [...], "cwd": ..., "isatty": ..., "stdin": ...}
+# the server sends json lines back: {"out": text}, {"err": text} and last {"exit": status}
+
+import collections
+import contextlib
+import errno
+import io
+import json
+import os
+import os.path
+import signal
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from .cache import MetadataCache
+from .index import Index
+from .logger import debug, error
+from .pyf import exit_statuses, pyf_main, writerr
+
+# estimated bytes of memory of a directory entry and of an index per byte of its file
+entry_size = 120
+index_size_factor = 4
+
+# a directory changed this recently may change again within the same mtime
+# so its listing is not kept
+racy_seconds = 2
+
+# seconds between saves of the metadata cache
+cache_save_interval = 60
+
+# seconds a client has to send its search, searches are answered one at a
+# time so a client sending nothing would keep the others waiting
+request_timeout = 5
+
+
+class Terminated(BaseException):
+    # raised by SIGTERM and SIGINT, not caught by a search like KeyboardInterrupt
+    pass
+
+
+def terminate(signum, frame):
+    raise Terminated()
+
+
+def socket_dir():
+    # the directory of the default socket
+    # without XDG_RUNTIME_DIR, one of this user's in the temporary directory,
+    # a socket there could be taken first by another user
+    return os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), 'pyf-%d' % os.getuid())
+
+
+def socket_default():
+    return os.path.join(socket_dir(), 'pyf-%d.sock' % os.getuid())
+
+
+def make_socket_dir(path):
+    # create the directory path, only for this user, if it does not exist
+    # returns an error message if it is not this user's alone
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError as e:
+        return 'Error creating %s: %s' % (path, e)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return 'Error: %s is not a directory only this user can use' % path
+    return None
+
+
+def peer_uid(sock, path):
+    # the user of the process at the other end of the connected unix socket sock
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        return uid
+    # elsewhere the owner of the socket's file
+    return os.stat(path).st_uid
+
+
+class Entry(object):
+    # a kept directory entry, like an os.DirEntry
+    __slots__ = ('name', 'path', 'dir', 'symlink')
+
+    def __init__(self, name, path, is_dir, is_symlink):
+        self.name = name
+        self.path = path
+        self.dir = is_dir
+        self.symlink = is_symlink
+
+    def is_dir(self):
+        return self.dir
+
+    def is_symlink(self):
+        return self.symlink
+
+
+class Listing(list):
+    # entries used like the iterator os.scandir returns
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class Server(object):
+    def __init__(self, options, path):
+        self.options = options
+        self.path = path
+        self.budget = options.server_memory * 1024 * 1024
+        # key -> (stamp, value, size), least recently used first
+        self.kept = collections.OrderedDict()
+        self.size = 0
+        # listings are made by the walk threads too
+        self.lock = threading.Lock()
+        self.cache = None
+        if not options.no_cache:
+            self.cache = MetadataCache(options.cache_file, options.cache_size,
+                                       settings={'sniff_size': options.sniff_size})
+            self.cache.load()
+        self.saved = time.monotonic()
+
+    def get(self, key, stamp):
+        with self.lock:
+            entry = self.kept.get(key)
+            if entry is None or entry[0] != stamp:
+                return None
+            self.kept.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, stamp, value, size):
+        with self.lock:
+            old = self.kept.pop(key, None)
+            if old:
+                self.size -= old[2]
+            if size > self.budget:
+                return
+            self.kept[key] = (stamp, value, size)
+            self.size += size
+            while self.size > self.budget:
+                key, entry = self.kept.popitem(last=False)
+                self.size -= entry[2]
+
+    def scandir(self, path):
+        # the entries of the directory path, as os.scandir would list them
+        st = os.stat(path)
+        key = ('dir', os.path.abspath(path))
+        stamp = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        names = self.get(key, stamp)
+        if names is None:
+            names = []
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    names.append((entry.name, is_dir, entry.is_symlink()))
+            if time.time() - st.st_mtime > racy_seconds:
+                self.put(key, stamp, names, sum(entry_size + 2 * len(n[0]) for n in names))
+        # the paths are joined to path as given in this search
+        return Listing(Entry(name, os.path.join(path, name), is_dir, is_symlink) for name, is_dir, is_symlink in names)
+
+    def load_index(self, options):
+        st = os.stat(options.index_file)
+        key = ('index', os.path.abspath(options.index_file), os.path.abspath(options.start_directory))
+        stamp = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        index = self.get(key, stamp)
+        if index is None:
+            index = Index(options.start_directory)
+            index.load(options.index_file)
+            self.put(key, stamp, index, st.st_size * index_size_factor)
+        else:
+            # the paths are relative to the start directory as given in this search
+            index.root = options.start_directory
+        return index
+
+    def metadata_cache(self, options):
+        # the kept cache if the search would use the same one
+        if self.cache and options.cache_file == self.cache.fname and options.cache_size == self.cache.max_entries \
+                and options.sniff_size == self.options.sniff_size:
+            return self.cache
+        return None
+
+    def save_cache(self):
+        if not self.cache:
+            return
+        try:
+            self.cache.save()
+        except Exception as e:
+            error('Server.save_cache: exception saving %s: %s', self.cache.fname, e, exc_info=True)
+        self.saved = time.monotonic()
+
+    def handle(self, conn):
+        if peer_uid(conn, self.path) != os.getuid():
+            debug('Server.handle: refusing a client of another user')
+            return
+        out = ClientStream(conn, 'out')
+        err = ClientStream(conn, 'err')
+        try:
+            conn.settimeout(request_timeout)
+            with conn.makefile('rb') as fp:
+                request = json.loads(fp.readline().decode('utf-8'))
+            # the results are sent as fast as the client reads them
+            conn.settimeout(None)
+            out.tty = bool(request.get('isatty'))
+            exit_status = self.search(request, out, err)
+            out.send({'exit': exit_status})
+        except socket.timeout:
+            error('Server.handle: no search sent in %s seconds', request_timeout)
+        except Exception as e:
+            error('Server.handle: exception: %s', e, exc_info=True)
+        if time.monotonic() - self.saved > cache_save_interval:
+            self.save_cache()
+
+    def search(self, request, out, err):
+        from .options import parse_opts
+
+        try:
+            os.chdir(request['cwd'])
+        except OSError as e:
+            err.write('Error changing to directory %s: %s\n' % (request['cwd'], e))
+            return exit_statuses['error']
+        stdin = io.StringIO(request.get('stdin') or '')
+        try:
+            # argparse writes its usage, errors and help to sys.stdout and sys.stderr
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                options = parse_opts(['-N'] + request['argv'], stdin=stdin, stdout=out, stderr=err)
+        except SystemExit as e:
+            return e.code
+        if not options:
+            return exit_statuses['error']
+        # -r would run the command in the server, not where the client is
+        for value, name in ((options.serve, '--serve'), (options.watch, '--watch'), (options.run, '-r')):
+            if value:
+                writerr(options, 'Error: %s cannot be sent to the server.' % name)
+                return exit_statuses['error']
+        debug('Server.search: %s in %s', request['argv'], request['cwd'])
+        options.server = self
+        return pyf_main(options)
+
+
+class ClientStream(io.TextIOBase):
+    # stdout or stderr of a search, sent to the client
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.tty = False
+        self.broken = False
+
+    def send(self, message):
+        self.conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+    def write(self, s):
+        if self.broken:
+            return len(s)
+        try:
+            self.send({self.name: s})
+        except OSError:
+            # the client has gone, the output buffer stops the search
+            self.broken = True
+            raise BrokenPipeError(errno.EPIPE, os.strerror(errno.EPIPE))
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.tty
+
+
+def serve(options):
+    path = options.socket
+    if not path:
+        path = socket_default()
+        message = make_socket_dir(os.path.dirname(path))
+        if message:
+            writerr(options, message)
+            return exit_statuses['error']
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        # another server or one that did not clean up
+        try:
+            sock.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            sock.close()
+            writerr(options, 'Error: a pyf server is already running at %s' % path)
+            return exit_statuses['error']
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # only for this user
+    umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    except OSError as e:
+        writerr(options, 'Error binding to %s' % path, exception=e)
+        return exit_statuses['error']
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+
+    server = Server(options, path)
+    # stop cleanly when killed or interrupted, also during a search
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+    debug('serve: listening at %s', path)
+    try:
+        while True:
+            conn, addr = sock.accept()
+            with conn:
+                server.handle(conn)
+    except Terminated:
+        pass
+    finally:
+        sock.close()
+        os.unlink(path)
+        server.save_cache()
+    return exit_statuses['ok']
+
+
+def client(argv, stdin=None, stdout=None, stderr=None):
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    # --client and --socket are for the client, the rest for the server
+    args = []
+    path = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--socket' and i + 1 < len(argv):
+            path = argv[i + 1]
+            i += 1
+        elif arg.startswith('--socket='):
+            path = arg[len('--socket='):]
+        elif arg != '--client':
+            args.append(arg)
+        i += 1
+    path = path or socket_default()
+
+    request = {'argv': args, 'cwd': os.getcwd(), 'isatty': stdout.isatty()}
+    # -f - reads the paths from stdin
+    if '-' in args:
+        request['stdin'] = stdin.read()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        stderr.write('Error connecting to the pyf server at %s: %s\n' % (path, e))
+        return exit_statuses['error']
+
+    exit_status = exit_statuses['error']
+    with sock:
+        # the query, with its paths and stdin, only goes to this user's server
+        try:
+            uid = peer_uid(sock, path)
+        except OSError as e:
+            stderr.write('Error checking the pyf server at %s: %s\n' % (path, e))
+            return exit_status
+        if uid != os.getuid():
+            stderr.write('Error: the pyf server at %s is run by another user (uid %d)\n' % (path, uid))
+            return exit_status
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as fp:
+            for line in fp:
+                message = json.loads(line.decode('utf-8'))
+                if 'out' in message:
+                    stdout.write(message['out'])
+                    stdout.flush()
+                elif 'err' in message:
+                    stderr.write(message['err'])
+                    stderr.flush()
+                elif 'exit' in message:
+                    exit_status = message['exit']
+    return exit_status
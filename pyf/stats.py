@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# counters and stage timings of a search, printed with --stats
+# they are always kept, an attribute increment per file or directory entry
+# and a time.perf_counter call around each stage of searching a file
+# the worker processes and walk threads count in their own Stats,
+# merged by the parent
+
+import json
+
+# what was counted, in the order printed
+counters = (
+    'dirs',
+    'files',
+    'skipped_dirs_pattern',
+    'skipped_files_pattern',
+    'skipped_filename_pattern',
+    'skipped_ignore',
+    'skipped_index',
+    'skipped_binary',
+    'unreadable',
+    'searched',
+    'bytes_read',
+    'matched_files',
+    'results',
+)
+
+# the stages timed, the seconds are summed over the worker processes
+# walk: listing directories, open: opening files and the cache,
+# sniff: the binary check, read: reading and decoding,
+# match: searching, including the mapped and streamed files,
+# output: writing to stdout
+stages = ('walk', 'open', 'sniff', 'read', 'match', 'output')
+
+
+class Stats(object):
+    __slots__ = counters + tuple('time_%s' % s for s in stages)
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def merge(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def as_dict(self):
+        return {
+            'counters': dict((name, getattr(self, name)) for name in counters),
+            'seconds': dict((s, round(getattr(self, 'time_%s' % s), 6)) for s in stages),
+        }
+
+    def format(self):
+        lines = ['pyf stats:']
+        for name in counters:
+            lines.append('  %-26s %12d' % (name.replace('_', ' '), getattr(self, name)))
+        for s in stages:
+            lines.append('  %-26s %12.3f' % ('seconds %s' % s, getattr(self, 'time_%s' % s)))
+        return '\n'.join(lines)
+
+    def format_json(self):
+        return json.dumps(self.as_dict(), sort_keys=True)
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# pyf --watch: search, then search the files that change
+# the results of each file are kept, when it changes it is searched again
+# and the results it lost are printed as "- result", those it gained as
+# "+ result"; the results of a removed file are all printed as removed
+# changes are found with inotify, through ctypes, with a watch on each
+# directory walked, waiting without using the CPU while nothing changes
+# where inotify cannot be used, or with --watch-poll, the start directory
+# is walked every few seconds and each file's stat compared
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+import time
+
+from .ignore import ignore_file_names, path_ignored
+from .logger import debug
+from .pyf import OutputCollector, pyf_file, pyfwalk, writeout, writerr
+
+# seconds between walks when inotify cannot be used
+poll_interval_default = 2.0
+
+# seconds to wait after a change for those that come with it
+# e.g. an editor writing a file in several steps
+settle_seconds = 0.1
+
+# from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# attrib for a file becoming readable or not
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_ONLYDIR
+
+# struct inotify_event without the name that follows it
+event_struct = struct.Struct('iIII')
+
+
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # watch descriptor -> the directory's path, as the walk joined it
+        self.paths = {}
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        self.paths[wd] = path
+
+    def forget(self, path):
+        # the directories below path, which has gone
+        prefix = os.path.join(path, '')
+        for wd, p in list(self.paths.items()):
+            if p == path or p.startswith(prefix):
+                del self.paths[wd]
+
+    def read(self, timeout):
+        # (directory, name, mask) of each event, waiting up to timeout
+        # seconds for the first, for ever if None
+        # ('', '', IN_Q_OVERFLOW) when some were lost
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        i = 0
+        while i < len(data):
+            wd, mask, cookie, length = event_struct.unpack_from(data, i)
+            i += event_struct.size
+            name = os.fsdecode(data[i:i + length].rstrip(b'\0'))
+            i += length
+            if mask & IN_Q_OVERFLOW:
+                events.append(('', '', mask))
+            elif mask & IN_IGNORED:
+                # removed, or the directory has gone
+                self.paths.pop(wd, None)
+            elif wd in self.paths:
+                events.append((self.paths[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def file_stamp(path):
+    # what changes when path is changed, None if it has gone
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_mode)
+
+
+def diff_lines(old, new):
+    # the lines of old not in new and of new not in old, in order
+    counts = collections.Counter(new)
+    removed = []
+    for line in old:
+        if counts[line]:
+            counts[line] -= 1
+        else:
+            removed.append(line)
+    counts = collections.Counter(old)
+    added = []
+    for line in new:
+        if counts[line]:
+            counts[line] -= 1
+        else:
+            added.append(line)
+    return removed, added
+
+
+class Watch(object):
+    def __init__(self, options):
+        self.options = options
+        # path -> (stamp, result lines)
+        self.results = {}
+        self.inotify = None
+        # set when there are more directories than inotify watches
+        self.too_many = False
+        # an error was printed, pyf exits with an error
+        self.failed = False
+
+    def emit(self, sign, lines):
+        for line in lines:
+            writeout(self.options, '%s %s' % (sign, line))
+
+    def wanted_file(self, name):
+        # as the walk would list it
+        options = self.options
+        if options.skip_files_pattern and options.skip_files_pattern_regex.search(name):
+            return False
+        return bool(options.filename_pattern_regex.search(name))
+
+    def wanted_dir(self, name):
+        options = self.options
+        return not (options.skip_dirs_pattern and options.skip_dirs_pattern_regex.search(name))
+
+    def search(self, path):
+        # the result lines of path
+        options = self.options
+        stdout = options.stdout
+        didmatch = options.didmatch
+        options.stdout = OutputCollector()
+        # no blank line before the first context of the file
+        options.didmatch = False
+        try:
+            pyf_file(options, path)
+            lines = [line[:-1] for line in options.stdout.lines if line != '\n']
+        finally:
+            options.stdout = stdout
+            options.didmatch = options.didmatch or didmatch
+        if options.exit_status == 'error':
+            # printed, keep watching
+            self.failed = True
+            options.exit_status = 'not-set'
+        return lines
+
+    def update(self, path, force=False):
+        # search path again if it changed, printing the results it lost and gained
+        stamp = file_stamp(path)
+        old = self.results.get(path)
+        if stamp is None:
+            if old:
+                del self.results[path]
+                self.emit('-', old[1])
+            return
+        if old and old[0] == stamp and not force:
+            return
+        if self.options.index and self.options.index.skip(path):
+            self.options.stats.skipped_index += 1
+            lines = []
+        else:
+            lines = self.search(path)
+        self.results[path] = (stamp, lines)
+        if old:
+            removed, added = diff_lines(old[1], lines)
+            self.emit('-', removed)
+            self.emit('+', added)
+        else:
+            self.emit('+', lines)
+
+    def remove(self, path):
+        # the results of the files below path, which has gone
+        prefix = os.path.join(path, '')
+        for p in sorted(p for p in self.results if p.startswith(prefix)):
+            self.emit('-', self.results.pop(p)[1])
+        if self.inotify:
+            self.inotify.forget(path)
+
+    def scan(self, top):
+        # walk top, searching the files that changed and watching the directories
+        options = self.options
+        seen = set()
+        for root, dirs, files in pyfwalk(options, top):
+            if options.done:
+                return
+            if self.inotify and not self.too_many:
+                try:
+                    self.inotify.add(root)
+                except OSError as e:
+                    if e.errno == errno.ENOSPC:
+                        self.too_many = True
+                    elif options.debug:
+                        debug('Watch.scan: cannot watch %s: %s', root, e)
+            for f in files:
+                path = os.path.join(root, f)
+                seen.add(path)
+                self.update(path)
+                if options.done:
+                    return
+        if options.exit_status == 'error':
+            # the walk stopped, e.g. a directory went while it was listed
+            self.failed = True
+            options.exit_status = 'not-set'
+            return
+        # gone, or no longer listed by the walk
+        prefix = os.path.join(top, '')
+        for path in sorted(p for p in self.results if p.startswith(prefix) and p not in seen):
+            self.emit('-', self.results.pop(path)[1])
+
+    def changed(self, events):
+        # search again the files and directories changed
+        changes = collections.OrderedDict()
+        for root, name, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                # some changes were lost, look at everything
+                changes = collections.OrderedDict()
+                changes[self.options.start_directory] = True
+                break
+            if not name or mask & IN_DELETE_SELF:
+                continue
+            if self.options.gitignore and name in ignore_file_names:
+                # what the directory's walk lists changed
+                changes[root] = True
+            elif mask & IN_ISDIR:
+                if self.wanted_dir(name):
+                    changes[os.path.join(root, name)] = True
+            elif self.wanted_file(name):
+                changes.setdefault(os.path.join(root, name), False)
+
+        for path, is_dir in changes.items():
+            if self.options.debug:
+                debug('Watch.changed: %s', path)
+            if self.options.gitignore and path_ignored(self.options, path, is_dir):
+                # as if it had gone
+                if is_dir:
+                    self.remove(path)
+                elif path in self.results:
+                    self.emit('-', self.results.pop(path)[1])
+                continue
+            if is_dir:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    self.scan(path)
+                else:
+                    self.remove(path)
+            elif not os.path.isdir(path):
+                # a symlink to a directory is not descended
+                self.update(path, force=True)
+            if self.options.done:
+                return
+
+    def watch_inotify(self):
+        while not self.options.done:
+            events = self.inotify.read(None)
+            if not events:
+                continue
+            time.sleep(settle_seconds)
+            more = self.inotify.read(0)
+            while more:
+                events.extend(more)
+                more = self.inotify.read(0)
+            self.changed(events)
+            self.options.stdout.flush()
+
+    def watch_poll(self, interval):
+        while not self.options.done:
+            time.sleep(interval)
+            self.scan(self.options.start_directory)
+            self.options.stdout.flush()
+
+    def run(self):
+        options = self.options
+        if options.watch_poll is None:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                # not linux
+                if options.debug:
+                    debug('Watch.run: no inotify: %s', e)
+
+        self.scan(options.start_directory)
+        options.stdout.flush()
+        if options.done:
+            return
+
+        if self.inotify and self.too_many:
+            writerr(options, 'Too many directories to watch with inotify, looking for changes every %s seconds'
+                    % poll_interval_default, set_exit_status=False)
+            self.inotify.close()
+            self.inotify = None
+        if self.inotify:
+            self.watch_inotify()
+        else:
+            self.watch_poll(options.watch_poll or poll_interval_default)
+
+
+def watch(options):
+    w = Watch(options)
+    try:
+        w.run()
+    except KeyboardInterrupt:
+        # how watching stops
+        pass
+    finally:
+        if w.inotify:
+            w.inotify.close()
+        options.stdout.flush()
+    if w.failed:
+        options.exit_status = 'error'
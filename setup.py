@@ -69,8 +69,13 @@ classifiers = [
     'License :: OSI Approved :: MIT License',
     'Natural Language :: English',
     'Operating System :: POSIX',
-    "Programming Language :: Python :: 2.7",
-    "Programming Language :: Python :: 3.4",
+    "Programming Language :: Python :: 3",
+    "Programming Language :: Python :: 3 :: Only",
+    "Programming Language :: Python :: 3.7",
+    "Programming Language :: Python :: 3.8",
+    "Programming Language :: Python :: 3.9",
+    "Programming Language :: Python :: 3.10",
+    "Programming Language :: Python :: 3.11",
     'Topic :: Software Development :: Build Tools',
     'Topic :: System :: Systems Administration',
     'Topic :: Text Processing',
@@ -95,6 +100,7 @@ setup(
     platforms=platforms,
 
     packages=find_packages(exclude=['tests']),
+    python_requires='>=3.7',
 
     entry_points={
         'console_scripts': [
@@ -2,20 +2,38 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
+import asyncio
+import concurrent.futures
+import errno
+import json
 import os
 import os.path
 import pytest
+import shutil
+import signal
+import socket
 import stat
 import subprocess
 import sys
+import threading
+import time
 
 if sys.version_info.major == 2:
     from StringIO import StringIO
 else:
-    from io import StringIO
+    from io import BytesIO, StringIO
 
+import pyf
+import pyf.api
 import pyf.options
+import pyf.cache
 import pyf.filetype
+import pyf.ignore
+import pyf.index
+import pyf.output
+import pyf.server
+import pyf.stats
+import pyf.watch
 
 
 class Cmd(object):
@@ -138,6 +156,29 @@ cmds = [
 
     # running a command
     Cmd('-d tests/data/simple -r basename one'),
+    Cmd('-d tests/data/simple --run-batch -P 2 -r true one'),
+    Cmd('-d tests/data/simple -r false one', stderr=["Command 'false' exited with status 1"] * 3, exitcode=2),
+    Cmd('-d tests/data/simple -P 2 -r false one', stderr=["Command 'false' exited with status 1"] * 3, exitcode=2),
+    Cmd('-d tests/data/simple --run-batch -r false one', stderr=["Command 'false' exited with status 1"], exitcode=2),
+    Cmd('-P 0 -r true one', stderr=[pyf.options.max_procs_error_message % 0], exitcode=2),
+
+    # replacing
+    Cmd('-d tests/data/context --replace 9 --dry-run nine', stdout=[
+        '--- tests/data/context/context.txt', '+++ tests/data/context/context.txt', '@@ -6,8 +6,8 @@',
+        ' six', ' seven', ' eight', '-nine', '+9', ' ten', '-nine', '+9', ' eight', ' seven']),
+    Cmd('-d tests/data/context --replace 9 --dry-run nothing', exitcode=1),
+    Cmd('--replace x -v one', stderr=[pyf.options.replace_invert_error_message], exitcode=2),
+    Cmd('--replace x -e one -e two', stderr=[pyf.options.replace_patterns_error_message], exitcode=2),
+    Cmd('--dry-run one', stderr=[pyf.options.dry_run_error_message], exitcode=2),
+
+    Cmd('--untracked one', stderr=[pyf.options.untracked_error_message], exitcode=2),
+
+    # watching
+    Cmd('--watch -n txt', stderr=[pyf.options.watch_pattern_error_message], exitcode=2),
+    Cmd('--watch -r true one', stderr=[pyf.options.watch_error_message % '-r'], exitcode=2),
+    Cmd('--watch --max-results 1 one', stderr=[pyf.options.watch_error_message % '--max-results'], exitcode=2),
+    Cmd('--watch-poll 1 one', stderr=[pyf.options.watch_poll_watch_error_message], exitcode=2),
+    Cmd('--watch --watch-poll 0 one', stderr=[pyf.options.watch_poll_error_message % 0.0], exitcode=2),
 
     # bad regex
     Cmd('-e %s' % bad_regex, stderr=[pyf.options.regex_compile_error_message % {'type': 'search-pattern', 'regex': bad_regex}], exitcode=2),
@@ -161,6 +202,8 @@ cmds = [
     Cmd('-f tests/data/simple/01.txt one', stdout=['tests/data/simple/01.txt']),
     Cmd('-f tests/data/simple/02.txt one', stdout=['tests/data/simple/02.txt']),
     Cmd('-f tests/data/simple/01.txt two', exitcode=1),
+    Cmd('-f tests/data/simple one', exitcode=1),
+    Cmd('-B -f tests/data/simple one', stderr=['Error opening tests/data/simple'], exitcode=2),
     Cmd('-f - one', stdin=['tests/data/simple/01.txt', 'tests/data/simple/02.txt'], stdout=['tests/data/simple/01.txt', 'tests/data/simple/02.txt']),
 
     # matching groups
@@ -295,9 +338,157 @@ cmds = [
         'seven'
     ]),
 
+    # matches are per line when searching the whole file
+    Cmd('-d tests/data/context -p -s -l ^five$', stdout=['5: five']),
+    Cmd('-d tests/data/context -p -s -l e\\s+t', exitcode=1),
+    Cmd('-d tests/data/context -p -s -l n\\s*e', stdout=['1: one', '9: nine', '11: nine']),
+    Cmd('-d tests/data/context -p -s -l ^nine$', stdout=['9: nine', '11: nine']),
+    Cmd('-d tests/data/context -p -s -l (\\w+)ven', stdout=['7: seven', '13: seven']),
+    Cmd('-d tests/data/context -p -s ten\\d', exitcode=1),
+    Cmd('-d tests/data/context -v -l zero', stdout=['13: tests/data/context/context.txt']),
+
+    # large files are memory mapped
+    Cmd("--large-file-size 0 -d tests/data/complex -s -l -m (\\d+)x\\d+", stdout=[
+        '1: 57',
+        '2: 72',
+        '3: 114',
+        '4: 512',
+        '5: 200',
+        '6: 150',
+        '7: 150',
+        '8: 150',
+        '9: 500',
+        '10: 800',
+        '11: 150',
+        '12: 150',
+    ]),
+    Cmd('--large-file-size 0 -d tests/data/context -p -s -l -c 2 nine', stdout=[
+        '7: seven',
+        '8: eight',
+        '9: nine',
+        '10: ten',
+        '11: nine',
+        '',
+        '9: nine',
+        '10: ten',
+        '11: nine',
+        '12: eight',
+        '13: seven',
+    ]),
+    Cmd('--large-file-size 0 -d tests/data/context -p -s -l -c 3 one', stdout=[
+        '1: one',
+        '2: two',
+        '3: three',
+        '4: four',
+    ]),
+
+    # large files that cannot be memory mapped are read line by line
+    Cmd('--large-file-size 0 -d tests/data/context -p -s -l -c 2 s.ven', stdout=[
+        '5: five',
+        '6: six',
+        '7: seven',
+        '8: eight',
+        '9: nine',
+        '',
+        '11: nine',
+        '12: eight',
+        '13: seven',
+    ]),
+    Cmd('--large-file-size 0 -d tests/data/context -v -p -s -l -c 1 [a-z]{4}', stdout=[
+        '1: one',
+        '2: two',
+        '',
+        '1: one',
+        '2: two',
+        '3: three',
+        '',
+        '5: five',
+        '6: six',
+        '7: seven',
+        '',
+        '9: nine',
+        '10: ten',
+        '11: nine',
+    ]),
+    Cmd('--large-file-size 0 -d tests/data/context -v -l zero', stdout=['13: tests/data/context/context.txt']),
+    Cmd('--large-file-size 0 -d tests/data/context -v -l seven', exitcode=1),
+
+    # stopping early
+    Cmd('-d tests/data/context -p -s -l --max-count 2 e', stdout=['1: one', '3: three']),
+    Cmd('-d tests/data/context -p -s -l --max-results 1 nine', stdout=['9: nine']),
+    Cmd('-d tests/data/context -p -s -l --max-results 1 -j 2 nine', stdout=['9: nine']),
+    Cmd('-d tests/data/context -p -s -l -v --max-count 1 e', stdout=['2: two']),
+    Cmd('-d tests/data/context -p -s -l -c 1 --max-count 1 --large-file-size 0 n.ne', stdout=['8: eight', '9: nine', '10: ten']),
+    Cmd('-d tests/data/simple -n txt --max-results 1', stdout=['tests/data/simple/01.txt']),
+    Cmd('--max-count 0 one', stderr=[pyf.options.max_count_error_message % 0], exitcode=2),
+    Cmd('--max-results -1 one', stderr=[pyf.options.max_results_error_message % -1], exitcode=2),
+
+    # several patterns
+    Cmd('-d tests/data/context -e five -e nine', stdout=['tests/data/context/context.txt']),
+    Cmd('-d tests/data/context -e five -e nine -e zero -p -s -l', stdout=['5: five: five', '9: nine: nine', '11: nine: nine']),
+    Cmd('-d tests/data/context -e f.ve -e n(i)ne -m -s', stdout=['f.ve: five', 'n(i)ne: i', 'n(i)ne: i']),
+    Cmd('-d tests/data/context -e (e)v\\1 -e one -s -l', stdout=['1: tests/data/context/context.txt: one', '7: tests/data/context/context.txt: (e)v\\1', '13: tests/data/context/context.txt: (e)v\\1']),
+    Cmd('-d tests/data/context --patterns-file tests/data/patterns/patterns.txt -p -s -c 1', stdout=[
+        'four',
+        'five: five',
+        'six',
+        '',
+        'eight',
+        'n(i)ne: nine',
+        'ten',
+        '',
+        'ten',
+        'n(i)ne: nine',
+        'eight',
+    ]),
+    Cmd('--patterns-file some-non-existent-file', stderr=[pyf.options.patterns_file_error_message % 'some-non-existent-file'], exitcode=2),
+
     # chinese
     Cmd('-d tests/data/chinese 你好', stdout=['tests/data/chinese/chinese.txt']),
 
+    # worker processes
+    Cmd('-j 2 -d tests/data/chinese 你好', stdout=['tests/data/chinese/chinese.txt']),
+    Cmd("-j 2 -d tests/data/complex -s -l -m \\d+x\\d+", stdout=[
+        '1: 57x57',
+        '2: 72x72',
+        '3: 114x114',
+        '4: 512x512',
+        '5: 200x200',
+        '6: 150x150',
+        '7: 150x150',
+        '8: 150x150',
+        '9: 500x500',
+        '10: 800x600',
+        '11: 150x150',
+        '12: 150x150',
+    ]),
+    Cmd('-j 2 -d tests/data/context -p -s -c 3 nine', stdout=[
+        'six',
+        'seven',
+        'eight',
+        'nine',
+        'ten',
+        'nine',
+        'eight',
+        '',
+        'eight',
+        'nine',
+        'ten',
+        'nine',
+        'eight',
+        'seven'
+    ]),
+    Cmd('-j 2 -d tests/data/simple four', exitcode=1),
+    Cmd('-j -1 one', stderr=[pyf.options.jobs_error_message % -1], exitcode=2),
+
+    # walk threads
+    Cmd('--walk-threads 2 -d tests/data a-deeply-nested-file', stdout=['tests/data/dir01/dir02/dir03/dir04/a-deeply-nested-file']),
+    Cmd('--walk-threads 2 -d tests/data -n simple', stdout=['tests/data/simple']),
+    Cmd('--walk-threads 2 -j 2 -d tests/data/complex -s 800x600', stdout=['tests/data/complex/sizes.txt']),
+    Cmd('--sniff-size 0 one', stderr=[pyf.options.sniff_size_error_message % 0], exitcode=2),
+    Cmd('--sniff-size 64 -d tests/data/context -l nine', stdout=['9: tests/data/context/context.txt', '11: tests/data/context/context.txt']),
+    Cmd('--walk-threads -1 one', stderr=[pyf.options.walk_threads_error_message % -1], exitcode=2),
+
 ]
 
 cmds_as_process = [
@@ -310,6 +501,18 @@ cmds_as_process = [
 ]
 
 
+@pytest.fixture(scope='module', autouse=True)
+def cache_home(tmp_path_factory):
+    # keep the cache file of the tests out of the user's cache directory
+    old = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = str(tmp_path_factory.mktemp('cache'))
+    yield
+    if old is None:
+        del os.environ['XDG_CACHE_HOME']
+    else:
+        os.environ['XDG_CACHE_HOME'] = old
+
+
 @pytest.fixture(scope='module')
 def inaccessible_files():
     # make dangling symlink
@@ -348,6 +551,694 @@ class TestCmd(object):
         assert r.exitcode == cmd.exitcode
 
 
+class TestWalk(object):
+    @pytest.mark.parametrize('replace', [False, True])
+    def test_dir_gone(self, tmpdir, replace):
+        # a directory removed after its parent was listed is skipped
+        for d in ('a', 'b', 'c'):
+            tmpdir.join(d, 'f.txt').write('x\n', ensure=True)
+        options = pyf.api.make_options('x', str(tmpdir), {})
+        roots = []
+        for root, dirs, files in pyf.pyf.pyfwalk(options, str(tmpdir)):
+            roots.append(root)
+            if root == str(tmpdir):
+                tmpdir.join('b').remove()
+                if replace:
+                    tmpdir.join('b').write('x\n')
+        # in the order the directory lists them
+        assert sorted(roots) == [str(tmpdir)] + [str(tmpdir.join(d)) for d in ('a', 'c')]
+        assert options.exit_status != 'error'
+        message = 'Not a directory' if replace else 'File does not exist'
+        assert options.stderr.lines == ['%s: %s\n' % (message, tmpdir.join('b'))]
+
+
+class TestIndex(object):
+    def run(self, args):
+        stdout = StringIO()
+        stderr = StringIO()
+        exitcode = pyf.pyf.main(['-N'] + args, stdout=stdout, stderr=stderr)
+        return exitcode, stdout.getvalue().split(), stderr.getvalue()
+
+    def test_trigrams(self, monkeypatch):
+        data = b'abcdefghij\nklm'
+        expected = set(data[i:i + 3] for i in range(len(data) - 2))
+        assert pyf.index.trigrams(data) == expected
+        # across the chunks
+        monkeypatch.setattr(pyf.index, 'trigram_chunk_size', 4)
+        assert pyf.index.trigrams(data) == expected
+        assert pyf.index.trigrams(b'ab') == set()
+
+    def test_index(self, tmpdir):
+        root = str(tmpdir.join('data'))
+        shutil.copytree('tests/data/simple', root)
+        index_file = os.path.join(root, pyf.index.index_file_default)
+
+        # build only
+        assert self.run(['--build-index', '-d', root]) == (0, [], '')
+        assert os.path.exists(index_file)
+        index = pyf.index.Index(root)
+        index.load(index_file)
+        assert sorted(index.files) == ['01.txt', '02.txt', '03.txt']
+        next_id = index.next_id
+
+        # search using it
+        assert self.run(['--use-index', '-d', root, 'three']) == (0, [os.path.join(root, '03.txt')], '')
+        assert self.run(['--use-index', '-d', root, 'four']) == (1, [], '')
+
+        # changed files are searched
+        with open(os.path.join(root, '01.txt'), 'a') as fp:
+            fp.write('four\n')
+        assert self.run(['--use-index', '-d', root, 'four']) == (0, [os.path.join(root, '01.txt')], '')
+
+        # only the changed file is read again, the removed file is dropped
+        os.unlink(os.path.join(root, '02.txt'))
+        assert self.run(['--build-index', '-d', root, 'four']) == (0, [os.path.join(root, '01.txt')], '')
+        index = pyf.index.Index(root)
+        index.load(index_file)
+        assert sorted(index.files) == ['01.txt', '03.txt']
+        assert index.next_id == next_id + 1
+        assert b'fou' in index.postings
+
+    def test_crlf(self, tmpdir):
+        # the trigrams are those of the file, the search is of universal newline text
+        tmpdir.join('crlf.txt').write_binary(b'foo\r\nbar\r\n')
+        tmpdir.join('cr.txt').write_binary(b'foo\rbar\r')
+        tmpdir.join('other.txt').write_binary(b'other\n')
+        root = str(tmpdir)
+        assert self.run(['--build-index', '-d', root]) == (0, [], '')
+        exitcode, stdout, stderr = self.run(['--use-index', '-d', root, 'bar'])
+        assert (exitcode, sorted(stdout)) == (0, [os.path.join(root, f) for f in ('cr.txt', 'crlf.txt')])
+        options = pyf.options.parse_opts(['-N', r'foo\nbar'], stdout=StringIO(), stderr=StringIO())
+        index = pyf.index.Index(root)
+        index.load(os.path.join(root, pyf.index.index_file_default))
+        index.query(options)
+        assert not index.skip(os.path.join(root, 'crlf.txt'))
+        assert not index.skip(os.path.join(root, 'cr.txt'))
+        assert index.skip(os.path.join(root, 'other.txt'))
+
+    def test_no_index(self, tmpdir):
+        index_file = str(tmpdir.join('no-index'))
+        exitcode, stdout, stderr = self.run(['--use-index', '--index-file', index_file, '-d', 'tests/data/context', 'nine'])
+        assert exitcode == 0
+        assert stdout == ['tests/data/context/context.txt']
+        assert stderr == 'Error loading index %s\n' % index_file
+
+
+class TestCache(object):
+    def run(self, args):
+        stdout = StringIO()
+        stderr = StringIO()
+        exitcode = pyf.pyf.main(['-N'] + args, stdout=stdout, stderr=stderr)
+        return exitcode, stdout.getvalue().split(), stderr.getvalue()
+
+    def test_cache(self, tmpdir, monkeypatch):
+        root = str(tmpdir.join('data'))
+        shutil.copytree('tests/data/simple', root)
+        cache_file = str(tmpdir.join('cache'))
+        args = ['--cache-file', cache_file, '-d', root, 'three']
+        found = (0, [os.path.join(root, '03.txt')], '')
+
+        assert self.run(args) == found
+        cache = pyf.cache.MetadataCache(cache_file, settings={'sniff_size': pyf.filetype.sniff_size_default})
+        cache.load()
+        assert len(cache.entries) == 3
+
+        # unchanged files are not checked again
+        def sniff_binary(options, path, fd):
+            checked.append(os.path.basename(path))
+            return False
+        checked = []
+        monkeypatch.setattr(pyf.pyf, 'sniff_binary', sniff_binary)
+        assert self.run(args) == found
+        assert checked == []
+
+        with open(os.path.join(root, '01.txt'), 'a') as fp:
+            fp.write('four\n')
+        assert self.run(args) == found
+        assert checked == ['01.txt']
+
+    def test_cache_ctime(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join('01.txt'))
+        shutil.copy('tests/data/simple/01.txt', path)
+        cache = pyf.cache.MetadataCache(str(tmpdir.join('cache')))
+        st = os.stat(path)
+        cache.put(cache.key(st), False)
+        assert cache.get(cache.key(st)) is False
+        # only worker processes keep what they added
+        assert cache.added is None
+        # a change that sets the mtime back still changes the ctime
+        time.sleep(0.01)
+        with open(path, 'a') as fp:
+            fp.write('x')
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.truncate(path, st.st_size)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert cache.get(cache.key(os.stat(path))) is None
+
+        # files that cannot be opened are not kept
+        monkeypatch.setattr(pyf.pyf, 'open_file', lambda options, path: None)
+        cache_file = str(tmpdir.join('cache'))
+        assert self.run(['--cache-file', cache_file, '-d', str(tmpdir), '-n', r'\.txt', 'one'])[0] == 1
+        cache = pyf.cache.MetadataCache(cache_file, settings={'sniff_size': pyf.filetype.sniff_size_default})
+        cache.load()
+        assert len(cache.entries) == 0
+
+    def test_cache_size(self, tmpdir):
+        cache_file = str(tmpdir.join('cache'))
+        assert self.run(['--cache-file', cache_file, '--cache-size', '2', '-d', 'tests/data/simple', 'three'])[0] == 0
+        cache = pyf.cache.MetadataCache(cache_file, settings={'sniff_size': pyf.filetype.sniff_size_default})
+        cache.load()
+        assert len(cache.entries) == 2
+
+    def test_no_cache(self, tmpdir):
+        cache_file = str(tmpdir.join('cache'))
+        assert self.run(['--no-cache', '--cache-file', cache_file, '-d', 'tests/data/simple', 'three'])[0] == 0
+        assert not os.path.exists(cache_file)
+
+
+class TestStream(object):
+    def test_long_lines(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(pyf.pyf, 'stream_block_size', 8)
+        monkeypatch.setattr(pyf.pyf, 'stream_line_size', 16)
+        monkeypatch.setattr(pyf.pyf, 'pyf_file_mapped', lambda options, path, fd: False)
+        path = str(tmpdir.join('long.txt'))
+        with open(path, 'w') as fp:
+            fp.write('one\nneedle ' + 'x' * 100 + '\n' + 'x' * 100 + ' needle\ntwo needle\n' + 'y' * 50)
+
+        def run(*args):
+            stdout = StringIO()
+            assert pyf.pyf.main(['-N', '--large-file-size', '0', '-p', '-s', '-l'] + list(args) + ['-f', path], stdout=stdout, stderr=StringIO()) == 0
+            return stdout.getvalue().splitlines()
+
+        # the rest of a line longer than a block and stream_line_size is skipped
+        assert run('needle') == ['2: needle xxxxxxxxxxxxx', '4: two needle']
+        assert run('-c', '1', 'two') == ['3: ' + 'x' * 24, '4: two needle', '5: ' + 'y' * 24]
+        assert run('-v', 'x') == ['1: one', '4: two needle', '5: ' + 'y' * 24]
+
+
+class TestTrace(object):
+    def test_trace(self, tmpdir):
+        trace_file = str(tmpdir.join('trace'))
+        stdout = StringIO()
+        exitcode = pyf.pyf.main(['-N', '--no-cache', '--trace', trace_file, '-d', 'tests/data/simple', 'three'],
+                                stdout=stdout, stderr=StringIO())
+        assert exitcode == 0
+        with open(trace_file) as fp:
+            records = [json.loads(line) for line in fp]
+        files = sorted((r['path'], r['results']) for r in records if r['event'] == 'file')
+        assert files == [
+            ('tests/data/simple/01.txt', 0),
+            ('tests/data/simple/02.txt', 0),
+            ('tests/data/simple/03.txt', 1),
+        ]
+        assert set(r['how'] for r in records if r['event'] == 'search') == set(['read'])
+
+
+class TestSearch(object):
+    def test_search(self):
+        matches = list(pyf.search('t(..)', 'tests/data/simple'))
+        assert sorted((m.path, m.lnum, m.offset, m.span, m.groups, m.line) for m in matches) == [
+            ('tests/data/simple/02.txt', 2, 4, (0, 3), ('wo',), 'two'),
+            ('tests/data/simple/03.txt', 2, 4, (0, 3), ('wo',), 'two'),
+            ('tests/data/simple/03.txt', 3, 8, (0, 3), ('hr',), 'three'),
+        ]
+        assert len(list(pyf.search('one', 'tests/data/simple', max_results=2))) == 2
+        assert [m.path for m in pyf.search('one', files=['tests/data/simple/02.txt'])] == ['tests/data/simple/02.txt']
+
+    def test_offsets(self, tmpdir):
+        path = str(tmpdir.join('offsets.txt'))
+        data = '  caf\u00e9 foo 1\r\nbar\r\n\t\u2003 x foo(2)\rlast foo\n'.encode('utf-8')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        matches = list(pyf.search(r'foo\W*(\d*)', files=[path]))
+        assert [(m.lnum, m.line, m.span, m.groups) for m in matches] == [
+            (1, 'caf\u00e9 foo 1', (5, 10), ('1',)),
+            (3, 'x foo(2)', (2, 7), ('2',)),
+            (4, 'last foo', (5, 8), ('',)),
+        ]
+        assert [data[m.offset:m.offset + 3] for m in matches] == [b'foo'] * 3
+
+    def test_errors(self):
+        with pytest.raises(ValueError):
+            pyf.search('(', '.')
+        with pytest.raises(TypeError):
+            pyf.search('one', '.', nonsense=True)
+
+    def test_documented_options(self):
+        with open('README.md') as fp:
+            readme = fp.read()
+        section = readme[readme.index('`pyf.search('):]
+        section = section[:section.index('\n')]
+        for name in pyf.api.search_opts:
+            assert '`%s`' % name in section
+            assert name in pyf.api.search.__doc__
+
+    def test_root_errors(self, tmpdir):
+        root = str(tmpdir.join('none'))
+        with pytest.raises(FileNotFoundError):
+            list(pyf.search('one', root))
+        errors = []
+        assert list(pyf.search('one', root, onerror=lambda path, e: errors.append((path, type(e))))) == []
+        assert errors == [(root, FileNotFoundError)]
+        with pytest.raises(NotADirectoryError):
+            list(pyf.search('one', 'tests/data/simple/01.txt'))
+        with pytest.raises(FileNotFoundError):
+            list(pyf.search('one', root, git=True))
+
+
+class TestAsyncSearch(object):
+    def test_asearch(self):
+        async def collect(**opts):
+            return [(m.path, m.lnum, m.offset) async for m in pyf.asearch('t(..)', 'tests/data', **opts)]
+
+        expected = [(m.path, m.lnum, m.offset) for m in pyf.search('t(..)', 'tests/data')]
+        assert asyncio.run(collect()) == expected
+        assert asyncio.run(collect(max_pending=1)) == expected
+        assert asyncio.run(collect(max_results=2)) == expected[:2]
+
+    def test_cancel(self, tmpdir):
+        for i in range(20):
+            with open(str(tmpdir.join('%02d.txt' % i)), 'w') as fp:
+                fp.write('match\n' * 100)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        consumed = []
+
+        async def consume():
+            async for m in pyf.asearch('match', str(tmpdir), executor=executor, max_pending=4):
+                consumed.append(m)
+                await asyncio.sleep(10)
+
+        async def main():
+            task = asyncio.ensure_future(consume())
+            while not consumed:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+        executor.shutdown(wait=True)
+        assert len(consumed) == 1
+
+    def test_close_walk(self, monkeypatch):
+        closed = []
+        walk_paths = pyf.api.walk_paths
+
+        def walk(options, onerror):
+            try:
+                for path in walk_paths(options, onerror):
+                    yield path
+            finally:
+                closed.append(threading.current_thread() is threading.main_thread())
+        monkeypatch.setattr(pyf.api, 'walk_paths', walk)
+
+        async def collect():
+            return [m async for m in pyf.asearch('t(..)', 'tests/data', max_results=1, max_pending=1)]
+
+        assert len(asyncio.run(collect())) == 1
+        # in the executor, not the event loop
+        assert closed == [False]
+
+    def test_cancelled_file(self):
+        options = pyf.api.make_options('one', '.', {})
+        cancel = threading.Event()
+        path = 'tests/data/simple/01.txt'
+        assert len(list(pyf.api.search_file(options, path, None, cancel))) == 1
+        cancel.set()
+        assert list(pyf.api.search_file(options, path, None, cancel)) == []
+
+    def test_max_pending(self):
+        with pytest.raises(ValueError):
+            pyf.asearch('one', '.', max_pending=0)
+
+
+class TestServer(object):
+    @pytest.fixture
+    def server(self, tmpdir):
+        sock = str(tmpdir.join('pyf.sock'))
+        p = subprocess.Popen([sys.executable, '-m', 'pyf.pyf', '--serve', '--socket', sock])
+        for i in range(100):
+            if os.path.exists(sock):
+                break
+            time.sleep(0.05)
+        self.process = p
+        yield sock
+        p.terminate()
+        assert p.wait() == 0
+        assert not os.path.exists(sock)
+
+    def client(self, sock, argv):
+        stdout = StringIO()
+        stderr = StringIO()
+        exitcode = pyf.pyf.main(['--client', '--socket', sock] + argv, stdout=stdout, stderr=stderr)
+        return exitcode, sorted(stdout.getvalue().splitlines()), stderr.getvalue()
+
+    def test_server(self, server, tmpdir):
+        argv = ['-p', '-d', 'tests/data/simple', 't(..)']
+        stdout = StringIO()
+        assert pyf.pyf.main(['-N', '--no-cache'] + argv, stdout=stdout, stderr=StringIO()) == 0
+        assert self.client(server, argv) == (0, sorted(stdout.getvalue().splitlines()), '')
+        # answered from the kept listings the second time
+        assert self.client(server, argv) == (0, sorted(stdout.getvalue().splitlines()), '')
+        assert self.client(server, ['-d', 'tests/data/simple', 'no-such-text']) == (1, [], '')
+
+        exitcode, out, err = self.client(server, ['--no-such-option'])
+        assert exitcode == 2
+        assert 'unrecognized arguments' in err
+        exitcode, out, err = self.client(server, ['--serve'])
+        assert exitcode == 2
+        exitcode, out, err = self.client(server, ['-r', 'true', '-d', 'tests/data/simple', 'one'])
+        assert (exitcode, out, err) == (2, [], 'Error: -r cannot be sent to the server.\n')
+
+    def test_changed_dir(self, server, tmpdir):
+        tmpdir.join('a.txt').write('needle\n')
+        os.utime(str(tmpdir), (time.time() - 10, time.time() - 10))
+        argv = ['-p', '-d', str(tmpdir), 'needle']
+        assert self.client(server, argv)[1] == ['%s: needle' % tmpdir.join('a.txt')]
+        tmpdir.join('b.txt').write('needle\n')
+        assert self.client(server, argv)[1] == ['%s: needle' % tmpdir.join(n) for n in ('a.txt', 'b.txt')]
+
+    def test_socket_dir(self, tmpdir, monkeypatch):
+        monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+        monkeypatch.setattr(pyf.server.tempfile, 'gettempdir', lambda: str(tmpdir))
+        path = pyf.server.socket_default()
+        assert os.path.dirname(path) == str(tmpdir.join('pyf-%d' % os.getuid()))
+        assert pyf.server.make_socket_dir(os.path.dirname(path)) is None
+        assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == 0o700
+        # one others can write is not used
+        os.chmod(os.path.dirname(path), 0o777)
+        assert 'only this user' in pyf.server.make_socket_dir(os.path.dirname(path))
+
+    def test_other_user(self, server, monkeypatch):
+        monkeypatch.setattr(pyf.server, 'peer_uid', lambda sock, path: os.getuid() + 1)
+        exitcode, out, err = self.client(server, ['-d', 'tests/data/simple', 'one'])
+        assert (exitcode, out) == (2, [])
+        assert 'run by another user' in err
+
+    def test_silent_client(self, server):
+        # one that sends nothing does not keep the others waiting for ever
+        silent = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        silent.connect(server)
+        try:
+            start = time.time()
+            assert self.client(server, ['-d', 'tests/data/simple', 'three'])[:2] == (0, ['tests/data/simple/03.txt'])
+            assert time.time() - start < pyf.server.request_timeout + 5
+        finally:
+            silent.close()
+
+    def test_terminate_search(self, server, tmpdir):
+        # killed while a search waits to open a fifo
+        fifo = str(tmpdir.join('fifo'))
+        os.mkfifo(fifo)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.client(server, ['-f', fifo, 'x'])))
+        thread.start()
+        time.sleep(0.5)
+        self.process.terminate()
+        assert self.process.wait(timeout=10) == 0
+        thread.join()
+        assert not os.path.exists(server)
+        assert results[0][0] == 2
+
+    def test_no_server(self, tmpdir):
+        exitcode, out, err = self.client(str(tmpdir.join('none.sock')), ['x'])
+        assert exitcode == 2
+        assert 'Error connecting to the pyf server' in err
+
+
+class TestWatch(object):
+    def test_diff_lines(self):
+        assert pyf.watch.diff_lines(['a', 'b', 'b', 'c'], ['b', 'c', 'd', 'c']) == (['a', 'b'], ['d', 'c'])
+
+    @pytest.mark.parametrize('poll', [[], ['--watch-poll', '0.2']])
+    def test_watch(self, tmpdir, poll):
+        root = tmpdir.mkdir('data')
+        root.join('a.txt').write('foo 1\n')
+        root.join('b.txt').write('bar\n')
+        p = subprocess.Popen([sys.executable, '-m', 'pyf.pyf', '-N', '--no-cache', '-p', '--watch'] + poll +
+                             ['-d', str(root), 'foo'], stdout=subprocess.PIPE, universal_newlines=True)
+        try:
+            assert p.stdout.readline() == '+ %s: foo 1\n' % root.join('a.txt')
+            # give the watch time to start after printing
+            time.sleep(0.5)
+            root.join('b.txt').write('bar\nfoo 2\n')
+            assert p.stdout.readline() == '+ %s: foo 2\n' % root.join('b.txt')
+            root.mkdir('sub').join('c.txt').write('foo 3\n')
+            assert p.stdout.readline() == '+ %s: foo 3\n' % root.join('sub', 'c.txt')
+            root.join('a.txt').remove()
+            assert p.stdout.readline() == '- %s: foo 1\n' % root.join('a.txt')
+        finally:
+            p.send_signal(signal.SIGINT)
+            assert p.wait() == 0
+            p.stdout.close()
+
+
+class TestGitignore(object):
+    def make_tree(self, root):
+        root.mkdir('.git').mkdir('info').join('exclude').write('*.tmp\n')
+        root.join('.gitignore').write('# built\n*.log\n!keep.log\nbuild/\n/top.txt\ndocs/**/*.md\n')
+        root.mkdir('src').join('.gitignore').write('*.py\n!ok.py\n')
+        root.mkdir('docs').mkdir('api').join('.ignore').write('!index.md\n')
+        for path in ('a.log', 'keep.log', 'a.tmp', 'build/a.txt', 'src/build/a.txt', 'top.txt', 'src/top.txt',
+                     'docs/a.md', 'docs/api/a.md', 'docs/api/index.md', 'docs/a.txt', 'src/a.py', 'src/ok.py'):
+            root.join(path).write('needle\n', ensure=True)
+
+    def search(self, args):
+        stdout = StringIO()
+        exitcode = pyf.pyf.main(['-N', '--no-cache', '--gitignore'] + args, stdout=stdout, stderr=StringIO())
+        assert exitcode == 0
+        return sorted(stdout.getvalue().split())
+
+    @pytest.mark.parametrize('walk_threads', ['0', '2'])
+    def test_gitignore(self, tmpdir, walk_threads):
+        self.make_tree(tmpdir)
+        found = self.search(['--walk-threads', walk_threads, '-d', str(tmpdir), 'needle'])
+        assert found == sorted(str(tmpdir.join(path)) for path in (
+            'keep.log', 'src/top.txt', 'docs/api/index.md', 'docs/a.txt', 'src/ok.py'))
+
+    def test_subdirectory(self, tmpdir):
+        # the ignore files above the start directory apply
+        self.make_tree(tmpdir)
+        assert self.search(['-d', str(tmpdir.join('docs')), 'needle']) == sorted(
+            str(tmpdir.join(path)) for path in ('docs/api/index.md', 'docs/a.txt'))
+
+    def test_rules(self):
+        ignore = pyf.ignore.IgnoreFile([pyf.ignore.parse_rule(line) for line in (
+            '*.o', 'bin/', '/root.txt', 'a/**/b', 'lib/*', '!lib/keep', '\\!bang', 'x\\ ', 'f[!0-9]')])
+        assert ignore.match('x/y.o', False) is True
+        assert ignore.match('x/bin', True) is True
+        assert ignore.match('x/bin', False) is None
+        assert ignore.match('root.txt', False) is True
+        assert ignore.match('x/root.txt', False) is None
+        assert ignore.match('a/b', False) is True
+        assert ignore.match('a/x/y/b', False) is True
+        assert ignore.match('lib/other', False) is True
+        assert ignore.match('lib/keep', False) is False
+        assert ignore.match('!bang', False) is True
+        assert ignore.match('x ', False) is True
+        assert ignore.match('fa', False) is True
+        assert ignore.match('f1', False) is None
+
+
+@pytest.mark.skipif(shutil.which('git') is None, reason='needs git to make the index')
+class TestGit(object):
+    def make_repo(self, root, version):
+        for path in ('a.txt', 'src/b.py', 'src/c.txt', 'src/.hidden', 'build/d.txt', 'e.log'):
+            root.join(path).write('needle\n', ensure=True)
+        root.join('.gitignore').write('*.log\n')
+        git = ['git', '-C', str(root)]
+        subprocess.check_call(git + ['init', '-q'])
+        subprocess.check_call(git + ['add', 'a.txt', 'src', 'build', '.gitignore'])
+        subprocess.check_call(git + ['update-index', '--index-version', version])
+        # not tracked
+        root.join('src', 'new.txt').write('needle\n')
+
+    def search(self, args):
+        stdout = StringIO()
+        stderr = StringIO()
+        exitcode = pyf.pyf.main(['-N', '--no-cache', '--git'] + args, stdout=stdout, stderr=stderr)
+        return exitcode, stdout.getvalue().split(), stderr.getvalue()
+
+    @pytest.mark.parametrize('version', ['2', '3', '4'])
+    def test_git(self, tmpdir, version):
+        self.make_repo(tmpdir, version)
+        root = str(tmpdir)
+        assert self.search(['-d', root, 'needle']) == (0, [os.path.join(root, path) for path in (
+            'a.txt', 'build/d.txt', 'src/b.py', 'src/c.txt')], '')
+        assert self.search(['--skip-dirs-pattern', 'build', '-d', root, '-n', 'txt']) == (0, [os.path.join(root, path) for path in (
+            'a.txt', 'src/c.txt')], '')
+        exitcode, out, err = self.search(['--untracked', '-d', root, 'needle'])
+        assert sorted(out) == sorted(os.path.join(root, path) for path in (
+            'a.txt', 'build/d.txt', 'src/b.py', 'src/c.txt', 'src/new.txt'))
+        # below the top of the work tree
+        assert self.search(['-d', os.path.join(root, 'src'), 'needle', r'\.py$']) == (0, [os.path.join(root, 'src', 'b.py')], '')
+
+    @pytest.mark.parametrize('jobs', ['1', '2'])
+    def test_index(self, tmpdir, jobs):
+        self.make_repo(tmpdir, '2')
+        tmpdir.join('a.txt').write('other\n')
+        root = str(tmpdir)
+        assert pyf.pyf.main(['-N', '--no-cache', '--build-index', '-d', root], stdout=StringIO(), stderr=StringIO()) == 0
+        trace_file = str(tmpdir.join('trace'))
+        assert self.search(['--use-index', '--trace', trace_file, '-j', jobs, '-d', root, 'other']) == (
+            0, [os.path.join(root, 'a.txt')], '')
+        with open(trace_file) as fp:
+            skipped = sorted(r['path'] for r in (json.loads(line) for line in fp) if r.get('reason') == 'index')
+        assert skipped == [os.path.join(root, path) for path in ('build/d.txt', 'src/b.py', 'src/c.txt')]
+
+    def test_no_repository(self, tmpdir):
+        exitcode, out, err = self.search(['-d', str(tmpdir), 'needle'])
+        assert exitcode == 2
+        assert 'not in a git repository' in err
+
+
+class TestStats(object):
+    @pytest.mark.parametrize('jobs', ['1', '2'])
+    def test_stats(self, jobs):
+        stderr = StringIO()
+        exitcode = pyf.pyf.main(['-N', '--no-cache', '--stats-json', '-j', jobs, '-n', r'0[12]\.txt', '-d', 'tests/data/simple', 'one'],
+                                stdout=StringIO(), stderr=stderr)
+        assert exitcode == 0
+        stats = json.loads(stderr.getvalue())
+        assert stats['counters'] == {
+            'dirs': 1,
+            'files': 2,
+            'skipped_dirs_pattern': 0,
+            'skipped_files_pattern': 0,
+            'skipped_filename_pattern': 1,
+            'skipped_ignore': 0,
+            'skipped_index': 0,
+            'skipped_binary': 0,
+            'unreadable': 0,
+            'searched': 2,
+            'bytes_read': os.path.getsize('tests/data/simple/01.txt') + os.path.getsize('tests/data/simple/02.txt'),
+            'matched_files': 2,
+            'results': 2,
+        }
+        assert sorted(stats['seconds']) == sorted(pyf.stats.stages)
+
+
+class TestReplace(object):
+    def run(self, args):
+        stdout = StringIO()
+        stderr = StringIO()
+        exitcode = pyf.pyf.main(['-N'] + args, stdout=stdout, stderr=stderr)
+        return exitcode, stdout.getvalue().split(), stderr.getvalue()
+
+    @pytest.mark.parametrize('jobs', ['1', '2'])
+    def test_replace(self, tmpdir, jobs):
+        root = str(tmpdir.join('data'))
+        shutil.copytree('tests/data/simple', root)
+        path = os.path.join(root, '02.txt')
+        with open(path, 'w', newline='') as fp:
+            fp.write('one zoo\r\n  zoo three  \nzoo')
+        os.chmod(path, 0o640)
+
+        assert self.run(['-j', jobs, '--replace', r'<\1>', '-d', root, '(zo)o']) == (0, [path], '')
+        with open(path, 'r', newline='') as fp:
+            assert fp.read() == 'one <zo>\r\n  <zo> three  \n<zo>'
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+        assert sorted(os.listdir(root)) == ['01.txt', '02.txt', '03.txt']
+
+
+class TestOutput(object):
+    class Stream(StringIO):
+        def __init__(self, tty=False, broken=False):
+            StringIO.__init__(self)
+            self.tty = tty
+            self.broken = broken
+
+        def isatty(self):
+            return self.tty
+
+        def write(self, s):
+            if self.broken:
+                raise BrokenPipeError(errno.EPIPE, 'Broken pipe')
+            return StringIO.write(self, s)
+
+    def options(self):
+        return pyf.options.parse_opts(['-N', 'one'], stdout=StringIO(), stderr=StringIO())
+
+    def test_buffered(self, monkeypatch):
+        monkeypatch.setattr(pyf.output, 'output_flush_interval', 60)
+        stream = self.Stream()
+        out = pyf.output.OutputBuffer(self.options(), stream)
+        out.writeline('one')
+        out.write('two\nthree\n')
+        assert stream.getvalue() == ''
+        out.flush()
+        assert stream.getvalue() == 'one\ntwo\nthree\n'
+
+    def test_flush_between_files(self, monkeypatch):
+        monkeypatch.setattr(pyf.output, 'output_flush_interval', 0.05)
+        stream = self.Stream()
+        seen = []
+        pyf_file_open = pyf.pyf.pyf_file_open
+
+        def slow_file_open(options, path):
+            seen.append(stream.getvalue())
+            pyf_file_open(options, path)
+            time.sleep(0.06)
+        monkeypatch.setattr(pyf.pyf, 'pyf_file_open', slow_file_open)
+        files = ['tests/data/simple/%s' % f for f in ('03.txt', '01.txt', '02.txt')]
+        args = ['-N', '--no-cache'] + ['-f%s' % f for f in files] + ['three']
+        assert pyf.pyf.main(args, stdout=stream, stderr=StringIO()) == 0
+        # the first result is written while the other files are searched
+        assert seen == ['', files[0] + '\n', files[0] + '\n']
+
+    def test_tty(self):
+        stream = self.Stream(tty=True)
+        out = pyf.output.OutputBuffer(self.options(), stream)
+        out.writeline('one')
+        assert stream.getvalue() == 'one\n'
+
+    def test_binary(self):
+        stream = BytesIO()
+        stream.isatty = lambda: False
+        out = pyf.output.OutputBuffer(self.options(), stream)
+        out.writeline('\u4e2d')
+        out.flush()
+        assert stream.getvalue() == '\u4e2d\n'.encode(out.encoding, 'replace')
+
+    def test_broken_pipe(self):
+        options = self.options()
+        out = pyf.output.OutputBuffer(options, self.Stream(broken=True), line_buffered=True)
+        out.writeline('one')
+        assert out.broken
+        assert options.done
+        out.writeline('two')
+
+
+class TestRunner(object):
+    class Process(object):
+        def __init__(self, args):
+            TestRunner.started.append(args)
+            self.returncode = 0
+
+        def poll(self):
+            return self.returncode
+
+        def wait(self):
+            return self.returncode
+
+    def test_batches(self, monkeypatch):
+        TestRunner.started = []
+        monkeypatch.setattr(pyf.pyf.subprocess, 'Popen', self.Process)
+        options = pyf.options.parse_opts(['-N', '--run-batch', '-r', 'cmd arg', 'one'], stdout=StringIO(), stderr=StringIO())
+        runner = pyf.pyf.Runner(options)
+        # room for two paths per command
+        runner.limit = pyf.pyf.arg_size(['path0', 'path1'])
+        for i in range(5):
+            runner.add('path%d' % i)
+        runner.finish()
+        assert TestRunner.started == [
+            ['cmd', 'arg', 'path0', 'path1'],
+            ['cmd', 'arg', 'path2', 'path3'],
+            ['cmd', 'arg', 'path4'],
+        ]
+        assert runner.failed == 0
+
+
 def make_filelist():
     # the starting directory to make a list of files to check
     #start_dir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -385,6 +1276,21 @@ class TestFileType(object):
         is_text = pyf.filetype.is_text(afile)
         assert file_is_text == is_text
 
+    @pytest.mark.parametrize('data, is_text', [
+        (b'', False),
+        (b'plain text\n', True),
+        ('caf\u00e9 \u4e2d\u6587\n'.encode('utf-8'), True),
+        # a character cut off at the end of the block
+        ('\u4e2d\u6587'.encode('utf-8')[:-1], False),
+        ('\u4e2d\u6587\u4e2d\u6587'.encode('utf-8')[:-1], True),
+        (b'\x00\x01\x02text', False),
+        (b'\xff\xfe\xfd\xfc', False),
+        (b'\x1f\x8b\x08 gzip header', False),
+    ])
+    def test_text_data(self, data, is_text):
+        assert pyf.filetype.is_text_data(data) == is_text
+        assert pyf.filetype.is_text_data(bytearray(data)) == is_text
+
 
 if __name__ == '__main__':
     pytest.main()